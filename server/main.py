@@ -3,7 +3,7 @@ import asyncio
 import time
 
 from udp_handler import listen_for_udp
-from websocket_push import listen_for_websocket
+from websocket_push import listen_for_websocket, DROP_POLICIES
 
 udp_port = 5005
 websocket_port = 8888
@@ -11,6 +11,11 @@ websocket_port = 8888
 async def main():
     parser = argparse.ArgumentParser(description='Start the server with optional SSL for websocket.')
     parser.add_argument('--dev', action='store_true', help='Skip SSL and use localhost for sockets')
+    parser.add_argument('--client-policy', choices=DROP_POLICIES, default='drop_oldest',
+                        help='What to do with data for a websocket client that can\'t keep up')
+    parser.add_argument('--client-queue-size', type=int, default=10, help='Max payloads queued per websocket client')
+    parser.add_argument('--lag-timeout', type=float, default=10.0,
+                        help='Seconds a client may lag before it is disconnected (disconnect policy)')
     args = parser.parse_args()
 
     print("Starting Pitstop server v. 0.2 - " + time.asctime())
@@ -22,7 +27,8 @@ async def main():
         listen_ip = "pitstop.driftfun.no"
 
     udp_task = asyncio.create_task(listen_for_udp(listen_ip, udp_port))
-    websocket_task = asyncio.create_task(listen_for_websocket(listen_ip, websocket_port, args.dev))
+    websocket_task = asyncio.create_task(listen_for_websocket(listen_ip, websocket_port, args.dev, args.client_policy,
+                                                            args.client_queue_size, args.lag_timeout))
 
     await asyncio.gather(udp_task, websocket_task)
 
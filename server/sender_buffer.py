@@ -0,0 +1,135 @@
+from array import array
+
+# Slot states
+EMPTY = 0
+BACKFILLED = 1  # Only position and RPM, recovered from the position history of a later packet
+COMPLETE = 2  # All data from the packet for this timestamp
+
+SLOT_MS = 100
+
+
+class SenderBuffer:
+    # Ring buffer with the last `capacity` 100 ms slots of data for one sender.
+    # A timestamp always maps to slot (timestamp // 100) % capacity, so inserting,
+    # checking for duplicates and looking up a timestamp are all O(1), and
+    # backfilling older slots never needs a re-sort. Data is kept column-wise in
+    # typed arrays instead of one dict per entry.
+
+    def __init__(self, sender_id, capacity=100):
+        self.id = sender_id
+        self.capacity = capacity
+        self.newest_timestamp = None
+
+        self.timestamps = array('q', [-1]) * capacity
+        self.state = bytearray(capacity)
+        self.speed = array('d', [0.0]) * capacity
+        self.heading = array('d', [0.0]) * capacity
+        self.coolant_temp = array('B', [0]) * capacity
+        self.oil_temp = array('B', [0]) * capacity
+        self.accelerator = array('B', [0]) * capacity
+        self.clutch = array('B', [0]) * capacity
+        self.brake = array('B', [0]) * capacity
+        self.latitude = array('d', [0.0]) * capacity
+        self.longitude = array('d', [0.0]) * capacity
+        self.rpm = array('H', [0]) * capacity
+
+    def slot(self, timestamp):
+        return (timestamp // SLOT_MS) % self.capacity
+
+    def oldest_timestamp(self):
+        # Oldest timestamp that still fits in the buffer
+        if self.newest_timestamp is None:
+            return None
+        return self.newest_timestamp - (self.capacity - 1) * SLOT_MS
+
+    def _claim(self, timestamp, state):
+        # Returns the slot to write timestamp into, or None if it is a duplicate
+        # or too old to fit in the buffer
+        oldest = self.oldest_timestamp()
+        if oldest is not None and timestamp < oldest:
+            return None
+
+        slot = self.slot(timestamp)
+        if self.timestamps[slot] == timestamp and self.state[slot] >= state:
+            return None
+
+        self.timestamps[slot] = timestamp
+        self.state[slot] = state
+        if self.newest_timestamp is None or timestamp > self.newest_timestamp:
+            self.newest_timestamp = timestamp
+        return slot
+
+    def add(self, timestamp, data):
+        # Stores the current data from a parsed packet. Replaces a backfilled
+        # entry for the same timestamp, but not a complete one.
+        slot = self._claim(timestamp, COMPLETE)
+        if slot is None:
+            return False
+
+        self.speed[slot] = data['speed']
+        self.heading[slot] = data['heading']
+        self.coolant_temp[slot] = data['coolant_temp']
+        self.oil_temp[slot] = data['oil_temp']
+        self.accelerator[slot] = data['accelerator']
+        self.clutch[slot] = data['clutch']
+        self.brake[slot] = data['brake']
+        self.latitude[slot], self.longitude[slot] = data['positions'][0]
+        self.rpm[slot] = data['rpms'][0]
+        return True
+
+    def backfill(self, timestamp, position, rpm):
+        # Stores position and RPM for a timestamp we have no data for yet
+        slot = self._claim(timestamp, BACKFILLED)
+        if slot is None:
+            return False
+
+        self.latitude[slot], self.longitude[slot] = position
+        self.rpm[slot] = rpm
+        return True
+
+    def has(self, timestamp):
+        oldest = self.oldest_timestamp()
+        if oldest is None or timestamp < oldest:
+            return False
+        return self.timestamps[self.slot(timestamp)] == timestamp
+
+    def get(self, timestamp):
+        # Returns the entry for a timestamp as a dict, or None if there is none
+        oldest = self.oldest_timestamp()
+        if oldest is None or timestamp < oldest:
+            return None
+
+        slot = self.slot(timestamp)
+        if self.timestamps[slot] != timestamp:
+            return None
+
+        entry = {
+            'id': self.id,
+            'timestamp': timestamp,
+        }
+        if self.state[slot] == COMPLETE:
+            entry['speed'] = self.speed[slot]
+            entry['heading'] = self.heading[slot]
+            entry['coolant_temp'] = self.coolant_temp[slot]
+            entry['oil_temp'] = self.oil_temp[slot]
+            entry['accelerator'] = self.accelerator[slot]
+            entry['clutch'] = self.clutch[slot]
+            entry['brake'] = self.brake[slot]
+        entry['position'] = (self.latitude[slot], self.longitude[slot])
+        entry['rpm'] = self.rpm[slot]
+        return entry
+
+    def __iter__(self):
+        # Entries from newest to oldest
+        if self.newest_timestamp is None:
+            return
+        for index in range(self.capacity):
+            entry = self.get(self.newest_timestamp - index * SLOT_MS)
+            if entry is not None:
+                yield entry
+
+    def __len__(self):
+        oldest = self.oldest_timestamp()
+        if oldest is None:
+            return 0
+        return sum(1 for timestamp in self.timestamps if timestamp >= oldest)
@@ -1,14 +1,32 @@
+import asyncio
 import struct
+import time
 from datetime import datetime
 import uuid
 import asyncudp
-from collections import deque
 from shared import active_senders
+from sender_buffer import SenderBuffer
 from typing import TypedDict, List, Tuple
 
 # Contains a mapping from the address of the sender to the UUID of the sender
 addr_to_uuid = {}
 
+# Last time a packet came from each address in addr_to_uuid. Senders that are
+# quiet for SENDER_TIMEOUT seconds are forgotten along with their buffer in
+# active_senders, checked every STATUS_INTERVAL.
+last_seen = {}
+SENDER_TIMEOUT = 60.0
+
+# Packets and backfilled positions per sender since its last status line, as
+# [start time, packets, backfilled]. Printing every packet held up the event loop,
+# so there's one line per sender every STATUS_INTERVAL seconds instead.
+packet_counts = {}
+STATUS_INTERVAL = 1.0
+
+# Precompiled layout of a full v0 data packet, including the version byte.
+# Same layout as V0_PACKET in server_directpush/packet_parser.py.
+V0_PACKET = struct.Struct('<BQHH16H6B' + 'IIH' * 40)
+
 class DataPacket(TypedDict):
     timestamp: int
     speed: float
@@ -26,41 +44,27 @@ class DataPacket(TypedDict):
 def parse_data_packet(payload) -> DataPacket | None:
     try:
         # Unpack protocol version
-        protocol_version, = struct.unpack('<B', payload[0:1])
-        if protocol_version != 0x00:
+        if payload[0] != 0x00:
             raise ValueError("Unsupported protocol version")
-        payload = payload[1:]
 
-        # Unpack timestamp
-        timestamp, = struct.unpack('<Q', payload[0:8])
-        payload = payload[8:]
+        # Decode the whole packet in one go, without slicing the payload
+        fields = V0_PACKET.unpack_from(payload)
 
         # Change timestamps from microseconds to milliseconds
-        timestamp = timestamp // 1000
+        timestamp = fields[1] // 1000
 
         # Round to closest 100 ms
         timestamp = (timestamp // 100) * 100
 
-        # Unpack current data
-        speed, heading = struct.unpack('<HH', payload[0:4])
-        payload = payload[4:]
-
-        brake_temp = struct.unpack('<' + 'H'*16, payload[0:32])
-        payload = payload[32:]
-
-        heartrate, coolant_temp, oil_temp, accelerator, clutch, brake = struct.unpack('<BBBBBB', payload[0:6])
-        payload = payload[6:]
+        speed, heading = fields[2:4]
+        brake_temp = fields[4:20]
+        heartrate, coolant_temp, oil_temp, accelerator, clutch, brake = fields[20:26]
 
-        # Unpack array of the position of the last 40 * 100ms
-        positions = []
-        rpms = []
-        for _ in range(40):
-            lat, long, rpm = struct.unpack('<IIH', payload[0:10])
-            lat /= 6000000.0
-            long /= 6000000.0
-            positions.append((lat, long))
-            rpms.append(rpm)
-            payload = payload[10:]
+        # The position of the last 40 * 100ms, as (lat, long, rpm) triplets
+        position_fields = fields[26:]
+        positions = [(position_fields[i] / 6000000.0, position_fields[i + 1] / 6000000.0)
+                     for i in range(0, len(position_fields), 3)]
+        rpms = list(position_fields[2::3])
 
         message: DataPacket = {
             'timestamp': timestamp,
@@ -79,7 +83,7 @@ def parse_data_packet(payload) -> DataPacket | None:
 
         return message
 
-    except struct.error as e:
+    except (struct.error, IndexError) as e:
         print("Error parsing message:", e)
         return None
     except ValueError as e:
@@ -104,6 +108,7 @@ def handle_data_packet(payload, sender_addr):
         return
 
     sender_uuid = addr_to_uuid[sender_addr]
+    last_seen[sender_addr] = time.monotonic()
     data_message = parse_data_packet(payload)
 
     if data_message is None:
@@ -114,68 +119,85 @@ def handle_data_packet(payload, sender_addr):
     # print("Received data from", sender_addr, "containing timestamp", data_message['timestamp'])
 
     if active_senders.get(sender_uuid) is None:
-        active_senders[sender_uuid] = deque(maxlen=100)
+        active_senders[sender_uuid] = SenderBuffer(str(sender_uuid))
 
     sender_buffer = active_senders[sender_uuid]
 
     # Add the newest data coming in with the packet
-    new_sender_entry = {
-        'id': str(sender_uuid),
-        'timestamp': data_message['timestamp'],
-        'speed': data_message['speed'],
-        'heading': data_message['heading'],
-        'coolant_temp': data_message['coolant_temp'],
-        'oil_temp': data_message['oil_temp'],
-        'accelerator': data_message['accelerator'],
-        'clutch': data_message['clutch'],
-        'brake': data_message['brake'],
-        'position': data_message['positions'][0],
-        'rpm': data_message['rpms'][0]
-    }
-    sender_buffer.appendleft(new_sender_entry)
-    # print("Adding entry for timestamp", new_sender_entry['timestamp'])
-
-    # Data received at clock time
-    print("Data,", sender_addr, ",", datetime.now().time(),",", data_message['timestamp'],",", new_sender_entry['position'])
+    sender_buffer.add(data_message['timestamp'], data_message)
+    # print("Adding entry for timestamp", data_message['timestamp'])
 
     position_and_rpm = zip(data_message['positions'][1:], data_message['rpms'][1:])
 
-    # Update any missing positions in older timestamps in sender's buffer
+    # Update any missing positions in older timestamps in sender's buffer.
+    # Timestamps that already exist in the buffer are skipped.
+    backfilled = 0
     for index, (position, rpm) in enumerate(position_and_rpm):
         timestamp_for_entry = data_message['timestamp'] - ((index + 1) * 100)
 
-        # If timestamp already exists in buffer, we just skip it
-        if any(entry['timestamp'] == timestamp_for_entry for entry in sender_buffer):
-            continue
+        if sender_buffer.backfill(timestamp_for_entry, position, rpm):
+            backfilled += 1
 
-        print("Backfilling", timestamp_for_entry, "with", position[0], "x", position[1], "and", rpm)
+    report_data_packet(sender_addr, data_message, backfilled)
 
-        buffer_entry = {
-            'id': str(sender_uuid),
-            'timestamp': timestamp_for_entry,
-            'position': position,
-            'rpm': rpm
-        }
-        sender_buffer.appendleft(buffer_entry)
 
-    # Sort buffer based on timestamp
-    active_senders[sender_uuid] = deque(reversed(sorted(sender_buffer, key=lambda x: x['timestamp'])), maxlen=100)
+def report_data_packet(sender_addr, data_message, backfilled):
+    counts = packet_counts.get(sender_addr)
+    now = time.monotonic()
+    if counts is None:
+        counts = packet_counts[sender_addr] = [now, 0, 0]
+    counts[1] += 1
+    counts[2] += backfilled
+    if now - counts[0] < STATUS_INTERVAL:
+        return
 
-    if len(active_senders[sender_uuid]) > 0:
-        # max_timestamp = max(timestamp['timestamp'] for timestamp in active_senders[sender_uuid])
-        # min_timestamp = min(timestamp['timestamp'] for timestamp in active_senders[sender_uuid])
-        # print("Buffer", sender_addr, "has", len(active_senders[sender_uuid]), "entries with timestamps from", min_timestamp, "to", max_timestamp)
-        # print("Latest timestamp", active_senders[sender_uuid][0]['timestamp'])
-        pass
-    else:
-        # print("Buffer", sender_addr, "is empty")
-        pass
+    # Data received at clock time, with the packets since the last line
+    print("Data,", sender_addr, ",", datetime.now().time(), ",", data_message['timestamp'], ",",
+          data_message['positions'][0], ",", counts[1], "packets,", counts[2], "backfilled")
+    packet_counts[sender_addr] = [now, 0, 0]
 
 
 def handle_auth_packet(payload, sender):
     sender_uuid = parse_auth_packet(payload)
+    last_seen[sender] = time.monotonic()
+    if addr_to_uuid.get(sender) == sender_uuid:
+        return  # Sent again every 10 seconds
+
     print("Received auth from", sender, "containing uuid", sender_uuid)
+    # The car moved to a new address, forget the old one
+    for addr, known_uuid in list(addr_to_uuid.items()):
+        if known_uuid == sender_uuid:
+            del addr_to_uuid[addr]
+            last_seen.pop(addr, None)
+    # The address may have belonged to another car until now
+    previous_uuid = addr_to_uuid.get(sender)
     addr_to_uuid[sender] = sender_uuid
+    forget_buffer(previous_uuid)
+
+
+def forget_buffer(sender_uuid):
+    # The websocket loop stops going through a car's buffer once no address sends for it
+    if sender_uuid is not None and sender_uuid not in addr_to_uuid.values():
+        active_senders.pop(sender_uuid, None)
+
+
+def forget_idle_senders():
+    now = time.monotonic()
+    for addr, seen in list(last_seen.items()):
+        if now - seen < SENDER_TIMEOUT:
+            continue
+        print("Forgetting", addr, "with uuid", addr_to_uuid.get(addr), "after", SENDER_TIMEOUT, "seconds without packets")
+        del last_seen[addr]
+        sender_uuid = addr_to_uuid.pop(addr, None)
+        packet_counts.pop(addr, None)
+        forget_buffer(sender_uuid)
+
+
+async def sweep_idle_senders():
+    # Runs on its own, so cars are forgotten even when no packets come in at all
+    while True:
+        await asyncio.sleep(STATUS_INTERVAL)
+        forget_idle_senders()
 
 
 def handle_packet(payload, sender):
@@ -188,7 +210,11 @@ def handle_packet(payload, sender):
 async def listen_for_udp(hostname, port):
     sock = await asyncudp.create_socket(local_addr=(hostname, port))
     print("Listening to UDP on", hostname + ":" + str(port))
+    sweep_task = asyncio.create_task(sweep_idle_senders())
 
-    while True:
-        data, addr = await sock.recvfrom()
-        handle_packet(data, addr[0] + ":" + str(addr[1]))
+    try:
+        while True:
+            data, addr = await sock.recvfrom()
+            handle_packet(data, addr[0] + ":" + str(addr[1]))
+    finally:
+        sweep_task.cancel()
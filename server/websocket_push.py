@@ -6,8 +6,29 @@ import ssl
 import websockets
 from websockets.asyncio.server import ServerConnection
 from websockets.asyncio.server import serve
+from websockets.protocol import State
+from collections import deque
 from shared import active_senders
 
+# What to do with data for a client that can't keep up:
+# 'drop_oldest' drops the oldest queued payload, 'latest_per_car' merges queued
+# payloads keeping the newest entry per car, and 'disconnect' drops the oldest
+# payload and disconnects the client once it has lagged for lag_timeout seconds.
+DROP_POLICIES = ('drop_oldest', 'latest_per_car', 'disconnect')
+client_policy = 'drop_oldest'
+client_queue_size = 10
+lag_timeout = 10.0
+
+# Frames dropped for slow clients, per client address and in total
+dropped_frames = {}
+dropped_frames_total = 0
+
+# Serialized frames per timestamp, shared by all clients. Only timestamps that
+# every sender is settled_after_ms past are cached, newer ones may still get backfilled.
+frame_cache = {}
+frame_cache_size = 100
+settled_after_ms = 40 * 100
+
 
 # Helper function to get the current time in milliseconds
 def current_milli_time():
@@ -19,16 +40,28 @@ def format_timestamp(time_num):
     return time_num
 
 
+def get_newest_timestamp():
+    newest_timestamps = [sender_buffer.newest_timestamp for sender_buffer in active_senders.values()
+                         if sender_buffer.newest_timestamp is not None]
+    return max(newest_timestamps, default=None)
+
+
+def get_settled_timestamp():
+    # Newest timestamp every sender is past, a car that lags behind the others
+    # may still backfill anything newer
+    newest_timestamps = [sender_buffer.newest_timestamp for sender_buffer in active_senders.values()
+                         if sender_buffer.newest_timestamp is not None]
+    return min(newest_timestamps, default=None)
+
+
 def get_start_timestamp():
-    optimal_timestamp = 0
     # Find newest available timestamp in active_senders
-    for sender_buffer in active_senders.values():
-        for entry in sender_buffer:
-            if entry['timestamp'] > optimal_timestamp:
-                optimal_timestamp = entry['timestamp']
+    newest_timestamp = get_newest_timestamp()
+    if newest_timestamp is None:
+        return None
 
     # Subtract 5 seconds to the millisecond timestamp found above
-    optimal_timestamp -= 5000
+    optimal_timestamp = newest_timestamp - 5000
 
     # print("Optimal timestamp to start at is", format_timestamp(optimal_timestamp), "ms")
 
@@ -36,15 +69,105 @@ def get_start_timestamp():
     # server_timestamp = current_milli_time()
     # print("Approximate latency is", format_timestamp(server_timestamp - optimal_timestamp), "ms")
 
-    # Find the closest timestamp to the optimal timestamp
-    current_timestamp = None
-    for sender_buffer in active_senders.values():
-        for entry in sender_buffer:
-            if (current_timestamp is None or
-                    abs(current_timestamp - entry['timestamp']) > abs(current_timestamp - optimal_timestamp)):
-                current_timestamp = entry['timestamp']
+    # Find the closest timestamp to the optimal timestamp that any sender has data for,
+    # looking at the neighbouring 100 ms slots in both directions
+    for distance in range(0, newest_timestamp - optimal_timestamp + 100, 100):
+        for timestamp in (optimal_timestamp + distance, optimal_timestamp - distance):
+            if any(sender_buffer.has(timestamp) for sender_buffer in active_senders.values()):
+                return timestamp
 
-    return current_timestamp
+    return None
+
+
+def get_frame(timestamp):
+    # Returns the entries for timestamp from all senders, serialized once per entry
+    # and once for the whole frame, as (entries by sender id, frame).
+    # Frames that every sender is past by the 4 seconds of position history in each
+    # packet can't change anymore, so they are cached and shared by every client
+    # replaying that timestamp.
+    cached = frame_cache.get(timestamp)
+    if cached is not None:
+        return cached
+
+    entries = {}
+    for sender_buffer in active_senders.values():
+        entry = sender_buffer.get(timestamp)
+        if entry is not None:
+            entries[entry['id']] = json.dumps(entry)
+    frame = (entries, '[' + ','.join(entries.values()) + ']')
+
+    settled_timestamp = get_settled_timestamp()
+    if settled_timestamp is not None and timestamp <= settled_timestamp - settled_after_ms:
+        frame_cache[timestamp] = frame
+        while len(frame_cache) > frame_cache_size:
+            del frame_cache[next(iter(frame_cache))]
+
+    return frame
+
+
+class ClientWriter:
+    # Bounded outbound queue for one client, sent from its own task so a slow
+    # client never holds up the replay loop
+
+    def __init__(self, websocket: ServerConnection):
+        self.websocket = websocket
+        self.queue = deque(maxlen=client_queue_size)
+        self.latest = {}  # Car id -> newest serialized entry, for 'latest_per_car'
+        self.ready = asyncio.Event()
+        self.lagging_since = None
+        self.closing = False
+        self.dropped = 0
+
+    def push(self, entries, frame):
+        # entries is the frame as serialized entries by sender id
+        if self.closing:
+            return
+
+        if client_policy == 'latest_per_car':
+            if self.latest:
+                self.dropped_frame()
+            self.latest.update(entries)
+        else:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped_frame()
+            self.queue.append(frame)
+        self.ready.set()
+
+    def dropped_frame(self):
+        global dropped_frames_total
+        self.dropped += 1
+        dropped_frames_total += 1
+        dropped_frames[self.websocket.remote_address] = self.dropped
+
+        now = time.monotonic()
+        if self.lagging_since is None:
+            self.lagging_since = now
+        elif client_policy == 'disconnect' and now - self.lagging_since > lag_timeout:
+            print("Disconnecting", self.websocket.remote_address, "lagging for more than", lag_timeout, "seconds")
+            self.closing = True
+            self.queue.clear()
+            asyncio.create_task(self.websocket.close(1008, "Client too slow"))
+
+    def next_frame(self):
+        if client_policy == 'latest_per_car':
+            if not self.latest:
+                return None
+            frame = '[' + ','.join(self.latest.values()) + ']'
+            self.latest = {}
+            return frame
+        if not self.queue:
+            return None
+        return self.queue.popleft()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            frame = self.next_frame()
+            while frame is not None:
+                await self.websocket.send(frame)
+                frame = self.next_frame()
+            self.lagging_since = None
 
 
 async def push_data_to_websocket(websocket: ServerConnection):
@@ -53,6 +176,9 @@ async def push_data_to_websocket(websocket: ServerConnection):
     current_timestamp = get_start_timestamp()
     print("Starting to send data to", websocket.remote_address, "from timestamp", format_timestamp(current_timestamp))
 
+    writer = ClientWriter(websocket)
+    writer_task = asyncio.create_task(writer.run())
+
     # Debug map
     # lat = 59.3293
     # current_timestamp = 1000
@@ -63,7 +189,6 @@ async def push_data_to_websocket(websocket: ServerConnection):
             current_timestamp = get_start_timestamp()
 
         # lat += 0.00001
-        payload_to_send = []
 
         # Debug map
         # active_senders['abc-123'].appendleft({
@@ -78,33 +203,41 @@ async def push_data_to_websocket(websocket: ServerConnection):
         # })
 
         # Get each entry from active_senders that match current_timestamp
-        for sender_buffer in active_senders.values():
-            for entry in sender_buffer:
-                if entry['timestamp'] == current_timestamp:
-                    payload_to_send.append(entry)
-
+        entries, frame = {}, None
         if current_timestamp is not None:
-            print("Looped, timestamp is", format_timestamp(current_timestamp))
+            entries, frame = get_frame(current_timestamp)
+            # print("Looped, timestamp is", format_timestamp(current_timestamp))
 
-        if len(payload_to_send) > 0:
+        if writer_task.done():
             try:
-                # print("Sending", payload_to_send)
-                await websocket.send(json.dumps(payload_to_send))
-                # print("Sent", len(payload_to_send), "entries to", websocket.remote_address)
+                writer_task.result()
             except websockets.ConnectionClosedOK:
                 print("Websocket connection closed (OK) to", websocket.remote_address)
-                break
             except websockets.ConnectionClosedError:
                 print("Websocket connection closed (error) )to", websocket.remote_address)
-                break
+            break
+        if websocket.state is State.CLOSED:
+            print("Websocket connection closed to", websocket.remote_address)
+            break
+
+        if len(entries) > 0:
+            # print("Sending", frame)
+            writer.push(entries, frame)
 
         # Wait for a short period before sending the next update
         await asyncio.sleep(0.1)
         if current_timestamp is not None:
             current_timestamp += 100
 
+    writer_task.cancel()
+    dropped_frames.pop(websocket.remote_address, None)
+    if writer.dropped > 0:
+        print("Dropped", writer.dropped, "frames for", websocket.remote_address)
+
 
-async def listen_for_websocket(hostname, port, dev=False):
+async def listen_for_websocket(hostname, port, dev=False, policy='drop_oldest', queue_size=10, lag=10.0):
+    global client_policy, client_queue_size, lag_timeout
+    client_policy, client_queue_size, lag_timeout = policy, queue_size, lag
     print("Listening to websocket", hostname + ":" + str(port))
 
     if dev is False:
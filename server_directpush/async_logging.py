@@ -0,0 +1,112 @@
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from typing import Dict, Hashable, List, Optional
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are, so the message is formatted by the
+    listener thread instead of the thread that logged it. The stock
+    QueueHandler formats first so records can be pickled, which a queue
+    between threads doesn't need. When the queue is full records are dropped
+    and counted, logging never blocks the event loop.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start_async_logging(queue_size: int = 10000) -> logging.handlers.QueueListener:
+    """
+    Moves the root logger's handlers to a background QueueListener thread, so
+    file and console writes no longer happen on the event loop.
+
+    Forked worker processes don't get the listener thread, they go back to
+    writing with the original handlers themselves.
+
+    Args:
+        queue_size: Max records waiting to be written before new ones are dropped
+
+    Returns:
+        The running listener, stop() it at shutdown to write what's queued
+    """
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    listener = logging.handlers.QueueListener(
+        queue.Queue(queue_size), *handlers, respect_handler_level=True
+    )
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(listener.queue))
+    listener.start()
+
+    def restore_handlers():
+        root.handlers = handlers
+
+    os.register_at_fork(after_in_child=restore_handlers)
+    return listener
+
+
+class RateLimitedLog:
+    """
+    Logs a message at most once per interval per key, such as a sender address.
+    Repeats in between are only counted, and the next line says how many there
+    were: "... (10 in the last 1.0 s)". A repeat is a dict lookup and an
+    addition, so this can be called for every packet. Messages use %-style
+    arguments, which are only formatted when a line is written.
+    """
+
+    def __init__(self, interval: float = 1.0, logger: Optional[logging.Logger] = None):
+        """
+        Args:
+            interval: Seconds between lines per key
+            logger: Logger to write to, the root logger if None
+        """
+        self.interval = interval
+        self.logger = logger or logging.getLogger()
+        # key -> [time of the last line, repeats since, latest (level, msg, args)]
+        self.entries: Dict[Hashable, List] = {}
+        self.next_prune = time.monotonic() + interval * 10
+
+    def log(self, key: Hashable, level: int, msg: str, *args):
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = [now, 0, None]
+            self.logger.log(level, msg, *args)
+        elif now - entry[0] < self.interval:
+            entry[1] += 1
+            entry[2] = (level, msg, args)
+        else:
+            self._write(level, msg, args, entry[1] + 1, now - entry[0])
+            entry[0] = now
+            entry[1] = 0
+        if now >= self.next_prune:
+            self._prune(now)
+
+    def _write(self, level: int, msg: str, args: tuple, count: int, elapsed: float):
+        self.logger.log(level, msg + " (%d in the last %.1f s)", *args, count, elapsed)
+
+    def _prune(self, now: float):
+        """Forgets keys that went quiet, writing their uncounted repeats."""
+        self.next_prune = now + self.interval * 10
+        for key, (last_line, repeats, latest) in list(self.entries.items()):
+            if now - last_line < self.interval:
+                continue
+            del self.entries[key]
+            if repeats:
+                level, msg, args = latest
+                self._write(level, msg, args, repeats, now - last_line)
@@ -0,0 +1,181 @@
+import logging
+import time
+from typing import Dict, List, Union
+import numpy as np
+from packet_parser import V0_PACKET, V0_POSITION_COUNT, PacketParser
+
+# --- Wire Layout (protocol v0) as a NumPy structured dtype ---
+# Mirrors V0_HEADER_FORMAT + V0_POSITION_FORMAT * 40 in packet_parser, packed
+# and little-endian, so a buffer of packets can be viewed as an array of records.
+V0_POSITION_DTYPE = np.dtype(
+    [
+        ("latitude", "<u4"),
+        ("longitude", "<u4"),
+        ("rpm", "<u2"),
+    ]
+)
+V0_DTYPE = np.dtype(
+    [
+        ("timestamp", "<i8"),
+        ("speed", "<u2"),
+        ("heading", "<u2"),
+        ("brake_temps", "<u2", (16,)),
+        ("heart_rate", "u1"),
+        ("coolant_temp", "u1"),
+        ("oil_temp", "u1"),
+        ("accelerator", "u1"),
+        ("clutch", "u1"),
+        ("brake", "u1"),
+        ("positions", V0_POSITION_DTYPE, (V0_POSITION_COUNT,)),
+    ]
+)
+# The same with the packet type byte in front, as the packets arrive over UDP
+V0_DATAGRAM_DTYPE = np.dtype([("type", "u1"), ("packet", V0_DTYPE)])
+
+if V0_DTYPE.itemsize != V0_PACKET.size:
+    raise RuntimeError(
+        f"V0_DTYPE is {V0_DTYPE.itemsize} bytes, but v0 packets are "
+        f"{V0_PACKET.size} bytes, it doesn't match packet_parser"
+    )
+
+
+def convert(records: np.ndarray, history: bool = False) -> Dict[str, np.ndarray]:
+    """
+    Applies the unit conversion of PacketParser.parse_data_packet to whole columns.
+
+    Args:
+        records: Array of V0_DTYPE records
+        history: Also convert the full 40 record position history, which is most
+            of the work
+
+    Returns:
+        Columns named like VehicleData, brake_temps as an N x 16 array. latitude,
+        longitude and rpm are the most recent position. With history, the full
+        history is in position_latitude, position_longitude and position_rpm as
+        N x 40 arrays, most recent first
+    """
+    current = records["positions"][:, 0]
+    columns = {
+        "timestamp": records["timestamp"].copy(),
+        "speed": records["speed"] / 100.0,
+        "heading": records["heading"] / 100.0,
+        "brake_temps": records["brake_temps"] * 0.1 - 100.0,
+        "heart_rate": records["heart_rate"].copy(),
+        "coolant_temp": records["coolant_temp"].copy(),
+        "oil_temp": records["oil_temp"].copy(),
+        "accelerator": records["accelerator"].copy(),
+        "clutch": records["clutch"].copy(),
+        "brake": records["brake"].copy(),
+        "latitude": current["latitude"] / 6000000.0,
+        "longitude": current["longitude"] / 6000000.0,
+        "rpm": current["rpm"].copy(),
+    }
+    if history:
+        positions = records["positions"]
+        columns["position_latitude"] = positions["latitude"] / 6000000.0
+        columns["position_longitude"] = positions["longitude"] / 6000000.0
+        columns["position_rpm"] = positions["rpm"].copy()
+    return columns
+
+
+def decode_buffer(
+    buffer: Union[bytes, bytearray, memoryview],
+    type_byte: bool = True,
+    history: bool = False,
+) -> Dict[str, np.ndarray]:
+    """
+    Decodes a buffer of concatenated full-size v0 packets in one pass.
+
+    Args:
+        buffer: The packets back to back, each V0_PACKET.size bytes (+1 with type byte)
+        type_byte: Whether every packet starts with the 0x00 packet type byte
+        history: Also return the full position history, see convert()
+
+    Returns:
+        Columns as returned by convert()
+    """
+    dtype = V0_DATAGRAM_DTYPE if type_byte else V0_DTYPE
+    if len(buffer) % dtype.itemsize:
+        raise ValueError(
+            f"Buffer of {len(buffer)} bytes is not a whole number of "
+            f"{dtype.itemsize} byte packets"
+        )
+    records = np.frombuffer(buffer, dtype)
+    if type_byte:
+        if np.any(records["type"] != 0x00):
+            raise ValueError("Buffer contains packets that are not v0 data packets")
+        records = records["packet"]
+    return convert(records, history)
+
+
+def decode_datagrams(
+    datagrams: List[bytes], history: bool = False
+) -> Dict[str, np.ndarray]:
+    """
+    Decodes a list of received datagrams, such as the records of a segment log.
+    Anything that isn't a full-size v0 data packet is skipped.
+
+    Returns:
+        Columns as returned by convert(), plus "index", the position in
+        datagrams each row was decoded from
+    """
+    size = V0_DATAGRAM_DTYPE.itemsize
+    index = [
+        i
+        for i, data in enumerate(datagrams)
+        if len(data) >= size and data[0] == 0x00
+    ]
+    skipped = len(datagrams) - len(index)
+    if skipped:
+        logging.debug(f"Skipping {skipped} datagrams that are not full v0 data packets")
+
+    buffer = b"".join(
+        datagrams[i] if len(datagrams[i]) == size else datagrams[i][:size]
+        for i in index
+    )
+    columns = decode_buffer(buffer, history=history)
+    columns["index"] = np.array(index, dtype=np.int64)
+    return columns
+
+
+def main():
+    import argparse
+    import random
+
+    parser = argparse.ArgumentParser(
+        description="Compare bulk decoding with PacketParser.parse_data_packet"
+    )
+    parser.add_argument("--packets", type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    packets = []
+    for i in range(args.packets):
+        fields = [1700000000000000 + i * 100000]
+        fields += [rng.randrange(30000), rng.randrange(36000)]
+        fields += [rng.randrange(4000) for _ in range(16)]
+        fields += [rng.randrange(256) for _ in range(6)]
+        for _ in range(V0_POSITION_COUNT):
+            fields += [rng.randrange(2**32), rng.randrange(2**32), rng.randrange(10000)]
+        packets.append(b"\x00" + V0_PACKET.pack(*fields))
+
+    started = time.perf_counter()
+    for packet in packets:
+        PacketParser.parse_data_packet(memoryview(packet)[1:], False)
+    loop_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    columns = decode_buffer(b"".join(packets))
+    bulk_time = time.perf_counter() - started
+
+    _, first = PacketParser.parse_data_packet(memoryview(packets[0])[1:], False)
+    for name, value in first.items():
+        assert np.allclose(columns[name][0], value), name
+
+    print(f"{args.packets} packets")
+    print(f"parse_data_packet loop: {loop_time:.3f} s")
+    print(f"decode_buffer:          {bulk_time:.3f} s ({loop_time / bulk_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
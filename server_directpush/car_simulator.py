@@ -358,6 +358,11 @@ class CarSimulator:
             print("Cannot send telemetry: not authenticated")
             return
 
+        packet = self.build_telemetry_packet()
+        self.socket.sendto(packet, (self.server_ip, self.server_port))
+
+    def build_telemetry_packet(self) -> bytes:
+        """Build a data packet from the current car state."""
         # Packet format: 0x00 (data packet type) + payload
         # Payload format as per protocol in README.md:
         # - 8 bytes: timestamp (big-endian long) in microseconds
@@ -392,9 +397,9 @@ class CarSimulator:
                 self.heart_rate,
                 self.coolant_temp,
                 self.oil_temp,
-                self.accelerator,
+                int(self.accelerator),
                 self.clutch,
-                self.brake,
+                int(self.brake),
             ]
         )
 
@@ -404,9 +409,8 @@ class CarSimulator:
             lon_int = int(lon * 6000000)
             payload += struct.pack("<IIH", lat_int, lon_int, rpm)
 
-        # Create and send the complete packet
-        packet = bytes([0x00]) + payload
-        self.socket.sendto(packet, (self.server_ip, self.server_port))
+        # Create the complete packet
+        return bytes([0x00]) + payload
 
     def run_simulation(self, duration_seconds: int = 60, interval_ms: int = 100):
         """
@@ -0,0 +1,131 @@
+import contextlib
+import io
+import json
+import time
+import zlib
+from typing import Dict, List, Optional
+from car_simulator import CarSimulator
+from delta_encoder import DeltaEncoder
+from packet_parser import PacketParser
+
+# (description, window bits, memLevel, level, no context takeover), None for no compression
+SETTINGS = [
+    ("off", None),
+    ("default", (12, 5, 6, False)),
+    ("fast", (12, 5, 1, False)),
+    ("large window", (15, 8, 6, False)),
+    ("small window", (10, 4, 6, False)),
+    ("no context takeover", (12, 5, 6, True)),
+]
+
+
+def generate_frames(cars: int, ticks: int) -> Dict[str, List]:
+    """
+    Runs the car simulator and builds the frames the server would broadcast.
+
+    Args:
+        cars: Number of simulated cars
+        ticks: Number of broadcast ticks (one packet per car per tick)
+
+    Returns:
+        The JSON and delta encoded frames, one per tick
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulators = [CarSimulator(uuid_seed=f"car{i}") for i in range(cars)]
+
+    encoder = DeltaEncoder()
+    frames: Dict[str, List] = {"json": [], "delta": []}
+    start = int(time.time()) * 1000000
+    for tick in range(ticks):
+        updates = {}
+        for simulator in simulators:
+            simulator.update_car_state()
+            simulator.timestamp = start + tick * 100000
+            packet = simulator.build_telemetry_packet()
+            uuid = simulator.car_uuid.hex()
+            _, vehicle = PacketParser.parse_data_packet(memoryview(packet)[1:], False)
+            updates[uuid] = {"uuid": uuid, "vehicle": vehicle}
+        frames["json"].append(
+            ("[" + ",".join(json.dumps(u) for u in updates.values()) + "]").encode()
+        )
+        frames["delta"].append(
+            encoder.encode({uuid: u["vehicle"] for uuid, u in updates.items()})
+        )
+    return frames
+
+
+def compress_frames(frames: List[bytes], setting: Optional[tuple]):
+    """
+    Compresses frames the way permessage-deflate does for a single connection.
+
+    Returns:
+        Tuple of (total compressed bytes, CPU seconds)
+    """
+    if setting is None:
+        return sum(len(frame) for frame in frames), 0.0
+
+    window_bits, mem_level, level, no_context_takeover = setting
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits, mem_level)
+    total = 0
+    started = time.process_time()
+    for frame in frames:
+        if no_context_takeover:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits, mem_level)
+        data = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        # The 4 byte sync flush trailer is not sent
+        total += len(data) - 4
+    return total, time.process_time() - started
+
+
+def deflate_memory(setting: Optional[tuple]) -> int:
+    """zlib's documented deflate memory use for a compressor with these settings."""
+    if setting is None:
+        return 0
+    window_bits, mem_level, _, no_context_takeover = setting
+    if no_context_takeover:
+        # Only allocated while a frame is being compressed
+        return 0
+    return (1 << (window_bits + 2)) + (1 << (mem_level + 9))
+
+
+def run_benchmark(cars: int, viewers: int, ticks: int, interval_ms: int):
+    frames = generate_frames(cars, ticks)
+    ticks_per_second = 1000 / interval_ms
+
+    print(
+        f"{cars} cars, {viewers} viewers, {ticks} ticks of {interval_ms} ms. "
+        f"CPU is for all viewers, bandwidth is per viewer."
+    )
+    print(
+        f"{'format':<7}{'compression':<22}{'bytes/frame':>12}{'ratio':>8}"
+        f"{'us/frame':>10}{'CPU %':>8}{'kbit/s':>9}{'mem/conn':>10}"
+    )
+    for format_name, format_frames in frames.items():
+        raw = sum(len(frame) for frame in format_frames)
+        for description, setting in SETTINGS:
+            compressed, cpu_seconds = compress_frames(format_frames, setting)
+            us_per_frame = cpu_seconds / ticks * 1000000
+            cpu_percent = us_per_frame * viewers * ticks_per_second / 10000
+            kbit_per_second = compressed / ticks * ticks_per_second * 8 / 1000
+            print(
+                f"{format_name:<7}{description:<22}{compressed / ticks:>12.0f}"
+                f"{raw / compressed:>8.2f}{us_per_frame:>10.1f}{cpu_percent:>8.1f}"
+                f"{kbit_per_second:>9.1f}{deflate_memory(setting) // 1024:>8d}kB"
+            )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Measure permessage-deflate CPU cost against bandwidth for broadcast frames"
+    )
+    parser.add_argument("--cars", type=int, default=30, help="Number of cars")
+    parser.add_argument("--viewers", type=int, default=200, help="Number of viewers")
+    parser.add_argument("--ticks", type=int, default=600, help="Broadcast ticks to run")
+    parser.add_argument(
+        "--interval", type=int, default=100, help="Broadcast interval in milliseconds"
+    )
+    args = parser.parse_args()
+
+    run_benchmark(args.cars, args.viewers, args.ticks, args.interval)
@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+from packet_parser import VehicleData
+from metrics import Histogram
+from history import (
+    RESOLUTIONS,
+    BUCKET_COLUMNS,
+    CREATE_BUCKET_TABLE,
+    BucketAggregator,
+    bucket_table,
+)
+
+# Columns written by COPY, in record order
+COLUMNS = (
+    "uuid",
+    "timestamp",
+    "speed",
+    "heading",
+    "brake_temps",
+    "heart_rate",
+    "coolant_temp",
+    "oil_temp",
+    "accelerator",
+    "clutch",
+    "brake",
+    "latitude",
+    "longitude",
+    "rpm",
+)
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS {table} (
+    uuid TEXT NOT NULL,
+    timestamp BIGINT NOT NULL,
+    speed REAL,
+    heading REAL,
+    brake_temps REAL[],
+    heart_rate SMALLINT,
+    coolant_temp SMALLINT,
+    oil_temp SMALLINT,
+    accelerator SMALLINT,
+    clutch SMALLINT,
+    brake SMALLINT,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    rpm INTEGER,
+    received_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS {table}_uuid_timestamp_idx ON {table} (uuid, timestamp);
+"""
+
+# Put on the queue by stop(), the writer task flushes its batch and returns
+STOP = None
+
+
+class TelemetryWriter:
+    """
+    Buffers parsed telemetry rows and writes them to PostgreSQL in bulk.
+    Every sample is also aggregated into 1 s, 10 s and 1 min buckets per car,
+    which go to their own tables for the history API.
+    Rows go into a bounded queue, which a background task drains into batches
+    that are flushed with COPY when they reach batch_size rows or after
+    flush_interval seconds. If the database can't keep up the queue fills
+    and new rows are dropped and counted, UDP ingest is never blocked.
+    """
+
+    def __init__(
+        self,
+        dsn: Optional[str] = None,
+        table: str = "telemetry",
+        batch_size: int = 1000,
+        flush_interval: float = 1.0,
+        queue_size: int = 100000,
+        pool_size: int = 4,
+        pool=None,
+    ):
+        """
+        Args:
+            dsn: PostgreSQL connection string, used when no pool is given
+            table: Table to write to, created if it doesn't exist
+            batch_size: Flush when this many rows are buffered
+            flush_interval: Flush buffered rows at least this often (seconds)
+            queue_size: Max rows waiting to be written before new rows are dropped
+            pool_size: Max connections, and so max concurrent flushes
+            pool: An asyncpg pool, or a stand-in with the same acquire() and
+                copy_records_to_table() interface
+        """
+        self.dsn = dsn
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pool_size = pool_size
+        self.pool = pool
+        self.owns_pool = pool is None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.flush_slots = asyncio.Semaphore(pool_size)
+        self.flush_tasks = set()
+        self.task = None
+
+        # Pre-aggregated bucket tables, with the columns of every table
+        self.aggregators = {
+            bucket_table(table, resolution): BucketAggregator(bucket_us)
+            for resolution, bucket_us in RESOLUTIONS.items()
+        }
+        self.columns = {table: COLUMNS}
+        for name in self.aggregators:
+            self.columns[name] = BUCKET_COLUMNS
+
+        # Stats
+        self.started_at = time.monotonic()
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.rows_failed = 0
+        self.flushes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.flush_seconds = Histogram(
+            "db_flush_seconds", "Time to write a batch of rows with COPY"
+        )
+
+    async def start(self):
+        """Connects, creates the table if needed and starts the writer task."""
+        if self.pool is None:
+            # Only needed with a database, the server runs without asyncpg otherwise
+            import asyncpg
+
+            logging.info(f"Connecting to database for table {self.table}")
+            self.pool = await asyncpg.create_pool(
+                self.dsn, min_size=1, max_size=self.pool_size
+            )
+            async with self.pool.acquire() as connection:
+                await connection.execute(CREATE_TABLE.format(table=self.table))
+                for name in self.aggregators:
+                    await connection.execute(CREATE_BUCKET_TABLE.format(table=name))
+        self.started_at = time.monotonic()
+        self.task = asyncio.create_task(self._run())
+        logging.info("Database writer running.")
+
+    async def stop(self):
+        """Writes everything still buffered and closes the pool."""
+        if self.task:
+            # Behind the rows already queued, so the batch being collected is
+            # flushed too. Waits for room if the queue is full.
+            await self.queue.put(STOP)
+            await self.task
+            self.task = None
+
+        # The open buckets are written as they are
+        for name, aggregator in self.aggregators.items():
+            for row in aggregator.flush():
+                self._enqueue(name, row)
+
+        remaining = []
+        while not self.queue.empty():
+            remaining.append(self.queue.get_nowait())
+        for start in range(0, len(remaining), self.batch_size):
+            await self._flush(remaining[start : start + self.batch_size])
+        if self.flush_tasks:
+            await asyncio.gather(*self.flush_tasks, return_exceptions=True)
+
+        if self.owns_pool and self.pool:
+            await self.pool.close()
+            self.pool = None
+        logging.info(f"Database writer stopped: {self.stats()}")
+
+    def write(self, uuid: str, vehicle: VehicleData):
+        """Queues a row for writing, dropping it if the queue is full. Never blocks."""
+        row = (
+            uuid,
+            vehicle["timestamp"],
+            vehicle["speed"],
+            vehicle["heading"],
+            vehicle["brake_temps"],
+            vehicle["heart_rate"],
+            vehicle["coolant_temp"],
+            vehicle["oil_temp"],
+            vehicle["accelerator"],
+            vehicle["clutch"],
+            vehicle["brake"],
+            vehicle["latitude"],
+            vehicle["longitude"],
+            vehicle["rpm"],
+        )
+        self._enqueue(self.table, row)
+        for name, aggregator in self.aggregators.items():
+            bucket = aggregator.add(uuid, vehicle)
+            if bucket is not None:
+                self._enqueue(name, bucket)
+
+    def _enqueue(self, table: str, row: Tuple):
+        try:
+            self.queue.put_nowait((table, row))
+        except asyncio.QueueFull:
+            self.rows_dropped += 1
+            if self.rows_dropped % 1000 == 1:
+                logging.warning(
+                    f"Database queue full, {self.rows_dropped} rows dropped so far"
+                )
+
+    async def _run(self):
+        """Collects rows into batches and flushes them, up to pool_size at a time."""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            row = await self.queue.get()
+            if row is STOP:
+                return
+            batch: List[Tuple] = [row]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        row = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    row = self.queue.get_nowait()
+                if row is STOP:
+                    stopping = True
+                    break
+                batch.append(row)
+
+            # Waits here while all connections are busy, rows keep queueing meanwhile
+            await self.flush_slots.acquire()
+            task = asyncio.create_task(self._flush(batch, release=True))
+            self.flush_tasks.add(task)
+            task.add_done_callback(self.flush_tasks.discard)
+
+    async def _flush(self, rows: List[Tuple], release: bool = False):
+        """Writes rows with one COPY per table and records the flush latency."""
+        tables: Dict[str, List[Tuple]] = {}
+        for table, row in rows:
+            tables.setdefault(table, []).append(row)
+
+        started = time.monotonic()
+        try:
+            async with self.pool.acquire() as connection:
+                for table, records in tables.items():
+                    await connection.copy_records_to_table(
+                        table, records=records, columns=self.columns[table]
+                    )
+            self.rows_written += len(rows)
+            self.flushes += 1
+        except Exception as e:
+            self.rows_failed += len(rows)
+            logging.error(f"Failed to write {len(rows)} rows to {', '.join(tables)}: {e}")
+        finally:
+            if release:
+                self.flush_slots.release()
+
+        self.last_flush_latency = time.monotonic() - started
+        self.flush_seconds.observe(self.last_flush_latency)
+        if self.last_flush_latency > self.max_flush_latency:
+            self.max_flush_latency = self.last_flush_latency
+
+    def stats(self) -> Dict[str, float]:
+        """Returns write throughput, flush latency and queue counters."""
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            "rows_written": self.rows_written,
+            "rows_per_second": self.rows_written / elapsed,
+            "rows_dropped": self.rows_dropped,
+            "rows_failed": self.rows_failed,
+            "queue_depth": self.queue.qsize(),
+            "flushes": self.flushes,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
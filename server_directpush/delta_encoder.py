@@ -0,0 +1,185 @@
+import struct
+from typing import Dict, List, Optional, Tuple
+from packet_parser import VehicleData
+
+# WebSocket subprotocol a viewer offers to get the delta encoded binary format.
+# Viewers that don't offer it get the JSON format.
+DELTA_SUBPROTOCOL = "pitstop.delta.v1"
+
+# --- Frame Layout ---
+# All little-endian:
+#   uint8  frame type (FRAME_KEYFRAME or FRAME_DELTA)
+#   uint16 number of car records
+#   per car record:
+#     uint16 car index
+#     uint32 field mask, bit n set when field n follows, UUID_FLAG when the uuid follows
+#     16 bytes car uuid (only with UUID_FLAG)
+#     the fields in the mask, in field order, packed with their struct code
+FRAME_KEYFRAME = 0x01
+FRAME_DELTA = 0x02
+UUID_FLAG = 1 << 31
+
+FRAME_HEADER = struct.Struct("<BH")
+RECORD_HEADER = struct.Struct("<HI")
+
+# (name, struct code, scale, offset): value = raw / scale + offset, which are
+# the same units the values have on the UDP wire
+FIELDS: List[Tuple[str, str, int, float]] = (
+    [
+        ("timestamp", "q", 1, 0),
+        ("speed", "H", 100, 0),
+        ("heading", "H", 100, 0),
+    ]
+    + [(f"brake_temps.{i}", "H", 10, -100) for i in range(16)]
+    + [
+        ("heart_rate", "B", 1, 0),
+        ("coolant_temp", "B", 1, 0),
+        ("oil_temp", "B", 1, 0),
+        ("accelerator", "B", 1, 0),
+        ("clutch", "B", 1, 0),
+        ("brake", "B", 1, 0),
+        ("latitude", "I", 6000000, 0),
+        ("longitude", "I", 6000000, 0),
+        ("rpm", "H", 1, 0),
+    ]
+)
+ALL_FIELDS_MASK = (1 << len(FIELDS)) - 1
+
+SCHEMA = {
+    "type": "schema",
+    "subprotocol": DELTA_SUBPROTOCOL,
+    "fields": [
+        {"name": name, "type": code, "scale": scale, "offset": offset}
+        for name, code, scale, offset in FIELDS
+    ],
+}
+
+
+def quantize(vehicle: VehicleData) -> Tuple[int, ...]:
+    """Converts vehicle data back to the integer units used on the UDP wire."""
+    return (
+        vehicle["timestamp"],
+        round(vehicle["speed"] * 100),
+        round(vehicle["heading"] * 100),
+        *[round((t + 100.0) * 10) for t in vehicle["brake_temps"]],
+        vehicle["heart_rate"],
+        vehicle["coolant_temp"],
+        vehicle["oil_temp"],
+        vehicle["accelerator"],
+        vehicle["clutch"],
+        vehicle["brake"],
+        round(vehicle["latitude"] * 6000000),
+        round(vehicle["longitude"] * 6000000),
+        vehicle["rpm"],
+    )
+
+
+class DeltaEncoder:
+    """
+    Encodes car updates as binary frames holding only the fields that changed.
+    Deltas are computed once per broadcast tick against the previous tick and
+    shared by all delta viewers. A viewer that misses a delta frame gets the
+    keyframe instead, which holds the full state of every car.
+    """
+
+    def __init__(self):
+        self.car_index: Dict[str, int] = {}
+        self.values: Dict[str, Tuple[int, ...]] = {}
+        self.record_structs: Dict[int, struct.Struct] = {}
+        self._keyframe: Optional[bytes] = None
+
+    def _record_struct(self, mask: int) -> struct.Struct:
+        """Returns the precompiled layout for the fields in mask."""
+        record_struct = self.record_structs.get(mask)
+        if record_struct is None:
+            codes = "".join(
+                code for n, (_, code, _, _) in enumerate(FIELDS) if mask & (1 << n)
+            )
+            record_struct = struct.Struct("<" + codes)
+            self.record_structs[mask] = record_struct
+        return record_struct
+
+    def _record(self, uuid: str, values: Tuple[int, ...], mask: int) -> bytes:
+        """Encodes one car record with the fields in mask."""
+        header = RECORD_HEADER.pack(self.car_index[uuid], mask)
+        if mask & UUID_FLAG:
+            header += bytes.fromhex(uuid)
+        fields_mask = mask & ALL_FIELDS_MASK
+        if fields_mask == ALL_FIELDS_MASK:
+            present = values
+        else:
+            present = [v for n, v in enumerate(values) if fields_mask & (1 << n)]
+        return header + self._record_struct(fields_mask).pack(*present)
+
+    def encode(self, updates: Dict[str, VehicleData]) -> bytes:
+        """
+        Encodes the updates of one broadcast tick as a delta frame.
+
+        Args:
+            updates: The newest vehicle data per car uuid
+
+        Returns:
+            The delta frame, with a record for every car that changed
+        """
+        records = []
+        for uuid, vehicle in updates.items():
+            values = quantize(vehicle)
+            previous = self.values.get(uuid)
+            if previous is None:
+                if uuid not in self.car_index:
+                    self.car_index[uuid] = len(self.car_index)
+                mask = ALL_FIELDS_MASK | UUID_FLAG
+            else:
+                mask = 0
+                for n, (value, old) in enumerate(zip(values, previous)):
+                    if value != old:
+                        mask |= 1 << n
+                if not mask:
+                    continue
+            self.values[uuid] = values
+            records.append(self._record(uuid, values, mask))
+
+        self._keyframe = None
+        return FRAME_HEADER.pack(FRAME_DELTA, len(records)) + b"".join(records)
+
+    def keyframe(self) -> bytes:
+        """Returns a frame with the full current state of every car, cached until the next tick."""
+        if self._keyframe is None:
+            records = [
+                self._record(uuid, values, ALL_FIELDS_MASK | UUID_FLAG)
+                for uuid, values in self.values.items()
+            ]
+            self._keyframe = FRAME_HEADER.pack(FRAME_KEYFRAME, len(records)) + b"".join(
+                records
+            )
+        return self._keyframe
+
+
+def decode_frame(
+    frame: bytes, cars: Dict[int, str]
+) -> Tuple[int, Dict[str, Dict[int, int]]]:
+    """
+    Decodes a binary frame into raw field values, the reference for viewers.
+
+    Args:
+        frame: The binary frame
+        cars: Car index to uuid table, updated from records carrying a uuid
+
+    Returns:
+        Tuple of (frame type, {uuid: {field number: raw value}})
+    """
+    frame_type, count = FRAME_HEADER.unpack_from(frame)
+    offset = FRAME_HEADER.size
+    decoded: Dict[str, Dict[int, int]] = {}
+    for _ in range(count):
+        index, mask = RECORD_HEADER.unpack_from(frame, offset)
+        offset += RECORD_HEADER.size
+        if mask & UUID_FLAG:
+            cars[index] = frame[offset : offset + 16].hex()
+            offset += 16
+        fields = [n for n in range(len(FIELDS)) if mask & (1 << n)]
+        codes = "<" + "".join(FIELDS[n][1] for n in fields)
+        values = struct.unpack_from(codes, frame, offset)
+        offset += struct.calcsize(codes)
+        decoded[cars[index]] = dict(zip(fields, values))
+    return frame_type, decoded
@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import struct
+import tempfile
+from typing import Dict, List, Optional, Set
+from delta_encoder import DeltaEncoder
+from packet_parser import PacketData
+from websocket_handler import WebSocketServer
+
+# --- Bus Message Layout ---
+# One message per broadcast tick, on a Unix stream socket:
+#   uint32 length of the body
+#   uint8  flags (MESSAGE_RESYNC)
+#   body: pickled (frame, updates, delta frame, keyframe, pending, recovered, events)
+MESSAGE_HEADER = struct.Struct("<IB")
+# The subscriber missed messages, delta viewers get the keyframe instead of the delta
+MESSAGE_RESYNC = 0x01
+
+
+class FrameBus:
+    """
+    Publishes the frames serialized by the broadcast tick to the fan-out
+    workers over a Unix socket. Frames are serialized once and the same bytes
+    go to every worker. A worker that doesn't keep up misses ticks instead of
+    growing the buffer, and resyncs its delta viewers with the next keyframe.
+    """
+
+    def __init__(self, path: str, max_buffer: int = 4 * 1024 * 1024):
+        """
+        Args:
+            path: Unix socket path the workers connect to
+            max_buffer: Max bytes queued for one worker before ticks are dropped
+        """
+        self.path = path
+        self.max_buffer = max_buffer
+        self.server = None
+        self.subscribers: Dict[asyncio.StreamWriter, bool] = {}  # writer -> resync
+        self.subscriber_tasks: Set[asyncio.Task] = set()
+        self.published = 0
+        self.dropped = 0
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._subscribe, self.path)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            for writer in list(self.subscribers):
+                writer.close()
+            # Let the subscriber handlers see the connections close
+            if self.subscriber_tasks:
+                await asyncio.wait(self.subscriber_tasks, timeout=1.0)
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _subscribe(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        self.subscribers[writer] = True
+        task = asyncio.current_task()
+        self.subscriber_tasks.add(task)
+        logging.info(f"Fan-out worker subscribed, {len(self.subscribers)} in total")
+        try:
+            # Workers never send anything, this returns when one disconnects
+            await reader.read()
+        finally:
+            del self.subscribers[writer]
+            self.subscriber_tasks.discard(task)
+            writer.close()
+            logging.info(f"Fan-out worker unsubscribed, {len(self.subscribers)} left")
+
+    def publish(
+        self,
+        frame: Optional[str],
+        updates: Optional[Dict[str, str]],
+        delta_frame: Optional[bytes],
+        keyframe: bytes,
+        pending: Dict[str, PacketData],
+        recovered: List[PacketData],
+        events: List[str],
+    ):
+        """Sends one tick's frames and timing events to every worker. The
+        updates themselves go along for the viewers with a subscription."""
+        if not self.subscribers:
+            return
+        body = pickle.dumps(
+            (frame, updates, delta_frame, keyframe, pending, recovered, events),
+            pickle.HIGHEST_PROTOCOL,
+        )
+        for writer, resync in self.subscribers.items():
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                self.subscribers[writer] = True
+                self.dropped += 1
+                continue
+            flags = MESSAGE_RESYNC if resync else 0
+            writer.write(MESSAGE_HEADER.pack(len(body), flags))
+            writer.write(body)
+            self.subscribers[writer] = False
+        self.published += 1
+
+
+class KeyframeCache:
+    """Stands in for the DeltaEncoder in a fan-out worker, with the newest
+    keyframe from the bus for new and lagging delta viewers."""
+
+    def __init__(self):
+        self.frame = DeltaEncoder().keyframe()
+
+    def keyframe(self) -> bytes:
+        return self.frame
+
+
+async def _worker_main(index, bus_path, host, port, devmode, server_options):
+    loop = asyncio.get_running_loop()
+    ws_server = WebSocketServer(host=host, port=port, **server_options)
+    keyframes = KeyframeCache()
+    ws_server.delta_encoder = keyframes
+    if not await ws_server.start(devmode, reuse_port=True):
+        logging.error(f"Fan-out worker {index} failed to start its WebSocket server")
+        return
+
+    reader, writer = await asyncio.open_unix_connection(bus_path)
+    receiver = asyncio.current_task()
+    loop.add_signal_handler(signal.SIGTERM, receiver.cancel)
+    logging.info(f"Fan-out worker {index} (pid {os.getpid()}) running")
+    try:
+        while True:
+            length, flags = MESSAGE_HEADER.unpack(
+                await reader.readexactly(MESSAGE_HEADER.size)
+            )
+            message = pickle.loads(await reader.readexactly(length))
+            frame, updates, delta_frame, keyframe, pending, recovered, events = message
+            keyframes.frame = keyframe
+            if flags & MESSAGE_RESYNC:
+                delta_frame = keyframe
+            ws_server.deliver(frame, updates, delta_frame, pending, recovered, events)
+    except asyncio.IncompleteReadError:
+        logging.error(f"Fan-out worker {index} lost the frame bus")
+    except asyncio.CancelledError:
+        pass
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        writer.close()
+        logging.info(f"Fan-out worker {index} stopping: {ws_server.client_stats()}")
+        await ws_server.stop()
+
+
+def _run_worker(index, bus_path, host, port, devmode, server_options):
+    # Ctrl+C reaches the whole process group, the main process stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker_main(index, bus_path, host, port, devmode, server_options))
+
+
+class FanoutWorkerPool:
+    """
+    Serves WebSocket viewers from worker processes that all listen on the
+    WebSocket port with SO_REUSEPORT, so TLS and sends are spread over cores.
+    The broadcast tick stays in the main process, which serializes every
+    frame once and publishes it to the workers on a FrameBus. Each worker
+    hands the frames to the writers of the viewers it owns.
+    """
+
+    def __init__(self, workers: int, host, port, devmode, **server_options):
+        """
+        Args:
+            workers: Number of worker processes
+            host: Host the workers listen on
+            port: WebSocket port the workers share
+            devmode: Whether to serve without TLS
+            server_options: Passed on to each worker's WebSocketServer
+        """
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.devmode = devmode
+        self.server_options = server_options
+        self.processes: List[multiprocessing.Process] = []
+        self.bus_dir = tempfile.mkdtemp(prefix="pitstop-fanout-")
+        self.bus = FrameBus(os.path.join(self.bus_dir, "bus.sock"))
+        self.monitor_task = None
+        self.dead_workers: Set[str] = set()
+
+    async def start(self):
+        """Opens the frame bus and starts the worker processes."""
+        await self.bus.start()
+        logging.info(
+            f"Starting {self.workers} WebSocket fan-out workers on port {self.port}"
+        )
+        # Forked, so the workers share this process's logging setup
+        context = multiprocessing.get_context("fork")
+        for index in range(self.workers):
+            process = context.Process(
+                target=_run_worker,
+                args=(
+                    index,
+                    self.bus.path,
+                    self.host,
+                    self.port,
+                    self.devmode,
+                    self.server_options,
+                ),
+                name=f"fanout-{index}",
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        self.monitor_task = asyncio.create_task(self._monitor())
+
+    async def _monitor(self):
+        """Logs workers that die, their viewers reconnect to the remaining ones."""
+        while True:
+            await asyncio.sleep(1.0)
+            for process in self.processes:
+                if process.exitcode is not None and process.name not in self.dead_workers:
+                    self.dead_workers.add(process.name)
+                    logging.error(
+                        f"Fan-out worker {process.name} exited with {process.exitcode}"
+                    )
+
+    async def stop(self):
+        """Stops the workers and closes the frame bus."""
+        if self.monitor_task:
+            self.monitor_task.cancel()
+            self.monitor_task = None
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(timeout=5)
+        self.processes = []
+        await self.bus.stop()
+        try:
+            os.unlink(self.bus.path)
+            os.rmdir(self.bus_dir)
+        except OSError:
+            pass
+        logging.info(
+            f"Fan-out workers stopped, {self.bus.published} ticks published, "
+            f"{self.bus.dropped} dropped"
+        )
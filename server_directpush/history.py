@@ -0,0 +1,242 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+from packet_parser import VehicleData
+
+# Bucket sizes for the pre-aggregated history tables, in microseconds
+RESOLUTIONS: Dict[str, int] = {
+    "1s": 1000000,
+    "10s": 10000000,
+    "1m": 60000000,
+}
+
+# Fields aggregated as min/max/avg per bucket
+AGGREGATED_FIELDS = (
+    "speed",
+    "rpm",
+    "accelerator",
+    "brake",
+    "clutch",
+    "coolant_temp",
+    "oil_temp",
+    "heart_rate",
+    "brake_temp_max",
+)
+
+BUCKET_COLUMNS = (
+    ("uuid", "bucket_start", "samples")
+    + tuple(
+        f"{field}_{stat}" for field in AGGREGATED_FIELDS for stat in ("min", "max", "avg")
+    )
+    + ("latitude", "longitude")
+)
+
+CREATE_BUCKET_TABLE = (
+    """
+CREATE TABLE IF NOT EXISTS {table} (
+    uuid TEXT NOT NULL,
+    bucket_start BIGINT NOT NULL,
+    samples INTEGER NOT NULL,
+"""
+    + "".join(
+        f"    {field}_{stat} REAL,\n"
+        for field in AGGREGATED_FIELDS
+        for stat in ("min", "max", "avg")
+    )
+    + """    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION
+);
+CREATE INDEX IF NOT EXISTS {table}_uuid_bucket_idx ON {table} (uuid, bucket_start);
+"""
+)
+
+RAW_COLUMNS = (
+    "timestamp",
+    "speed",
+    "heading",
+    "heart_rate",
+    "coolant_temp",
+    "oil_temp",
+    "accelerator",
+    "clutch",
+    "brake",
+    "latitude",
+    "longitude",
+    "rpm",
+)
+
+
+def bucket_table(table: str, resolution: str) -> str:
+    """Returns the name of the bucket table for a resolution."""
+    return f"{table}_{resolution}"
+
+
+def _sample(vehicle: VehicleData) -> Tuple[float, ...]:
+    """Returns the values of AGGREGATED_FIELDS for one sample."""
+    return (
+        vehicle["speed"],
+        vehicle["rpm"],
+        vehicle["accelerator"],
+        vehicle["brake"],
+        vehicle["clutch"],
+        vehicle["coolant_temp"],
+        vehicle["oil_temp"],
+        vehicle["heart_rate"],
+        max(vehicle["brake_temps"]),
+    )
+
+
+class Bucket:
+    """Running min/max/sum of the aggregated fields for one car and one bucket."""
+
+    __slots__ = ("start", "samples", "minimum", "maximum", "total", "latitude", "longitude")
+
+    def __init__(self, start: int, values: Tuple[float, ...], latitude: float, longitude: float):
+        self.start = start
+        self.samples = 1
+        self.minimum = list(values)
+        self.maximum = list(values)
+        self.total = list(values)
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def add(self, values: Tuple[float, ...], latitude: float, longitude: float):
+        self.samples += 1
+        minimum, maximum, total = self.minimum, self.maximum, self.total
+        for i, value in enumerate(values):
+            if value < minimum[i]:
+                minimum[i] = value
+            elif value > maximum[i]:
+                maximum[i] = value
+            total[i] += value
+        # Position is the last one in the bucket
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def row(self, uuid: str) -> Tuple:
+        """Returns the bucket as a row in BUCKET_COLUMNS order."""
+        stats = []
+        for i in range(len(self.total)):
+            stats += (self.minimum[i], self.maximum[i], self.total[i] / self.samples)
+        return (uuid, self.start, self.samples, *stats, self.latitude, self.longitude)
+
+
+class BucketAggregator:
+    """
+    Aggregates samples into fixed-size time buckets per car.
+    A bucket is emitted as a row once a sample for a later bucket arrives,
+    so the work per sample is constant.
+    """
+
+    def __init__(self, bucket_us: int):
+        self.bucket_us = bucket_us
+        self.buckets: Dict[str, Bucket] = {}
+
+    def add(self, uuid: str, vehicle: VehicleData) -> Optional[Tuple]:
+        """
+        Adds a sample.
+
+        Returns:
+            The row of the bucket that was finished by this sample, if any
+        """
+        start = vehicle["timestamp"] - vehicle["timestamp"] % self.bucket_us
+        values = _sample(vehicle)
+        bucket = self.buckets.get(uuid)
+        if bucket is not None and bucket.start == start:
+            bucket.add(values, vehicle["latitude"], vehicle["longitude"])
+            return None
+
+        self.buckets[uuid] = Bucket(start, values, vehicle["latitude"], vehicle["longitude"])
+        if bucket is None:
+            return None
+        return bucket.row(uuid)
+
+    def flush(self) -> List[Tuple]:
+        """Returns the rows of all open buckets and forgets them."""
+        rows = [bucket.row(uuid) for uuid, bucket in self.buckets.items()]
+        self.buckets = {}
+        return rows
+
+
+class HistoryAPI:
+    """
+    Serves telemetry history for one car over HTTP, from the raw table or
+    from the pre-aggregated bucket tables, so a long time range is a few
+    thousand rows at most.
+
+    GET /history?uuid=<uuid>&start=<us>&end=<us>&resolution=<raw|1s|10s|1m|auto>
+    """
+
+    def __init__(self, writer, max_points: int = 2000):
+        """
+        Args:
+            writer: The TelemetryWriter whose tables and connection pool are queried
+            max_points: Max rows per response, also used to pick the auto resolution
+        """
+        self.writer = writer
+        self.max_points = max_points
+
+    def pick_resolution(self, start: int, end: int) -> str:
+        """Returns the finest resolution that covers start-end in max_points rows."""
+        span = end - start
+        # Packets arrive every 100 ms
+        if span // 100000 <= self.max_points:
+            return "raw"
+        for resolution, bucket_us in RESOLUTIONS.items():
+            if span // bucket_us <= self.max_points:
+                return resolution
+        return list(RESOLUTIONS)[-1]
+
+    async def handle(self, params: Dict[str, str]) -> Tuple[int, Dict]:
+        """
+        Handles a history request.
+
+        Args:
+            params: The query string parameters
+
+        Returns:
+            Tuple of (HTTP status, JSON body)
+        """
+        uuid = params.get("uuid")
+        try:
+            start = int(params["start"])
+            end = int(params["end"])
+        except (KeyError, ValueError):
+            return 400, {"error": "start and end must be given in microseconds"}
+        if not uuid or end <= start:
+            return 400, {"error": "uuid must be given and end must be after start"}
+
+        resolution = params.get("resolution", "auto")
+        if resolution == "auto":
+            resolution = self.pick_resolution(start, end)
+        if resolution == "raw":
+            table = self.writer.table
+            columns = RAW_COLUMNS
+            time_column = "timestamp"
+        elif resolution in RESOLUTIONS:
+            table = bucket_table(self.writer.table, resolution)
+            columns = BUCKET_COLUMNS[1:]
+            time_column = "bucket_start"
+        else:
+            return 400, {"error": f"Unknown resolution {resolution}"}
+
+        query = (
+            f"SELECT {', '.join(columns)} FROM {table} "
+            f"WHERE uuid = $1 AND {time_column} >= $2 AND {time_column} < $3 "
+            f"ORDER BY {time_column} LIMIT $4"
+        )
+        try:
+            async with self.writer.pool.acquire() as connection:
+                records = await connection.fetch(query, uuid, start, end, self.max_points)
+        except Exception as e:
+            logging.error(f"History query failed: {e}")
+            return 500, {"error": "History query failed"}
+
+        # Columnar, which is both smaller and what charts want
+        return 200, {
+            "uuid": uuid,
+            "resolution": resolution,
+            "columns": {
+                column: [record[i] for record in records]
+                for i, column in enumerate(columns)
+            },
+        }
@@ -0,0 +1,282 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import tempfile
+from typing import Dict, Iterator, List, Set
+from delta_encoder import quantize
+from packet_parser import PacketParser, PacketData, V0_CURRENT
+from udp_handler import UDPHandler
+
+# --- Bus Record Layout ---
+# Workers forward decoded samples to the main process as fixed-size records,
+# several per Unix datagram:
+#   16 bytes car uuid
+#   uint8  flags (RECORD_RECOVERED)
+#   the sample in protocol v0 wire units: the header plus one position record
+RECORD_HEADER = struct.Struct("<16sB")
+RECORD_SIZE = RECORD_HEADER.size + V0_CURRENT.size
+RECORD_RECOVERED = 0x01
+
+
+def encode_record(data: PacketData) -> bytes:
+    """Packs a car update as a bus record."""
+    flags = RECORD_RECOVERED if data.get("recovered") else 0
+    return RECORD_HEADER.pack(bytes.fromhex(data["uuid"]), flags) + V0_CURRENT.pack(
+        *quantize(data["vehicle"])
+    )
+
+
+def decode_records(buffer: bytes) -> Iterator[PacketData]:
+    """Unpacks the bus records in a datagram."""
+    view = memoryview(buffer)
+    for offset in range(0, len(buffer) - RECORD_SIZE + 1, RECORD_SIZE):
+        uuid, flags = RECORD_HEADER.unpack_from(view, offset)
+        parsed = PacketParser.parse_data_packet(
+            view[offset + RECORD_HEADER.size : offset + RECORD_SIZE], False
+        )
+        if not parsed:
+            continue
+        data: PacketData = {"uuid": uuid.hex(), "vehicle": parsed[1]}
+        if flags & RECORD_RECOVERED:
+            data["recovered"] = True
+        yield data
+
+
+class RecordForwarder:
+    """
+    Stands in for the WebSocket server in an ingest worker's UDPHandler.
+    Published updates are packed as bus records and sent to the main process,
+    batched per event loop turn, so a burst of datagrams is a few sends.
+    If the main process can't keep up, batches are dropped and counted.
+    """
+
+    def __init__(self, bus_path: str, max_batch: int = 64):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.connect(bus_path)
+        self.sock.setblocking(False)
+        self.max_batch = max_batch
+        self.batch: List[bytes] = []
+        self.flush_scheduled = False
+        self.sent_records = 0
+        self.dropped_records = 0
+
+    def publish(self, data: PacketData):
+        self.batch.append(encode_record(data))
+        if len(self.batch) >= self.max_batch:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        try:
+            self.sock.send(b"".join(batch))
+            self.sent_records += len(batch)
+        except (BlockingIOError, ConnectionRefusedError, FileNotFoundError):
+            self.dropped_records += len(batch)
+            if self.dropped_records % 1000 < len(batch):
+                logging.warning(
+                    f"Ingest bus full, {self.dropped_records} records dropped so far"
+                )
+
+    def close(self):
+        self.flush()
+        self.sock.close()
+
+
+async def _worker_main(index, host, port, bus_path, handler_options):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+    forwarder = RecordForwarder(bus_path)
+    handler = UDPHandler(**handler_options)
+    handler.set_websocket_server(forwarder)
+    await handler.start_server(host=host, port=port, reuse_port=True)
+    logging.info(f"Ingest worker {index} (pid {os.getpid()}) running")
+
+    await stop.wait()
+    handler.stop_server()
+    forwarder.close()
+    logging.info(
+        f"Ingest worker {index} stopped: {handler.ingest_stats()}, "
+        f"{forwarder.sent_records} records forwarded, "
+        f"{forwarder.dropped_records} dropped"
+    )
+
+
+def _run_worker(index, host, port, bus_path, handler_options):
+    # Ctrl+C reaches the whole process group, the main process stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker_main(index, host, port, bus_path, handler_options))
+
+
+class BusProtocol(asyncio.DatagramProtocol):
+    def __init__(self, pool: "IngestWorkerPool"):
+        self.pool = pool
+
+    def datagram_received(self, data: bytes, addr):
+        for record in decode_records(data):
+            self.pool.dispatch(record)
+
+
+class IngestWorkerPool:
+    """
+    Runs UDP ingest in worker processes that all bind the UDP port with
+    SO_REUSEPORT. The kernel picks the worker by hashing the sender address,
+    so a car always lands on the same worker, which holds its authentication
+    and timestamp state and keeps its packets in order. Workers parse the
+    packets and forward the samples over a Unix datagram socket to this
+    process, which does the WebSocket fan-out, database and session store.
+
+    Has the same interface as UDPHandler, so main can use either.
+    """
+
+    def __init__(self, workers: int, **handler_options):
+        """
+        Args:
+            workers: Number of worker processes
+            handler_options: Passed on to each worker's UDPHandler
+        """
+        self.workers = workers
+        self.handler_options = handler_options
+        self.processes: List[multiprocessing.Process] = []
+        self.websocket_server = None
+        self.db_writer = None
+        self.session_store = None
+        self.lap_timer = None
+        self.bus_dir = None
+        self.bus_transport = None
+        self.monitor_task = None
+        self.dead_workers: Set[str] = set()
+        self.received_records = 0
+
+    def set_websocket_server(self, ws_server):
+        self.websocket_server = ws_server
+        logging.info("WebSocket server instance set in IngestWorkerPool")
+
+    def set_database_writer(self, db_writer):
+        self.db_writer = db_writer
+        logging.info("Database writer instance set in IngestWorkerPool")
+
+    def set_session_store(self, session_store):
+        self.session_store = session_store
+        logging.info("Session store instance set in IngestWorkerPool")
+
+    def set_lap_timer(self, lap_timer):
+        # Timed here rather than in the workers, so every car has one timer
+        self.lap_timer = lap_timer
+        logging.info("Lap timer instance set in IngestWorkerPool")
+
+    def set_segment_log(self, segment_log):
+        raise ValueError("Recording is not supported with ingest workers")
+
+    def dispatch(self, data: PacketData):
+        """Hands a sample from a worker on like UDPHandler does."""
+        self.received_records += 1
+        if self.websocket_server:
+            self.websocket_server.publish(data)
+        # Recovered samples come before the live one, in timestamp order
+        if self.lap_timer:
+            for event in self.lap_timer.add(data["uuid"], data["vehicle"]):
+                if event["type"] == "lap":
+                    logging.info(
+                        f"Car {event['uuid']} lap {event['lap']}: "
+                        f"{event['time_ms'] / 1000:.3f} s"
+                    )
+                if self.websocket_server:
+                    self.websocket_server.publish_event(event)
+        # Recovered samples are only for the live trace
+        if data.get("recovered"):
+            return
+        if self.db_writer:
+            self.db_writer.write(data["uuid"], data["vehicle"])
+        if self.session_store:
+            self.session_store.add(data["uuid"], data["vehicle"])
+
+    async def start_server(self, host="127.0.0.1", port=5005):
+        """Opens the bus socket and starts the worker processes."""
+        loop = asyncio.get_running_loop()
+        self.bus_dir = tempfile.mkdtemp(prefix="pitstop-ingest-")
+        bus_path = os.path.join(self.bus_dir, "bus.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(bus_path)
+        # Room for bursts while the event loop is busy with fan-out
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.bus_transport, _ = await loop.create_datagram_endpoint(
+            lambda: BusProtocol(self), sock=sock
+        )
+
+        logging.info(f"Starting {self.workers} UDP ingest workers on {host}:{port}")
+        # Forked, so the workers share this process's logging setup
+        context = multiprocessing.get_context("fork")
+        for index in range(self.workers):
+            process = context.Process(
+                target=_run_worker,
+                args=(
+                    index,
+                    host,
+                    port,
+                    bus_path,
+                    self.handler_options,
+                ),
+                name=f"ingest-{index}",
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        self.monitor_task = asyncio.create_task(self._monitor())
+
+    async def _monitor(self):
+        """Logs workers that die. Their senders are rehashed to the remaining
+        workers by the kernel, and are picked up on their next auth packet."""
+        while True:
+            await asyncio.sleep(1.0)
+            for process in self.processes:
+                if process.exitcode is not None and process.name not in self.dead_workers:
+                    self.dead_workers.add(process.name)
+                    logging.error(
+                        f"Ingest worker {process.name} exited with {process.exitcode}"
+                    )
+
+    def stop_server(self):
+        """Stops the workers and closes the bus."""
+        if self.monitor_task:
+            self.monitor_task.cancel()
+            self.monitor_task = None
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(timeout=5)
+        self.processes = []
+        if self.bus_transport:
+            self.bus_transport.close()
+            self.bus_transport = None
+        if self.bus_dir:
+            try:
+                os.unlink(os.path.join(self.bus_dir, "bus.sock"))
+                os.rmdir(self.bus_dir)
+            except OSError:
+                pass
+            self.bus_dir = None
+        logging.info(f"Ingest workers stopped, {self.received_records} records received")
+
+    def ingest_stats(self) -> Dict[str, int]:
+        return {
+            "workers": sum(process.is_alive() for process in self.processes),
+            "received_records": self.received_records,
+        }
+
+    def histograms(self) -> List:
+        # The stage latencies are measured in the workers, not exported from there
+        return []
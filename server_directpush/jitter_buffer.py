@@ -0,0 +1,213 @@
+import time
+from bisect import insort
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+from packet_parser import PacketData
+
+# Delay above the current minimum after which a car's clock is assumed to have
+# gone back (a device resyncing its time), and its estimate starts over. A jump
+# forward lowers the minimum right away, the playout shift then snaps to it.
+CLOCK_RESET_US = 5000000
+
+# Most the playout time of a car moves per sample, relative to its timestamp.
+# Samples then play out between 90 and 110 ms apart while the delay adapts,
+# instead of bunching up or leaving gaps. Changes smaller than PLAYOUT_DEADBAND_US
+# are ignored, so a steady car keeps the same phase against the broadcast tick.
+PLAYOUT_SLEW_US = 10000
+PLAYOUT_DEADBAND_US = 20000
+
+# Live samples of a car that may wait for a later tick. Only one goes out per
+# tick, as the broadcast only keeps the newest live update per car. Beyond this
+# the oldest are sent as recovered samples, which only fill in the trace.
+MAX_CARRIED_SAMPLES = 5
+
+
+def _timestamp(sample: Tuple[int, int, PacketData]) -> int:
+    return sample[0]
+
+
+class CarClock:
+    """
+    Clock offset and network delay of one car.
+
+    The offset between the car's clock and ours is the minimum of arrival
+    minus send time over a sliding window: the fastest packet had the least
+    queueing, so it's the closest to the pure offset plus the fixed path
+    delay. The window is a monotonic deque, so the minimum is O(1) per packet
+    and follows slow drift of the car's clock.
+
+    What a packet took on top of that is its jitter, which is smoothed like
+    TCP smooths round trip times. The playout delay is the mean plus four
+    times the mean deviation, so it grows quickly on a bad network and
+    shrinks slowly once it calms down.
+    """
+
+    __slots__ = ("window_us", "minimums", "delay", "deviation", "shift", "samples")
+
+    def __init__(self, window_us: int):
+        self.window_us = window_us
+        # (arrival, arrival - send time), increasing in both
+        self.minimums: Deque[Tuple[int, int]] = deque()
+        self.delay = 0.0
+        self.deviation = 0.0
+        # Timestamp to playout time, following offset plus delay at PLAYOUT_SLEW_US
+        self.shift = None
+        # Buffered samples in timestamp order, as (timestamp, playout time, data)
+        self.samples: List[Tuple[int, int, PacketData]] = []
+
+    @property
+    def offset(self) -> int:
+        return self.minimums[0][1]
+
+    def observe(self, arrival: int, timestamp: int):
+        """Adds the arrival of a live packet (both in microseconds)."""
+        difference = arrival - timestamp
+        minimums = self.minimums
+        if minimums and difference - minimums[0][1] > CLOCK_RESET_US:
+            minimums.clear()
+            self.delay = 0.0
+            self.deviation = 0.0
+            self.shift = None
+        while minimums and minimums[-1][1] >= difference:
+            minimums.pop()
+        minimums.append((arrival, difference))
+        while minimums[0][0] < arrival - self.window_us:
+            minimums.popleft()
+
+        jitter = difference - minimums[0][1]
+        error = jitter - self.delay
+        self.delay += error / 8
+        self.deviation += (abs(error) - self.deviation) / 4
+
+    def playout_delay(self, min_delay: int, max_delay: int) -> int:
+        delay = int(self.delay + 4 * self.deviation)
+        return min(max(delay, min_delay), max_delay)
+
+    def adapt_shift(self, min_delay: int, max_delay: int):
+        """
+        Moves the playout shift towards offset plus delay, after a live packet.
+        A move of more than max_delay is a clock jump, not jitter, and is made
+        at once instead of holding the car back or bunching it up for minutes.
+        """
+        target = self.offset + self.playout_delay(min_delay, max_delay)
+        change = target - self.shift if self.shift is not None else 0
+        if self.shift is None or abs(change) > max_delay:
+            self.shift = target
+        elif abs(change) > PLAYOUT_DEADBAND_US:
+            self.shift += max(-PLAYOUT_SLEW_US, min(change, PLAYOUT_SLEW_US))
+
+
+class JitterBuffer:
+    """
+    Holds car updates back until their playout time, so viewers get every car
+    at an even 10 Hz instead of in whatever bursts the mobile network delivers.
+
+    A sample plays out at its own timestamp, moved to our clock with the car's
+    clock offset, plus the car's playout delay. Each car gets only as much
+    delay as its observed jitter needs, and changes to it are spread out over
+    many samples. Samples recovered from a later packet's position history are
+    put back in their slot if it hasn't played out yet, otherwise they go out
+    at the next tick like before.
+
+    Sits in front of WebSocketServer.publish, the broadcast tick takes the
+    samples that are due with release().
+    """
+
+    def __init__(
+        self,
+        min_delay: float = 0.0,
+        max_delay: float = 2.0,
+        window: float = 30.0,
+    ):
+        """
+        Args:
+            min_delay: Least playout delay on top of the clock offset (seconds)
+            max_delay: Most playout delay, later packets are sent when they come in
+            window: Seconds of packets the clock offset is the minimum over
+        """
+        self.min_delay = int(min_delay * 1000000)
+        self.max_delay = int(max_delay * 1000000)
+        self.window_us = int(window * 1000000)
+        self.cars: Dict[str, CarClock] = {}
+        # Recovered samples of cars without a clock offset yet, sent right away
+        self.unplaced: List[PacketData] = []
+        self.late_samples = 0
+        self.released_samples = 0
+        self.catch_up_samples = 0  # Live samples sent as recovered to catch up
+
+    @staticmethod
+    def now() -> int:
+        return time.monotonic_ns() // 1000
+
+    def add(self, data: PacketData):
+        """Buffers a car update until its playout time."""
+        uuid = data["uuid"]
+        timestamp = data["vehicle"]["timestamp"]
+        now = self.now()
+        car = self.cars.get(uuid)
+        if data.get("recovered"):
+            if car is None:
+                self.unplaced.append(data)
+                return
+        else:
+            if car is None:
+                car = CarClock(self.window_us)
+                self.cars[uuid] = car
+            car.observe(now, timestamp)
+            car.adapt_shift(self.min_delay, self.max_delay)
+
+        playout = timestamp + car.shift
+        if playout < now and not data.get("recovered"):
+            self.late_samples += 1
+        insort(car.samples, (timestamp, playout, data), key=_timestamp)
+
+    def release(self) -> List[PacketData]:
+        """
+        Returns the samples that are due, oldest first per car, with at most
+        one live sample per car. Further due live samples wait for the next
+        ticks, as samples are 90 to 110 ms apart while the delay adapts. When
+        more than MAX_CARRIED_SAMPLES wait, the oldest are marked as recovered
+        so the car catches up. Cars that stopped sending are forgotten once
+        their samples are out.
+        """
+        now = self.now()
+        released = self.unplaced
+        self.unplaced = []
+        gone = []
+        for uuid, car in self.cars.items():
+            samples = car.samples
+            due = 0
+            while due < len(samples) and samples[due][1] <= now:
+                due += 1
+            if not due:
+                if not samples and car.minimums[-1][0] < now - self.window_us:
+                    gone.append(uuid)
+                continue
+            live = [i for i in range(due) if not samples[i][2].get("recovered")]
+            if len(live) > 1:
+                excess = max(0, len(live) - 1 - MAX_CARRIED_SAMPLES)
+                for index in live[:excess]:
+                    timestamp, playout, data = samples[index]
+                    samples[index] = (timestamp, playout, dict(data, recovered=True))
+                self.catch_up_samples += excess
+                # Up to and including one live sample, in timestamp order
+                due = live[excess + 1]
+            released.extend(data for _, _, data in samples[:due])
+            del samples[:due]
+        for uuid in gone:
+            del self.cars[uuid]
+        self.released_samples += len(released)
+        return released
+
+    def stats(self) -> Dict[str, float]:
+        cars = self.cars.values()
+        delays = [car.playout_delay(self.min_delay, self.max_delay) for car in cars]
+        return {
+            "cars": len(self.cars),
+            "buffered_samples": sum(len(car.samples) for car in cars),
+            "late_samples": self.late_samples,
+            "released_samples": self.released_samples,
+            "catch_up_samples": self.catch_up_samples,
+            "max_delay_ms": max(delays, default=0) / 1000,
+            "mean_delay_ms": sum(delays) / len(delays) / 1000 if delays else 0.0,
+        }
@@ -0,0 +1,363 @@
+import json
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+from packet_parser import VehicleData
+
+Point = Tuple[float, float]  # (latitude, longitude)
+Line = Tuple[Point, Point]
+
+# Metres per degree of latitude, and of longitude at the equator
+METERS_PER_DEGREE_LAT = 110574.0
+METERS_PER_DEGREE_LON = 111320.0
+
+# Samples further apart than this can't be timed across, the car may have
+# crossed a line in between. Gap recovery fills gaps up to 4 seconds.
+MAX_GAP_US = 5000000
+# Faster than this between two samples is a GPS glitch, not a car
+MAX_SPEED_MS = 150.0
+
+NO_EVENTS: Tuple = ()
+
+
+def _ms(us: Optional[float]) -> Optional[int]:
+    return None if us is None else round(us / 1000)
+
+
+class TimingLine:
+    """
+    A start/finish or sector line, from the left to the right edge of the track
+    seen in the driving direction. Crossing it forwards is from behind the line
+    to ahead of it, in the local metre grid of the LapTimer.
+    """
+
+    __slots__ = ("ax", "ay", "dx", "dy", "length_squared")
+
+    def __init__(self, a: Tuple[float, float], b: Tuple[float, float]):
+        self.ax, self.ay = a
+        self.dx = b[0] - a[0]
+        self.dy = b[1] - a[1]
+        self.length_squared = self.dx * self.dx + self.dy * self.dy
+
+    def side(self, x: float, y: float) -> float:
+        """Positive ahead of the line, negative behind it."""
+        return self.dx * (y - self.ay) - self.dy * (x - self.ax)
+
+    def crossing(self, px: float, py: float, qx: float, qy: float) -> Optional[float]:
+        """
+        Returns:
+            Where the move from p to q crosses the line forwards, as a fraction
+            of the move, or None if it doesn't
+        """
+        before = self.side(px, py)
+        after = self.side(qx, qy)
+        if before >= 0 or after < 0:
+            return None
+        fraction = before / (before - after)
+        # Where on the line, 0 at the left edge and 1 at the right
+        x = px + (qx - px) * fraction - self.ax
+        y = py + (qy - py) * fraction - self.ay
+        along = (x * self.dx + y * self.dy) / self.length_squared
+        if along < 0 or along > 1:
+            return None
+        return fraction
+
+
+class CarTiming:
+    """Lap in progress and best times of one car. Times are in microseconds."""
+
+    __slots__ = (
+        "timestamp",
+        "x",
+        "y",
+        "lap",
+        "lap_start",
+        "sector",
+        "sector_start",
+        "laps",
+        "best_lap",
+        "best_sectors",
+    )
+
+    def __init__(self, sectors: int):
+        self.timestamp = None  # Previous sample, None before the first
+        self.x = 0.0
+        self.y = 0.0
+        self.lap = 0  # Completed laps
+        self.lap_start = None  # Crossing time of start/finish, None while not timed
+        self.sector = 0  # Index of the sector in progress
+        self.sector_start = None
+        self.laps: List[int] = []
+        self.best_lap: Optional[int] = None
+        self.best_sectors: List[Optional[int]] = [None] * sectors
+
+
+class LapTimer:
+    """
+    Lap and sector times of every car, from its positions as they come in.
+
+    Each sample is checked against the start/finish and sector lines with the
+    move from the car's previous position: a segment intersection per line,
+    so the work per sample doesn't depend on the length of the session. The
+    crossing time is interpolated between the two samples, which times laps
+    to a few milliseconds from 10 Hz positions.
+
+    Positions are projected to a flat metre grid around the start/finish
+    line, which is accurate to well under a metre over a circuit.
+    """
+
+    def __init__(
+        self,
+        start_finish: Line,
+        sectors: Sequence[Line] = (),
+        min_lap: float = 10.0,
+    ):
+        """
+        Args:
+            start_finish: The start/finish line, left edge then right edge as
+                (latitude, longitude) seen in the driving direction
+            sectors: The lines between the sectors, in driving order
+            min_lap: Seconds a lap takes at least, crossings sooner than that
+                are GPS noise around the line
+        """
+        (lat_a, lon_a), (lat_b, lon_b) = start_finish
+        self.origin = ((lat_a + lat_b) / 2, (lon_a + lon_b) / 2)
+        self.meters_per_lat = METERS_PER_DEGREE_LAT
+        self.meters_per_lon = METERS_PER_DEGREE_LON * math.cos(
+            math.radians(self.origin[0])
+        )
+        # The start/finish line first, then the sector lines
+        self.lines = [
+            TimingLine(self.project(*a), self.project(*b))
+            for a, b in [start_finish, *sectors]
+        ]
+        self.sector_count = len(self.lines)
+        self.min_lap = int(min_lap * 1000000)
+        self.cars: Dict[str, CarTiming] = {}
+        self.best_lap: Optional[int] = None  # Fastest lap of any car
+        # Fastest time of any car in each sector
+        self.best_sectors: List[Optional[int]] = [None] * self.sector_count
+        self.completed_laps = 0
+        self.completed_sectors = 0
+        self.discarded_laps = 0
+
+    def project(self, latitude: float, longitude: float) -> Tuple[float, float]:
+        return (
+            (longitude - self.origin[1]) * self.meters_per_lon,
+            (latitude - self.origin[0]) * self.meters_per_lat,
+        )
+
+    def add(self, uuid: str, vehicle: VehicleData) -> Sequence[Dict]:
+        """
+        Moves a car to its next position. Samples must come in timestamp
+        order per car, older ones are ignored.
+
+        Returns:
+            The lap and sector events of lines crossed since the previous sample
+        """
+        timestamp = vehicle["timestamp"]
+        car = self.cars.get(uuid)
+        if car is None:
+            car = self.cars[uuid] = CarTiming(self.sector_count)
+        elif timestamp <= car.timestamp:
+            return NO_EVENTS
+
+        x, y = self.project(vehicle["latitude"], vehicle["longitude"])
+        events = NO_EVENTS
+        if car.timestamp is not None:
+            elapsed = timestamp - car.timestamp
+            if elapsed > MAX_GAP_US:
+                self._discard_lap(car)
+            elif math.hypot(x - car.x, y - car.y) > MAX_SPEED_MS * elapsed / 1000000:
+                return NO_EVENTS  # Keep the previous position
+            else:
+                for index, line in enumerate(self.lines):
+                    fraction = line.crossing(car.x, car.y, x, y)
+                    if fraction is not None:
+                        crossed = car.timestamp + fraction * elapsed
+                        events = [*events, *self._crossed(uuid, car, index, crossed)]
+        car.timestamp = timestamp
+        car.x = x
+        car.y = y
+        return events
+
+    def _discard_lap(self, car: CarTiming):
+        if car.lap_start is not None:
+            self.discarded_laps += 1
+        car.lap_start = None
+        car.sector_start = None
+
+    def _crossed(self, uuid: str, car: CarTiming, index: int, at: float) -> List[Dict]:
+        """Updates a car that crossed line index at time at (microseconds)."""
+        events = []
+        if index == 0:
+            if car.lap_start is not None:
+                if at - car.lap_start < self.min_lap:
+                    return events
+                # The last sector ends at the start/finish line. Without sector
+                # lines the lap is the only sector, and the lap event says it all.
+                if self.sector_count > 1 and car.sector == self.sector_count - 1:
+                    events.append(self._sector_event(uuid, car, car.sector, at))
+                events.append(self._lap_event(uuid, car, at))
+            car.lap_start = at
+            car.sector = 0
+            car.sector_start = at
+        elif car.sector_start is not None and index > car.sector:
+            # A line skipped by a GPS glitch leaves its sector without a time
+            if index == car.sector + 1:
+                events.append(self._sector_event(uuid, car, car.sector, at))
+            car.sector = index
+            car.sector_start = at
+        return events
+
+    def _sector_event(self, uuid: str, car: CarTiming, sector: int, at: float) -> Dict:
+        time = round(at - car.sector_start)
+        best = car.best_sectors[sector]
+        session_best = self.best_sectors[sector]
+        if best is None or time < best:
+            car.best_sectors[sector] = time
+        if session_best is None or time < session_best:
+            self.best_sectors[sector] = time
+        self.completed_sectors += 1
+        return {
+            "type": "sector",
+            "uuid": uuid,
+            "lap": car.lap + 1,
+            "sector": sector + 1,
+            "time_ms": _ms(time),
+            "delta_ms": _ms(time - best) if best is not None else None,
+            "session_delta_ms": (
+                _ms(time - session_best) if session_best is not None else None
+            ),
+            "timestamp": round(at),
+        }
+
+    def _lap_event(self, uuid: str, car: CarTiming, at: float) -> Dict:
+        time = round(at - car.lap_start)
+        best = car.best_lap
+        session_best = self.best_lap
+        car.lap += 1
+        car.laps.append(time)
+        if best is None or time < best:
+            car.best_lap = time
+        if session_best is None or time < session_best:
+            self.best_lap = time
+        self.completed_laps += 1
+        return {
+            "type": "lap",
+            "uuid": uuid,
+            "lap": car.lap,
+            "time_ms": _ms(time),
+            "best_ms": _ms(car.best_lap),
+            "delta_ms": _ms(time - best) if best is not None else None,
+            "session_delta_ms": (
+                _ms(time - session_best) if session_best is not None else None
+            ),
+            "timestamp": round(at),
+        }
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "cars": len(self.cars),
+            "laps": self.completed_laps,
+            "sectors": self.completed_sectors,
+            "discarded_laps": self.discarded_laps,
+        }
+
+    async def handle(self, params: Dict[str, str]) -> Tuple[int, Dict]:
+        """
+        Serves the lap times of every car, in milliseconds.
+
+        GET /laps
+        """
+        return 200, {
+            "best_ms": _ms(self.best_lap),
+            "best_sectors_ms": (
+                [_ms(time) for time in self.best_sectors]
+                if self.sector_count > 1
+                else []
+            ),
+            "cars": {
+                uuid: {
+                    "laps": [_ms(time) for time in car.laps],
+                    "best_ms": _ms(car.best_lap),
+                    "best_sectors_ms": (
+                        [_ms(time) for time in car.best_sectors]
+                        if self.sector_count > 1
+                        else []
+                    ),
+                }
+                for uuid, car in self.cars.items()
+            },
+        }
+
+
+def load_lines(path: str) -> Tuple[Line, List[Line]]:
+    """
+    Reads the timing lines of a track from a JSON file:
+    {"start_finish": [[lat, lon], [lat, lon]], "sectors": [[[lat, lon], [lat, lon]], ...]}
+    Each line goes from the left to the right edge of the track, seen in the
+    driving direction.
+
+    Returns:
+        The start/finish line and the sector lines
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    def line(points) -> Line:
+        (lat_a, lon_a), (lat_b, lon_b) = points
+        return (float(lat_a), float(lon_a)), (float(lat_b), float(lon_b))
+
+    return line(config["start_finish"]), [line(s) for s in config.get("sectors", [])]
+
+
+def line_across(points: Sequence[Point], index: int, width: float = 30.0) -> Line:
+    """
+    A timing line across a track given by its centre line, at one of its points.
+
+    Args:
+        points: The centre line as (latitude, longitude), in driving order
+        index: The point the line goes through
+        width: Length of the line in metres, wider than the track
+
+    Returns:
+        The line, left edge first
+    """
+    latitude, longitude = points[index]
+    before = points[index - 1]
+    after = points[(index + 1) % len(points)]
+    meters_per_lon = METERS_PER_DEGREE_LON * math.cos(math.radians(latitude))
+    # Driving direction in metres east and north, and the right hand side of it
+    east = (after[1] - before[1]) * meters_per_lon
+    north = (after[0] - before[0]) * METERS_PER_DEGREE_LAT
+    length = math.hypot(east, north)
+    right_lat = -east / length * width / 2 / METERS_PER_DEGREE_LAT
+    right_lon = north / length * width / 2 / meters_per_lon
+    return (
+        (latitude - right_lat, longitude - right_lon),
+        (latitude + right_lat, longitude + right_lon),
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    import contextlib
+    import io
+    from car_simulator import CarSimulator
+
+    parser = argparse.ArgumentParser(
+        description="Prints timing lines across the car simulator's track"
+    )
+    parser.add_argument(
+        "--sectors", type=int, default=3, help="Number of sectors of the lap"
+    )
+    parser.add_argument(
+        "--width", type=float, default=30.0, help="Length of the lines in metres"
+    )
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        track = CarSimulator().track_points
+    indices = [len(track) * sector // args.sectors for sector in range(args.sectors)]
+    lines = [line_across(track, index, args.width) for index in indices]
+    print(json.dumps({"start_finish": lines[0], "sectors": lines[1:]}, indent=2))
@@ -0,0 +1,330 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+import websockets
+from car_simulator import CarSimulator
+from packet_parser import V0_SLOT_US
+
+# How often cars re-send their auth packet, like the firmware
+AUTH_INTERVAL = 10.0
+
+
+class LoadStats:
+    """
+    Send times of the packets of one load level, and what the viewers saw.
+    A packet is identified by its car and timestamp, which the server passes
+    through unchanged, so the harness keeps the send time of every packet and
+    looks it up when a viewer receives the update.
+    """
+
+    def __init__(self):
+        self.measuring = False
+        self.sent: Dict[Tuple[str, int], float] = {}  # (uuid, timestamp) -> send time
+        self.sent_total = 0
+        self.send_errors = 0
+        self.latencies: List[float] = []
+        self.received = 0  # Samples sent while measuring, seen by a measuring viewer
+        self.frames = 0
+        self.frame_bytes = 0
+        self.rate_changes = 0  # Adaptive rate messages, the server slowing viewers down
+        self.disconnects = 0
+        self.loop_lag: List[float] = []
+
+    def packet_sent(self, uuid: str, timestamp: int):
+        self.sent_total += 1
+        if self.measuring:
+            self.sent[(uuid, timestamp)] = time.perf_counter()
+
+    def frame_received(self, message, measure: bool):
+        self.frames += 1
+        self.frame_bytes += len(message)
+        if not isinstance(message, str):
+            return
+        if message.startswith('{"type": "rate"'):
+            self.rate_changes += 1
+            return
+        if not measure:
+            return
+        now = time.perf_counter()
+        update = json.loads(message)
+        if isinstance(update, dict):
+            return  # The snapshot
+        for data in update:
+            if data.get("recovered"):
+                continue
+            sent = self.sent.get((data["uuid"], data["vehicle"]["timestamp"]))
+            if sent is not None:
+                self.latencies.append(now - sent)
+                self.received += 1
+
+
+class SimulatedCar:
+    """
+    One CarSimulator driven from the event loop instead of its own blocking
+    loop. Each car has its own socket, so the server sees it as a separate
+    sender, and timestamps advance one slot per packet like the firmware's.
+    """
+
+    def __init__(self, index: int, server: Tuple[str, int]):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.simulator = CarSimulator(
+                server_ip=server[0],
+                server_port=server[1],
+                uuid_seed=f"loadtest-car-{index}",
+            )
+        self.simulator.socket.setblocking(False)
+        self.server = server
+        self.uuid = self.simulator.car_uuid.hex()
+        # Spread the cars around the track
+        for _ in range(random.randrange(200)):
+            self.simulator.update_car_state()
+
+    def send(self, data: bytes, stats: LoadStats) -> bool:
+        try:
+            self.simulator.socket.sendto(data, self.server)
+            return True
+        except (BlockingIOError, ConnectionRefusedError):
+            stats.send_errors += 1
+            return False
+
+    async def run(self, stats: LoadStats):
+        loop = asyncio.get_running_loop()
+        simulator = self.simulator
+        # Cars don't send in lockstep, start at a random point of the slot
+        await asyncio.sleep(random.random() * V0_SLOT_US / 1000000)
+        next_send = loop.time()
+        next_auth = next_send
+        timestamp = int(time.time() * 1000000)
+        timestamp -= timestamp % V0_SLOT_US
+        try:
+            while True:
+                if next_send >= next_auth:
+                    self.send(bytes([0xFF]) + simulator.car_uuid, stats)
+                    next_auth += AUTH_INTERVAL
+                simulator.update_car_state()
+                simulator.timestamp = timestamp
+                if self.send(simulator.build_telemetry_packet(), stats):
+                    stats.packet_sent(self.uuid, timestamp)
+                timestamp += V0_SLOT_US
+                next_send += V0_SLOT_US / 1000000
+                await asyncio.sleep(max(0.0, next_send - loop.time()))
+        finally:
+            simulator.socket.close()
+
+
+async def run_viewer(url: str, stats: LoadStats, measure: bool):
+    """
+    A viewer on the JSON format. Measuring viewers decode every frame for the
+    latency, the others only receive, so the harness can run hundreds of them.
+    """
+    try:
+        async with websockets.connect(url, max_size=None) as websocket:
+            async for message in websocket:
+                stats.frame_received(message, measure)
+    except (OSError, websockets.exceptions.WebSocketException):
+        stats.disconnects += 1
+
+
+async def measure_loop_lag(stats: LoadStats, interval: float = 0.05):
+    """Records how late the harness's own event loop wakes up. If this gets
+    close to the latencies, the harness is the bottleneck, not the server."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(loop.time() - started - interval)
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    """
+    CPU time used by a process and its child processes (the ingest and fan-out
+    workers) from /proc, so Linux only.
+    """
+    ticks_per_second = os.sysconf("SC_CLK_TCK")
+    total = 0.0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/stat") as f:
+                # The command name can hold spaces, the fields start after it
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            if current == pid:
+                return None
+            continue
+        # utime and stime, fields 14 and 15 of the stat line
+        total += (int(fields[11]) + int(fields[12])) / ticks_per_second
+    return total
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run_level(
+    cars: int,
+    viewers: int,
+    server: Tuple[str, int],
+    url: str,
+    warmup: float,
+    duration: float,
+    measured_viewers: int,
+    server_pid: Optional[int],
+) -> Dict:
+    """
+    Runs one load level: starts the cars and viewers, lets them settle for
+    warmup seconds and measures for duration seconds.
+
+    Returns:
+        The results of the level
+    """
+    stats = LoadStats()
+    simulated = [SimulatedCar(index, server) for index in range(cars)]
+    tasks = [asyncio.create_task(car.run(stats)) for car in simulated]
+    tasks.append(asyncio.create_task(measure_loop_lag(stats)))
+    for index in range(viewers):
+        tasks.append(
+            asyncio.create_task(run_viewer(url, stats, index < measured_viewers))
+        )
+    try:
+        await asyncio.sleep(warmup)
+        stats.measuring = True
+        stats.loop_lag = []
+        sent_before = stats.sent_total
+        frames_before = stats.frames
+        bytes_before = stats.frame_bytes
+        cpu_before = process_cpu_seconds(server_pid) if server_pid else None
+        started = time.perf_counter()
+
+        await asyncio.sleep(duration)
+        stats.measuring = False
+        elapsed = time.perf_counter() - started
+        sent = stats.sent_total - sent_before
+        frames = stats.frames - frames_before
+        frame_bytes = stats.frame_bytes - bytes_before
+        cpu_after = process_cpu_seconds(server_pid) if server_pid else None
+        # Let the last packets of the window reach the viewers
+        await asyncio.sleep(1.0)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    expected = len(stats.sent) * min(viewers, measured_viewers)
+    latencies = sorted(stats.latencies)
+    loop_lag = sorted(stats.loop_lag)
+    server_cpu = None
+    if cpu_before is not None and cpu_after is not None:
+        server_cpu = (cpu_after - cpu_before) / elapsed * 100
+    return {
+        "cars": cars,
+        "viewers": viewers,
+        "packets_per_second": sent / elapsed,
+        "send_errors": stats.send_errors,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "p999_ms": percentile(latencies, 0.999) * 1000,
+        "missed_percent": 100 - stats.received / expected * 100 if expected else 0.0,
+        "frames_per_second": frames / elapsed,
+        "kbit_per_viewer": frame_bytes * 8 / 1000 / elapsed / max(viewers, 1),
+        "rate_changes": stats.rate_changes,
+        "disconnects": stats.disconnects,
+        "server_cpu_percent": server_cpu,
+        "harness_lag_p99_ms": percentile(loop_lag, 0.99) * 1000,
+    }
+
+
+def parse_levels(levels: str) -> List[Tuple[int, int]]:
+    """Parses "CARS:VIEWERS,CARS:VIEWERS,..."."""
+    parsed = []
+    for level in levels.split(","):
+        cars, viewers = level.split(":")
+        parsed.append((int(cars), int(viewers)))
+    return parsed
+
+
+async def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Load test a running server with simulated cars and viewers"
+    )
+    parser.add_argument(
+        "--levels",
+        default="50:50,100:200,200:400",
+        help="Load levels to run one after the other, as CARS:VIEWERS,...",
+    )
+    parser.add_argument(
+        "--udp", default="127.0.0.1:5005", metavar="HOST:PORT", help="Server UDP address"
+    )
+    parser.add_argument(
+        "--ws", default="ws://127.0.0.1:8888", help="Server WebSocket URL"
+    )
+    parser.add_argument(
+        "--warmup", type=float, default=5.0, help="Seconds to settle before measuring"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=20.0, help="Seconds to measure per level"
+    )
+    parser.add_argument(
+        "--measured-viewers",
+        type=int,
+        default=20,
+        help="Viewers that decode every frame for latency and missed updates, "
+        "the rest only receive",
+    )
+    parser.add_argument(
+        "--server-pid",
+        type=int,
+        help="Process id of the server, to report its CPU use (Linux)",
+    )
+    args = parser.parse_args()
+
+    host, port = args.udp.rsplit(":", 1)
+    server = (host, int(port))
+
+    print(
+        f"{'cars':>5}{'viewers':>8}{'pkt/s':>8}{'p50 ms':>8}{'p99 ms':>8}"
+        f"{'p99.9 ms':>9}{'missed %':>9}{'frames/s':>9}{'kbit/s':>8}"
+        f"{'rates':>7}{'closed':>7}{'CPU %':>7}{'lag ms':>7}"
+    )
+    for cars, viewers in parse_levels(args.levels):
+        result = await run_level(
+            cars,
+            viewers,
+            server,
+            args.ws,
+            args.warmup,
+            args.duration,
+            args.measured_viewers,
+            args.server_pid,
+        )
+        cpu = result["server_cpu_percent"]
+        print(
+            f"{cars:>5}{viewers:>8}{result['packets_per_second']:>8.0f}"
+            f"{result['p50_ms']:>8.1f}{result['p99_ms']:>8.1f}"
+            f"{result['p999_ms']:>9.1f}{result['missed_percent']:>9.2f}"
+            f"{result['frames_per_second']:>9.0f}{result['kbit_per_viewer']:>8.0f}"
+            f"{result['rate_changes']:>7}{result['disconnects']:>7}"
+            f"{cpu if cpu is not None else float('nan'):>7.0f}"
+            f"{result['harness_lag_p99_ms']:>7.1f}"
+        )
+        if result["send_errors"]:
+            print(f"      {result['send_errors']} packets could not be sent")
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Load test stopped by user")
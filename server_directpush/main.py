@@ -3,7 +3,21 @@ import logging
 import signal
 import argparse
 from udp_handler import UDPHandler
-from websocket_handler import WebSocketServer
+from ingest_workers import IngestWorkerPool
+from fanout import FanoutWorkerPool
+from db_writer import TelemetryWriter
+from history import HistoryAPI
+from segment_log import SegmentLog
+from metrics import MetricsServer
+from async_logging import start_async_logging
+from jitter_buffer import JitterBuffer
+from lap_timing import LapTimer, load_lines
+from websocket_handler import (
+    WebSocketServer,
+    DROP_POLICIES,
+    DROP_OLDEST,
+    deflate_extension,
+)
 
 # Configure basic logging
 logging.basicConfig(
@@ -20,7 +34,163 @@ shutdown_requested = asyncio.Event()
 async def main():
     parser = argparse.ArgumentParser(description="Pitstop Server")
     parser.add_argument("--dev", action="store_true", help="Use development host")
+    parser.add_argument(
+        "--ingest-queue-size",
+        type=int,
+        default=10000,
+        help="Max datagrams waiting to be processed before new ones are dropped",
+    )
+    parser.add_argument(
+        "--ingest-workers",
+        type=int,
+        default=0,
+        help="Parse UDP packets in this many worker processes sharing the port "
+        "with SO_REUSEPORT (Linux), instead of in the main process",
+    )
+    parser.add_argument(
+        "--fanout-workers",
+        type=int,
+        default=0,
+        help="Serve WebSocket viewers from this many worker processes sharing the "
+        "WebSocket port with SO_REUSEPORT (Linux), instead of the main process",
+    )
+    parser.add_argument(
+        "--http-port",
+        type=int,
+        default=8889,
+        help="Port the main process serves the HTTP endpoints on, with --fanout-workers",
+    )
+    parser.add_argument(
+        "--sender-timeout",
+        type=float,
+        default=60.0,
+        help="Seconds without packets after which a car's address is forgotten, "
+        "it is picked up again with its next auth packet",
+    )
+    parser.add_argument(
+        "--no-gap-recovery",
+        action="store_true",
+        help="Don't recover lost packets from the position history of the next packet",
+    )
+    parser.add_argument(
+        "--broadcast-interval",
+        type=int,
+        default=100,
+        help="Milliseconds between WebSocket frames, car updates are coalesced per frame",
+    )
+    parser.add_argument(
+        "--client-queue-size",
+        type=int,
+        default=10,
+        help="Max frames queued for a single WebSocket viewer",
+    )
+    parser.add_argument(
+        "--client-policy",
+        choices=DROP_POLICIES,
+        default=DROP_OLDEST,
+        help="What to do with frames for a viewer that can't keep up",
+    )
+    parser.add_argument(
+        "--lag-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds a viewer may lag behind before it is disconnected (disconnect policy)",
+    )
+    parser.add_argument(
+        "--jitter-buffer",
+        action="store_true",
+        help="Hold car updates back by each car's observed network jitter, so "
+        "viewers get an even 10 Hz per car",
+    )
+    parser.add_argument(
+        "--max-playout-delay",
+        type=float,
+        default=2.0,
+        help="Most seconds the jitter buffer holds an update back",
+    )
+    parser.add_argument(
+        "--snapshot-trail",
+        type=float,
+        default=10.0,
+        help="Seconds of position trail per car sent to viewers when they connect",
+    )
+    parser.add_argument(
+        "--no-compression",
+        action="store_true",
+        help="Disable permessage-deflate compression",
+    )
+    parser.add_argument(
+        "--deflate-window-bits",
+        type=int,
+        choices=range(9, 16),
+        default=12,
+        help="permessage-deflate window size in bits (9-15)",
+    )
+    parser.add_argument(
+        "--deflate-mem-level",
+        type=int,
+        choices=range(1, 10),
+        default=5,
+        help="permessage-deflate zlib memLevel (1-9)",
+    )
+    parser.add_argument(
+        "--deflate-level",
+        type=int,
+        choices=range(1, 10),
+        default=6,
+        help="permessage-deflate zlib compression level (1-9)",
+    )
+    parser.add_argument(
+        "--deflate-no-context-takeover",
+        action="store_true",
+        help="Reset the compressor after every frame, for low memory operation",
+    )
+    parser.add_argument(
+        "--db-dsn",
+        help="PostgreSQL connection string for storing telemetry history, e.g. "
+        "postgresql://pitstop@localhost/pitstop. History is not stored without it",
+    )
+    parser.add_argument(
+        "--record-dir",
+        help="Record every raw datagram to segment files in this directory, "
+        "for replaying with replay.py",
+    )
+    parser.add_argument(
+        "--session-store",
+        action="store_true",
+        help="Keep all telemetry of this run in memory, served at /session",
+    )
+    parser.add_argument(
+        "--timing-lines",
+        metavar="PATH",
+        help="JSON file with the start/finish and sector lines of the track, "
+        "to send lap and sector times to viewers and serve them at /laps",
+    )
+    parser.add_argument(
+        "--min-lap",
+        type=float,
+        default=10.0,
+        help="Seconds a lap takes at least, start/finish crossings sooner are ignored",
+    )
+    parser.add_argument(
+        "--sync-logging",
+        action="store_true",
+        help="Write log messages on the event loop instead of a background thread",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Serve stage latencies, queue depths and counters as Prometheus text "
+        "at http://127.0.0.1:PORT/metrics",
+    )
     args = parser.parse_args()
+    if args.ingest_workers and args.record_dir:
+        parser.error("--record-dir can't be used with --ingest-workers")
+
+    log_listener = None
+    if not args.sync_logging:
+        log_listener = start_async_logging()
 
     devmode = False
     if args.dev:
@@ -36,12 +206,117 @@ async def main():
         f"Starting server on {host} with ports {ws_port} (WebSocket) and {udp_port} (UDP)"
     )
 
-    ws_server = WebSocketServer(host=host, port=ws_port)
-    udp_handler = UDPHandler()
+    server_options = dict(
+        tick_interval=args.broadcast_interval / 1000,
+        client_queue_size=args.client_queue_size,
+        client_policy=args.client_policy,
+        lag_timeout=args.lag_timeout,
+        snapshot_trail=args.snapshot_trail,
+        compression=not args.no_compression,
+        deflate=deflate_extension(
+            args.deflate_window_bits,
+            args.deflate_mem_level,
+            args.deflate_level,
+            args.deflate_no_context_takeover,
+        ),
+    )
+    fanout_pool = None
+    if args.fanout_workers:
+        # The workers take the WebSocket port, the main process still runs the
+        # broadcast tick and serves the HTTP endpoints on its own port
+        fanout_pool = FanoutWorkerPool(
+            args.fanout_workers, host, ws_port, devmode, **server_options
+        )
+        ws_server = WebSocketServer(host=host, port=args.http_port, **server_options)
+        ws_server.set_frame_bus(fanout_pool.bus)
+    else:
+        ws_server = WebSocketServer(host=host, port=ws_port, **server_options)
+    jitter_buffer = None
+    if args.jitter_buffer:
+        jitter_buffer = JitterBuffer(max_delay=args.max_playout_delay)
+        ws_server.set_jitter_buffer(jitter_buffer)
+    handler_options = dict(
+        ingest_queue_size=args.ingest_queue_size,
+        recover_gaps=not args.no_gap_recovery,
+        sender_timeout=args.sender_timeout,
+    )
+    if args.ingest_workers:
+        udp_handler = IngestWorkerPool(args.ingest_workers, **handler_options)
+    else:
+        udp_handler = UDPHandler(**handler_options)
 
     # Link the UDP handler to the WebSocket server for broadcasting
     udp_handler.set_websocket_server(ws_server)
 
+    segment_log = None
+    if args.record_dir:
+        segment_log = SegmentLog(args.record_dir)
+        udp_handler.set_segment_log(segment_log)
+
+    if args.session_store:
+        # Needs numpy, which the server doesn't otherwise
+        from session_store import SessionStore
+
+        session_store = SessionStore()
+        udp_handler.set_session_store(session_store)
+        ws_server.add_http_route("/session", session_store.handle)
+
+    lap_timer = None
+    if args.timing_lines:
+        start_finish, sectors = load_lines(args.timing_lines)
+        lap_timer = LapTimer(start_finish, sectors, min_lap=args.min_lap)
+        udp_handler.set_lap_timer(lap_timer)
+        ws_server.add_http_route("/laps", lap_timer.handle)
+
+    db_writer = None
+    if args.db_dsn:
+        db_writer = TelemetryWriter(dsn=args.db_dsn)
+        udp_handler.set_database_writer(db_writer)
+        # History is served over HTTP on the WebSocket port
+        ws_server.add_http_route("/history", HistoryAPI(db_writer).handle)
+
+    metrics = None
+    if args.metrics_port:
+        metrics = MetricsServer()
+        metrics.add_stats(
+            "ingest",
+            udp_handler.ingest_stats,
+            counters=(
+                "dropped_datagrams",
+                "recovered_samples",
+                "unrecovered_slots",
+                "received_records",
+                "evicted_senders",
+                "rebound_senders",
+            ),
+        )
+        metrics.add_stats(
+            "ws", ws_server.client_stats, counters=("dropped_frames", "lag_disconnects")
+        )
+        metrics.add_histograms(udp_handler.histograms())
+        metrics.add_histograms(ws_server.histograms())
+        if db_writer:
+            metrics.add_stats(
+                "db",
+                db_writer.stats,
+                counters=("rows_written", "rows_dropped", "rows_failed", "flushes"),
+            )
+            metrics.add_histograms([db_writer.flush_seconds])
+        if jitter_buffer:
+            metrics.add_stats(
+                "jitter",
+                jitter_buffer.stats,
+                counters=("late_samples", "released_samples", "catch_up_samples"),
+            )
+        if lap_timer:
+            metrics.add_stats(
+                "laps",
+                lap_timer.stats,
+                counters=("laps", "sectors", "discarded_laps"),
+            )
+        if args.session_store:
+            metrics.add_stats("session", session_store.stats, counters=("out_of_order",))
+
     loop = asyncio.get_running_loop()
 
     # --- Signal Handling ---
@@ -61,14 +336,30 @@ async def main():
 
     # --- Start Servers ---
     try:
+        # Workers are forked first, so they don't inherit the listening sockets
+        if fanout_pool:
+            await fanout_pool.start()
+        if args.ingest_workers:
+            await udp_handler.start_server(host=host, port=udp_port)
+
         # Start WebSocket Server
         ws_server_instance = await ws_server.start(devmode)
         if not ws_server_instance:
             logging.error("Failed to start WebSocket server. Exiting.")
             return  # Exit if WebSocket server fails to start
 
+        # Start the segment log and database writer before any data comes in
+        if segment_log:
+            segment_log.start()
+        if db_writer:
+            await db_writer.start()
+
         # Start UDP Server (doesn't block now)
-        await udp_handler.start_server(host=host, port=udp_port)
+        if not args.ingest_workers:
+            await udp_handler.start_server(host=host, port=udp_port)
+
+        if metrics:
+            await metrics.start(port=args.metrics_port)
 
         # Keep main running until shutdown is requested
         logging.info("Servers started. Press Ctrl+C to stop.")
@@ -83,12 +374,23 @@ async def main():
     finally:
         logging.info("Shutting down servers...")
         # --- Graceful Shutdown ---
+        if metrics:
+            await metrics.stop()
+
         # Stop WebSocket Server
         await ws_server.stop()
+        if fanout_pool:
+            await fanout_pool.stop()
 
         # Stop UDP Server
         udp_handler.stop_server()
 
+        # Write what's left in the segment log and database queues
+        if segment_log:
+            segment_log.stop()
+        if db_writer and db_writer.task:
+            await db_writer.stop()
+
         # Clean up signal handlers if they were added
         if hasattr(loop, "remove_signal_handler"):
             for sig in (signal.SIGINT, signal.SIGTERM):
@@ -98,6 +400,9 @@ async def main():
                     logging.error(f"Error removing signal handler for {sig.name}: {e}")
 
         logging.info("Servers shut down gracefully.")
+        # Write out what's still queued
+        if log_listener:
+            log_listener.stop()
 
 
 if __name__ == "__main__":
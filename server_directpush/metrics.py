@@ -0,0 +1,158 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Upper bounds of the latency buckets in seconds, 1 us to 2.5 s
+LATENCY_BUCKETS = (
+    0.000001,
+    0.000005,
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+
+def _format_value(value: float) -> str:
+    """Exact text for a sample value, so large counters keep every digit."""
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets. Observing is a binary search over the
+    bucket bounds and two additions, cheap enough for the per-packet path.
+    """
+
+    __slots__ = ("name", "help", "buckets", "counts", "sum", "count")
+
+    def __init__(
+        self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        """
+        Args:
+            name: Metric name, without the pitstop_ prefix
+            help: One line description for the metrics endpoint
+            buckets: Bucket upper bounds in seconds, ascending
+        """
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def render(self, lines: List[str]):
+        name = f"pitstop_{self.name}"
+        lines.append(f"# HELP {name} {self.help}")
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum!r}")
+        lines.append(f"{name}_count {self.count}")
+
+
+class MetricsServer:
+    """
+    Serves the stage latency histograms and the stats of the server components
+    as Prometheus text on a local port. Everything is read when scraped, the
+    components only keep their counters and histograms up to date.
+    """
+
+    def __init__(self):
+        # (prefix, stats function, names of the stats that are counters)
+        self.stats: List[Tuple[str, Callable[[], Dict[str, float]], Iterable[str]]] = []
+        self.histograms: List[Histogram] = []
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def add_stats(
+        self,
+        prefix: str,
+        stats: Callable[[], Dict[str, float]],
+        counters: Iterable[str] = (),
+    ):
+        """
+        Exports a component's stats as pitstop_<prefix>_<name>.
+
+        Args:
+            prefix: Name of the component
+            stats: Function returning the stats, such as UDPHandler.ingest_stats
+            counters: Stats that only go up, the rest are gauges
+        """
+        self.stats.append((prefix, stats, frozenset(counters)))
+
+    def add_histograms(self, histograms: Iterable[Histogram]):
+        self.histograms.extend(histograms)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for prefix, stats, counters in self.stats:
+            try:
+                values = stats()
+            except Exception as e:
+                logging.error(f"Error reading {prefix} stats for metrics: {e}")
+                continue
+            for key, value in values.items():
+                name = f"pitstop_{prefix}_{key}"
+                kind = "counter" if key in counters else "gauge"
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {_format_value(value)}")
+        for histogram in self.histograms:
+            histogram.render(lines)
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 9100):
+        """Serves GET /metrics on host:port, only on localhost by default."""
+        self.server = await asyncio.start_server(self._handle, host, port)
+        logging.info(f"Metrics served on http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
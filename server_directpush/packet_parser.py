@@ -1,6 +1,28 @@
 import struct
 import logging
-from typing import Dict, List, Tuple, TypedDict, Optional
+from typing import Dict, List, NotRequired, Tuple, TypedDict, Optional
+
+
+# --- Wire Layout (protocol v0) ---
+# Everything after the packet type byte, little-endian:
+# timestamp, speed, heading, 16 brake temps, heart rate, coolant, oil,
+# accelerator, clutch, brake, followed by 40 (lat, lon, rpm) position records.
+V0_HEADER_FORMAT = "<qHH16H6B"
+V0_POSITION_FORMAT = "IIH"
+V0_POSITION_COUNT = 40
+
+V0_HEADER = struct.Struct(V0_HEADER_FORMAT)  # 50 bytes
+V0_POSITION = struct.Struct("<" + V0_POSITION_FORMAT)  # 10 bytes
+# Header plus the most recent position record, the shortest packet we accept
+V0_CURRENT = struct.Struct(V0_HEADER_FORMAT + V0_POSITION_FORMAT)
+# Header plus the full 40 record position history
+V0_PACKET = struct.Struct(V0_HEADER_FORMAT + V0_POSITION_FORMAT * V0_POSITION_COUNT)
+
+# Index of the first position field in a tuple unpacked with V0_CURRENT/V0_PACKET
+V0_POSITION_OFFSET = 25
+
+# Time between position records, and between packets, in microseconds
+V0_SLOT_US = 100000
 
 
 # --- TypedDict Definitions ---
@@ -23,6 +45,8 @@ class VehicleData(TypedDict):
 class PacketData(TypedDict):
     uuid: str
     vehicle: VehicleData
+    # Set on samples recovered from the position history of a later packet
+    recovered: NotRequired[bool]
 
 
 class PacketParser:
@@ -56,78 +80,83 @@ class PacketParser:
         Parse a data packet (protocol v0).
 
         Args:
-            payload: Raw bytes containing the telemetry data
+            payload: Raw bytes (or a memoryview) containing the telemetry data
             timestamp_check: Whether to check if the timestamp is newer than last_timestamp
             last_timestamp: The last received timestamp for comparison
 
         Returns:
             Tuple of (timestamp, vehicle_data) if valid, None otherwise
-            Note: Only the first position and RPM data is used, the rest are discarded
+            Note: Only the first position and RPM data is used, the older records
+            are read with parse_position_record when needed
         """
-        # Check minimum length (8 byte timestamp + vehicle data + at least one position)
-        # Vehicle data: 2+2+32+1+1+1+1+1+1 = 42 bytes
-        # Position data: 4+4+2 = 10 bytes
-        min_len = 8 + 42 + 10
-        if len(payload) < min_len:
+        if len(payload) < V0_CURRENT.size:
             logging.warning(f"Received short data packet ({len(payload)} bytes)")
             return None
 
         try:
-            # --- Parse Timestamp ---
-            timestamp = struct.unpack("<q", payload[:8])[0]
+            # Decode the vehicle data and the most recent position in one pass,
+            # straight from the receive buffer without slicing
+            fields = V0_CURRENT.unpack_from(payload)
+            timestamp = fields[0]
+            latitude, longitude, rpm = fields[
+                V0_POSITION_OFFSET : V0_POSITION_OFFSET + 3
+            ]
 
             # Check if this is an old packet
             if timestamp_check and timestamp <= last_timestamp:
                 logging.debug(
-                    f"Ignoring old packet (timestamp: {timestamp} <= last: {last_timestamp})"
+                    "Ignoring old packet (timestamp: %d <= last: %d)",
+                    timestamp,
+                    last_timestamp,
                 )
                 return None
 
-            # --- Parse Vehicle Data (offset 8) ---
             vehicle_data: VehicleData = {
                 "timestamp": timestamp,
-                "speed": struct.unpack("<H", payload[8:10])[0] / 100.0,
-                "heading": struct.unpack("<H", payload[10:12])[0] / 100.0,
-                "brake_temps": [
-                    t * 0.1 - 100.0 for t in struct.unpack("<16H", payload[12:44])
-                ],
-                "heart_rate": payload[44],
-                "coolant_temp": payload[45],
-                "oil_temp": payload[46],
-                "accelerator": payload[47],
-                "clutch": payload[48],
-                "brake": payload[49],
-                # Initialize with default values
-                "latitude": 0.0,
-                "longitude": 0.0,
-                "rpm": 0,
+                "speed": fields[1] / 100.0,
+                "heading": fields[2] / 100.0,
+                "brake_temps": [t * 0.1 - 100.0 for t in fields[3:19]],
+                "heart_rate": fields[19],
+                "coolant_temp": fields[20],
+                "oil_temp": fields[21],
+                "accelerator": fields[22],
+                "clutch": fields[23],
+                "brake": fields[24],
+                "latitude": latitude / 6000000.0,
+                "longitude": longitude / 6000000.0,
+                "rpm": rpm,
             }
 
-            # --- Parse Positional Data (offset 50) ---
-            pos_data_bytes = payload[50:]
-
-            # Only process the first position data if available
-            if len(pos_data_bytes) >= 10:  # Each position record is 10 bytes
-                lat_raw, lon_raw, rpm = struct.unpack("<IIH", pos_data_bytes[:10])
-                # Add position and RPM directly to vehicle data
-                vehicle_data["latitude"] = lat_raw / 6000000.0
-                vehicle_data["longitude"] = lon_raw / 6000000.0
-                vehicle_data["rpm"] = rpm
-
-                # Log if we're discarding additional position data
-                if len(pos_data_bytes) > 10:
-                    num_discarded = (len(pos_data_bytes) - 10) // 10
-                    logging.debug(
-                        f"Discarding {num_discarded} additional position records as requested"
-                    )
-
             return timestamp, vehicle_data
 
         except struct.error as e:
             logging.error(f"Failed to unpack data packet: {e}")
-        except IndexError as e:
-            logging.error(f"Data packet seems incomplete: {e}")
         except Exception as e:
             logging.error(f"Unexpected error processing data packet: {e}")
 
         return None
+
+    @staticmethod
+    def position_record_count(payload: bytes) -> int:
+        """Returns the number of position records in a data packet payload."""
+        return max(0, (len(payload) - V0_HEADER.size) // V0_POSITION.size)
+
+    @staticmethod
+    def parse_position_record(
+        payload: bytes, index: int
+    ) -> Tuple[float, float, int]:
+        """
+        Parse one record of the position history of a data packet (protocol v0).
+
+        Args:
+            payload: Raw bytes (or a memoryview) containing the telemetry data
+            index: Record to parse, 0 is the current position and record n is
+                n * V0_SLOT_US older, must be below position_record_count()
+
+        Returns:
+            Tuple of (latitude, longitude, rpm)
+        """
+        latitude, longitude, rpm = V0_POSITION.unpack_from(
+            payload, V0_HEADER.size + index * V0_POSITION.size
+        )
+        return latitude / 6000000.0, longitude / 6000000.0, rpm
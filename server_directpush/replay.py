@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import socket
+import time
+from typing import Dict, List, Optional, Tuple
+from segment_log import read_segments
+from udp_handler import UDPHandler
+from websocket_handler import WebSocketServer
+
+
+async def replay_to_handler(
+    paths: List[str], handler: UDPHandler, speed: Optional[float] = 1.0
+) -> int:
+    """
+    Feeds recorded datagrams through UDPHandler.process_datagram.
+
+    Args:
+        paths: Segment files, or directories with segment files
+        handler: The handler to feed
+        speed: Playback speed relative to the recording, None for as fast as possible
+
+    Returns:
+        Number of datagrams replayed
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    first_arrival = None
+    count = 0
+    for arrival, addr, _, data in read_segments(paths):
+        if first_arrival is None:
+            first_arrival = arrival
+        if speed:
+            delay = started + (arrival - first_arrival) / 1000000 / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % 1000 == 0:
+            # Let the WebSocket side run now and then at max speed
+            await asyncio.sleep(0)
+
+        await handler.process_datagram(data, addr)
+        count += 1
+    return count
+
+
+async def replay_to_server(
+    paths: List[str], server: Tuple[str, int], speed: Optional[float] = 1.0
+) -> int:
+    """
+    Sends recorded datagrams to a running server over UDP.
+    Each recorded sender gets its own socket, so the server sees them as separate cars.
+
+    Args:
+        paths: Segment files, or directories with segment files
+        server: Host and port of the server
+        speed: Playback speed relative to the recording, None for as fast as possible
+
+    Returns:
+        Number of datagrams sent
+    """
+    loop = asyncio.get_running_loop()
+    sockets: Dict[Tuple[str, int], socket.socket] = {}
+    started = loop.time()
+    first_arrival = None
+    count = 0
+    try:
+        for arrival, addr, _, data in read_segments(paths):
+            if first_arrival is None:
+                first_arrival = arrival
+            if speed:
+                delay = started + (arrival - first_arrival) / 1000000 / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif count % 1000 == 0:
+                await asyncio.sleep(0)
+
+            sender = sockets.get(addr)
+            if sender is None:
+                sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sender.setblocking(False)
+                sockets[addr] = sender
+            try:
+                sender.sendto(data, server)
+            except BlockingIOError:
+                logging.warning("Send buffer full, datagram not sent")
+            count += 1
+    finally:
+        for sender in sockets.values():
+            sender.close()
+    return count
+
+
+async def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Replay recorded datagrams through the server"
+    )
+    parser.add_argument(
+        "paths", nargs="+", help="Segment files, or directories with segment files"
+    )
+    speed_group = parser.add_mutually_exclusive_group()
+    speed_group.add_argument(
+        "--speed", type=float, default=1.0, help="Playback speed, e.g. 1 or 10"
+    )
+    speed_group.add_argument(
+        "--max", action="store_true", help="Replay as fast as possible"
+    )
+    parser.add_argument(
+        "--send",
+        metavar="HOST:PORT",
+        help="Send the datagrams to a running server instead of replaying in-process",
+    )
+    parser.add_argument(
+        "--ws-port",
+        type=int,
+        default=8888,
+        help="WebSocket port viewers can watch the in-process replay on",
+    )
+    args = parser.parse_args()
+    speed = None if args.max else args.speed
+
+    started = time.monotonic()
+    if args.send:
+        host, port = args.send.rsplit(":", 1)
+        count = await replay_to_server(args.paths, (host, int(port)), speed)
+    else:
+        ws_server = WebSocketServer(host="127.0.0.1", port=args.ws_port)
+        await ws_server.start(True)
+        udp_handler = UDPHandler()
+        udp_handler.set_websocket_server(ws_server)
+        try:
+            count = await replay_to_handler(args.paths, udp_handler, speed)
+        finally:
+            await ws_server.stop()
+
+    elapsed = time.monotonic() - started
+    logging.info(
+        f"Replayed {count} datagrams in {elapsed:.1f} s ({count / max(elapsed, 1e-9):.0f}/s)"
+    )
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logging.info("Replay stopped by user")
@@ -0,0 +1,202 @@
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, List, Optional, Tuple
+
+# --- Segment File Layout ---
+# A segment starts with SEGMENT_MAGIC, followed by records, all little-endian:
+#   uint32 length of the rest of the record
+#   uint32 crc32 of the rest of the record
+#   int64  arrival time, microseconds since 1970
+#   uint16 sender port
+#   16 bytes sender uuid at arrival, zeros if the sender wasn't authenticated
+#   uint8  length of the sender host
+#   the sender host (ascii), then the raw datagram
+# A crash can only leave a short or corrupt record at the end of the newest
+# segment, which the reader detects by length and checksum and skips.
+SEGMENT_MAGIC = b"PITSEG1\n"
+SEGMENT_SUFFIX = ".seg"
+RECORD_PREFIX = struct.Struct("<II")
+RECORD_HEADER = struct.Struct("<qH16sB")
+NO_UUID = bytes(16)
+
+Record = Tuple[int, Tuple[str, int], Optional[str], bytes]
+
+
+class SegmentLog:
+    """
+    Appends every raw datagram to rotating segment files.
+    The event loop only puts a tuple on a queue, packing and file I/O happen
+    in a writer thread, which writes whatever has queued up in one go.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_segment_bytes: int = 64 * 1024 * 1024,
+        fsync_interval: float = 1.0,
+    ):
+        """
+        Args:
+            directory: Where segment files are written, created if missing
+            max_segment_bytes: Start a new segment when the current one is this big
+            fsync_interval: Seconds between fsyncs, what a power loss can cost at most
+        """
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.fsync_interval = fsync_interval
+        self.records: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread = None
+        self.file = None
+        self.segment_bytes = 0
+        self.segment_number = 0
+
+        # Stats, updated by the writer thread
+        self.records_written = 0
+        self.bytes_written = 0
+        self.segments = 0
+
+    def start(self):
+        """Starts the writer thread."""
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(
+            target=self._run, name="segment-log", daemon=True
+        )
+        self.thread.start()
+        logging.info(f"Recording raw datagrams to {self.directory}")
+
+    def stop(self):
+        """Writes everything still queued and closes the current segment."""
+        if self.thread:
+            self.records.put(None)
+            self.thread.join()
+            self.thread = None
+            logging.info(
+                f"Segment log stopped: {self.records_written} records, "
+                f"{self.bytes_written} bytes in {self.segments} segments"
+            )
+
+    def append(self, data: bytes, addr: Tuple[str, int], uuid: Optional[str]):
+        """Queues a datagram for writing. Cheap enough to call for every packet."""
+        self.records.put((time.time_ns() // 1000, addr, uuid, data))
+
+    def _open_segment(self):
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.segment_number += 1
+        name = f"pitstop-{int(time.time())}-{self.segment_number:06d}{SEGMENT_SUFFIX}"
+        self.file = open(os.path.join(self.directory, name), "ab")
+        self.file.write(SEGMENT_MAGIC)
+        self.segment_bytes = len(SEGMENT_MAGIC)
+        self.segments += 1
+
+    def _run(self):
+        last_fsync = time.monotonic()
+        stopping = False
+        self._open_segment()
+        while not stopping:
+            # Block for the first record, then take everything else that is queued
+            batch = [self.records.get()]
+            while not self.records.empty() and len(batch) < 10000:
+                batch.append(self.records.get_nowait())
+
+            chunks: List[bytes] = []
+            for item in batch:
+                if item is None:
+                    stopping = True
+                    continue
+                arrival, addr, uuid, data = item
+                port = addr[1]
+                host_bytes = addr[0].encode("ascii")
+                rest = (
+                    RECORD_HEADER.pack(
+                        arrival,
+                        port,
+                        bytes.fromhex(uuid) if uuid else NO_UUID,
+                        len(host_bytes),
+                    )
+                    + host_bytes
+                    + data
+                )
+                chunks.append(RECORD_PREFIX.pack(len(rest), zlib.crc32(rest)) + rest)
+
+            if chunks:
+                block = b"".join(chunks)
+                if self.segment_bytes + len(block) > self.max_segment_bytes:
+                    self._open_segment()
+                try:
+                    self.file.write(block)
+                    self.file.flush()
+                except OSError as e:
+                    logging.error(f"Failed to write segment log: {e}")
+                    continue
+                self.segment_bytes += len(block)
+                self.bytes_written += len(block)
+                self.records_written += len(chunks)
+
+            if stopping or time.monotonic() - last_fsync >= self.fsync_interval:
+                os.fsync(self.file.fileno())
+                last_fsync = time.monotonic()
+
+        self.file.close()
+        self.file = None
+
+
+def read_segment(path: str) -> Iterator[Record]:
+    """
+    Reads the records of one segment file.
+
+    Yields:
+        Tuples of (arrival time in microseconds, sender address, sender uuid or None, datagram)
+    """
+    with open(path, "rb") as f:
+        if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            logging.warning(f"{path} is not a segment file, skipping it")
+            return
+
+        while True:
+            prefix = f.read(RECORD_PREFIX.size)
+            if not prefix:
+                return
+            if len(prefix) < RECORD_PREFIX.size:
+                logging.warning(f"{path} ends with a truncated record, skipping it")
+                return
+            length, crc = RECORD_PREFIX.unpack(prefix)
+            rest = f.read(length)
+            if len(rest) < length or zlib.crc32(rest) != crc:
+                logging.warning(f"{path} ends with a truncated or corrupt record, skipping it")
+                return
+
+            arrival, port, uuid_bytes, host_length = RECORD_HEADER.unpack_from(rest)
+            offset = RECORD_HEADER.size
+            host = rest[offset : offset + host_length].decode("ascii")
+            data = rest[offset + host_length :]
+            uuid = uuid_bytes.hex() if uuid_bytes != NO_UUID else None
+            yield arrival, (host, port), uuid, data
+
+
+def segment_paths(paths: List[str]) -> List[str]:
+    """Expands directories to the segment files in them, in the order they were written."""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if name.endswith(SEGMENT_SUFFIX)
+            )
+        else:
+            found.append(path)
+    return found
+
+
+def read_segments(paths: List[str]) -> Iterator[Record]:
+    """Reads the records of several segment files or directories, in order."""
+    for path in segment_paths(paths):
+        yield from read_segment(path)
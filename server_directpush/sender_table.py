@@ -0,0 +1,137 @@
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+Address = Tuple[str, int]
+
+
+class SenderSession:
+    """One authenticated car: where it sends from and its per-car ingest state."""
+
+    __slots__ = ("uuid", "addr", "last_timestamp", "last_seen", "active")
+
+    def __init__(self, uuid: str, addr: Address, now: float):
+        self.uuid = uuid
+        self.addr = addr
+        self.last_timestamp = 0  # Timestamp of the newest data packet, 0 for none yet
+        self.last_seen = now
+        self.active = True  # False once evicted or replaced, for the timer wheel
+
+
+class SenderTable:
+    """
+    The authenticated cars, by sender address and by UUID, so both lookups are
+    one dict access.
+
+    When a car's auth packet comes from a new address (a new NAT mapping, or
+    a switch between mobile networks), its session moves to that address and
+    keeps its timestamp, so gap recovery carries on. An address that starts
+    sending another car's auth packets is taken over by that car.
+
+    Cars that send nothing for idle_timeout seconds are evicted with a timer
+    wheel: a session sits in the slot its timeout falls in, and packets only
+    update its last_seen. Each tick looks at one slot, evicting what timed
+    out and moving the rest on, so the work per tick is bounded by the cars
+    that could expire, not by every car ever seen.
+    """
+
+    def __init__(self, idle_timeout: float = 60.0, tick: float = 1.0):
+        """
+        Args:
+            idle_timeout: Seconds without packets after which a car is forgotten
+            tick: Seconds between timer wheel ticks, the eviction resolution
+        """
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self.by_addr: Dict[Address, SenderSession] = {}
+        self.by_uuid: Dict[str, SenderSession] = {}
+        # One slot per tick of the timeout, plus one so a slot is never its own next
+        self.wheel: List[Set[SenderSession]] = [
+            set() for _ in range(int(idle_timeout / tick) + 2)
+        ]
+        self.current_tick = int(time.monotonic() / tick)
+        self.evicted = 0
+        self.rebound = 0
+
+    def __len__(self) -> int:
+        return len(self.by_uuid)
+
+    def _schedule(self, session: SenderSession):
+        due_tick = int((session.last_seen + self.idle_timeout) / self.tick) + 1
+        due_tick = max(due_tick, self.current_tick + 1)
+        self.wheel[due_tick % len(self.wheel)].add(session)
+
+    def authenticate(self, addr: Address, uuid: str) -> Tuple[SenderSession, bool]:
+        """
+        Binds an address to a car's UUID.
+
+        Returns:
+            The car's session, and whether the binding is new (a new car, or a
+            known car from a new address) rather than a repeated auth packet
+        """
+        now = time.monotonic()
+        session = self.by_uuid.get(uuid)
+        if session is not None and session.addr == addr:
+            session.last_seen = now
+            return session, False
+
+        # The address belonged to another car
+        previous = self.by_addr.get(addr)
+        if previous is not None:
+            self._remove(previous)
+
+        if session is None:
+            session = SenderSession(uuid, addr, now)
+            self.by_uuid[uuid] = session
+            self._schedule(session)
+        else:
+            del self.by_addr[session.addr]
+            session.addr = addr
+            session.last_seen = now
+            self.rebound += 1
+        self.by_addr[addr] = session
+        return session, True
+
+    def get(self, addr: Address) -> Optional[SenderSession]:
+        """Returns the session of an authenticated address, and notes it's alive."""
+        session = self.by_addr.get(addr)
+        if session is not None:
+            session.last_seen = time.monotonic()
+        return session
+
+    def uuid(self, addr: Address) -> Optional[str]:
+        session = self.by_addr.get(addr)
+        return session.uuid if session is not None else None
+
+    def _remove(self, session: SenderSession):
+        session.active = False
+        del self.by_addr[session.addr]
+        del self.by_uuid[session.uuid]
+
+    def expire(self) -> List[SenderSession]:
+        """
+        Advances the timer wheel to now.
+
+        Returns:
+            The sessions evicted for being idle
+        """
+        now = time.monotonic()
+        now_tick = int(now / self.tick)
+        evicted = []
+        # After a long stall every slot is looked at once, that covers everything
+        ticks = min(now_tick - self.current_tick, len(self.wheel))
+        for _ in range(ticks):
+            self.current_tick += 1
+            slot = self.wheel[self.current_tick % len(self.wheel)]
+            due = list(slot)
+            slot.clear()
+            for session in due:
+                if not session.active:
+                    continue
+                if now - session.last_seen >= self.idle_timeout:
+                    self._remove(session)
+                    evicted.append(session)
+                else:
+                    self._schedule(session)
+        self.current_tick = max(self.current_tick, now_tick)
+        self.evicted += len(evicted)
+        return evicted
@@ -0,0 +1,167 @@
+import logging
+import time
+from typing import Dict, Optional, Tuple
+import numpy as np
+from packet_parser import VehicleData
+
+# Column dtypes, brake temps are kept as an N x 16 block
+DTYPES = {
+    "timestamp": np.int64,
+    "speed": np.float32,
+    "heading": np.float32,
+    "heart_rate": np.uint8,
+    "coolant_temp": np.uint8,
+    "oil_temp": np.uint8,
+    "accelerator": np.uint8,
+    "clutch": np.uint8,
+    "brake": np.uint8,
+    "latitude": np.float64,
+    "longitude": np.float64,
+    "rpm": np.uint16,
+}
+BRAKE_TEMP_COUNT = 16
+
+
+class CarSeries:
+    """
+    Telemetry for one car as preallocated column arrays, in timestamp order.
+    The arrays double in size when full, so appending is amortized O(1), and a
+    time range is found with a binary search and returned as array views.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        self.size = 0
+        self.columns: Dict[str, np.ndarray] = {
+            name: np.empty(capacity, dtype) for name, dtype in DTYPES.items()
+        }
+        self.brake_temps = np.empty((capacity, BRAKE_TEMP_COUNT), np.float32)
+
+    @property
+    def capacity(self) -> int:
+        return len(self.brake_temps)
+
+    @property
+    def last_timestamp(self) -> Optional[int]:
+        if self.size == 0:
+            return None
+        return int(self.columns["timestamp"][self.size - 1])
+
+    def _grow(self):
+        capacity = self.capacity * 2
+        for name, column in self.columns.items():
+            grown = np.empty(capacity, column.dtype)
+            grown[: self.size] = column[: self.size]
+            self.columns[name] = grown
+        grown = np.empty((capacity, BRAKE_TEMP_COUNT), np.float32)
+        grown[: self.size] = self.brake_temps[: self.size]
+        self.brake_temps = grown
+
+    def append(self, vehicle: VehicleData) -> bool:
+        """
+        Appends a sample.
+
+        Returns:
+            False if the sample is not newer than the last one, and was not stored
+        """
+        last = self.last_timestamp
+        if last is not None and vehicle["timestamp"] <= last:
+            return False
+        if self.size == self.capacity:
+            self._grow()
+
+        i = self.size
+        for name, column in self.columns.items():
+            column[i] = vehicle[name]
+        self.brake_temps[i] = vehicle["brake_temps"]
+        self.size += 1
+        return True
+
+    def range(self, start: int, end: int) -> Tuple[int, int]:
+        """Returns the index range of samples with start <= timestamp < end."""
+        timestamps = self.columns["timestamp"][: self.size]
+        return (
+            int(np.searchsorted(timestamps, start, "left")),
+            int(np.searchsorted(timestamps, end, "left")),
+        )
+
+    def slice(self, start: int, end: int) -> Dict[str, np.ndarray]:
+        """Returns views of every column for samples with start <= timestamp < end."""
+        first, last = self.range(start, end)
+        data = {name: column[first:last] for name, column in self.columns.items()}
+        data["brake_temps"] = self.brake_temps[first:last]
+        return data
+
+    @property
+    def nbytes(self) -> int:
+        return self.brake_temps.nbytes + sum(c.nbytes for c in self.columns.values())
+
+
+class SessionStore:
+    """
+    All telemetry of one session (a server run) in memory, per car, as
+    CarSeries columns. About 110 bytes per sample, so a 10 hour race day
+    at 10 Hz is roughly 40 MB per car.
+    """
+
+    def __init__(self, name: Optional[str] = None):
+        self.name = name or time.strftime("%Y%m%d-%H%M%S")
+        self.cars: Dict[str, CarSeries] = {}
+        self.out_of_order = 0
+
+    def add(self, uuid: str, vehicle: VehicleData):
+        """Stores a sample for a car."""
+        series = self.cars.get(uuid)
+        if series is None:
+            series = CarSeries()
+            self.cars[uuid] = series
+            logging.info(f"Session {self.name}: storing telemetry for {uuid}")
+        if not series.append(vehicle):
+            self.out_of_order += 1
+
+    def slice(
+        self, uuid: str, start: int, end: int
+    ) -> Optional[Dict[str, np.ndarray]]:
+        """Returns column views of a car's samples in a time range, None if unknown."""
+        series = self.cars.get(uuid)
+        if series is None:
+            return None
+        return series.slice(start, end)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "cars": len(self.cars),
+            "samples": sum(series.size for series in self.cars.values()),
+            "bytes": sum(series.nbytes for series in self.cars.values()),
+            "out_of_order": self.out_of_order,
+        }
+
+    async def handle(self, params: Dict[str, str]) -> Tuple[int, Dict]:
+        """
+        Serves a car's samples in a time range from memory, decimated evenly
+        to at most max_points.
+
+        GET /session?uuid=<uuid>&start=<us>&end=<us>&max_points=<n>
+        """
+        try:
+            uuid = params["uuid"]
+            start = int(params.get("start", 0))
+            end = int(params.get("end", 2**63 - 1))
+            max_points = max(1, int(params.get("max_points", 2000)))
+        except (KeyError, ValueError):
+            return 400, {
+                "error": "uuid must be given, start, end and max_points must be integers"
+            }
+
+        data = self.slice(uuid, start, end)
+        if data is None:
+            return 404, {"error": f"No data for {uuid}"}
+
+        count = len(data["timestamp"])
+        step = max(1, -(-count // max_points))
+        return 200, {
+            "uuid": uuid,
+            "session": self.name,
+            "samples": count,
+            "step": step,
+            "columns": {name: column[::step].tolist() for name, column in data.items()},
+        }
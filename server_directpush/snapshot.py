@@ -0,0 +1,82 @@
+import json
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from packet_parser import PacketData
+
+
+class SnapshotCache:
+    """
+    The latest update of every car, plus a short trail of positions, kept
+    ready as one serialized message for viewers that just connected.
+    Updating is O(updates) per tick. The message is only serialized when a
+    viewer connects after something changed, so a reconnect storm costs one
+    serialization per tick no matter how many viewers come back.
+    """
+
+    def __init__(self, trail_seconds: float = 10.0, max_age: float = 300.0):
+        """
+        Args:
+            trail_seconds: How much position history to keep per car
+            max_age: Leave out cars that haven't sent anything for this long (seconds)
+        """
+        self.trail_us = int(trail_seconds * 1000000)
+        self.max_age = max_age
+        self.latest: Dict[str, PacketData] = {}
+        self.last_seen: Dict[str, float] = {}
+        # uuid -> (timestamp, latitude, longitude), oldest first
+        self.trails: Dict[str, Deque[Tuple[int, float, float]]] = {}
+        self.blob: Optional[str] = None
+        self.builds = 0
+
+    def update(self, pending: Dict[str, PacketData], recovered: List[PacketData]):
+        """Adds a tick's updates. Recovered samples are older, so they go first."""
+        if not pending and not recovered:
+            return
+        now = time.monotonic()
+        for data in recovered:
+            self._add_to_trail(data)
+        for uuid, data in pending.items():
+            self._add_to_trail(data)
+            self.latest[uuid] = data
+            self.last_seen[uuid] = now
+        self.blob = None
+
+    def _add_to_trail(self, data: PacketData):
+        vehicle = data["vehicle"]
+        timestamp = vehicle["timestamp"]
+        trail = self.trails.get(data["uuid"])
+        if trail is None:
+            trail = deque()
+            self.trails[data["uuid"]] = trail
+        elif trail and timestamp <= trail[-1][0]:
+            return  # Already have it, or older than the newest point
+        trail.append((timestamp, vehicle["latitude"], vehicle["longitude"]))
+        oldest = timestamp - self.trail_us
+        while trail[0][0] < oldest:
+            trail.popleft()
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.max_age
+        for uuid in [uuid for uuid, seen in self.last_seen.items() if seen < cutoff]:
+            del self.latest[uuid]
+            del self.last_seen[uuid]
+            self.trails.pop(uuid, None)
+
+    def message(self) -> str:
+        """
+        Returns the snapshot message:
+        {"type": "snapshot", "cars": [{"uuid": ..., "vehicle": {...}}, ...],
+         "trails": {uuid: [[timestamp, latitude, longitude], ...]}}
+        """
+        if self.blob is None:
+            self._prune()
+            self.blob = json.dumps(
+                {
+                    "type": "snapshot",
+                    "cars": list(self.latest.values()),
+                    "trails": {uuid: list(trail) for uuid, trail in self.trails.items()},
+                }
+            )
+            self.builds += 1
+        return self.blob
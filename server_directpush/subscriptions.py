@@ -0,0 +1,240 @@
+import json
+import time
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+from packet_parser import PacketData
+
+# Fields a viewer can subscribe to, by group. The timestamp is always sent.
+FIELD_GROUPS: Dict[str, Tuple[str, ...]] = {
+    "position": ("latitude", "longitude", "heading", "speed"),
+    "engine": ("rpm", "coolant_temp", "oil_temp"),
+    "brakes": ("brake", "brake_temps"),
+    "driver": ("accelerator", "clutch", "heart_rate"),
+}
+
+# Fields sent with their min and max since the previous frame when a shape is
+# decimated, as <field>_min and <field>_max, so a short stab of the brake
+# between two frames isn't lost
+MINMAX_FIELDS = ("brake",)
+
+# Key of a subscription shape: (cars or None for all, fields or None for all, interval)
+ShapeKey = Tuple[Optional[FrozenSet[str]], Optional[Tuple[str, ...]], float]
+
+
+class Subscription:
+    """
+    What a viewer asked for: some or all cars, some or all field groups and a
+    max update rate. Viewers that ask for the same thing share a shape, which
+    is serialized once per frame for all of them.
+    """
+
+    __slots__ = ("cars", "groups", "fields", "interval")
+
+    def __init__(
+        self,
+        cars: Optional[FrozenSet[str]] = None,
+        groups: Optional[Tuple[str, ...]] = None,
+        interval: float = 0.0,
+    ):
+        self.cars = cars
+        self.groups = groups
+        self.fields: Optional[Tuple[str, ...]] = None
+        if groups is not None:
+            self.fields = ("timestamp",) + tuple(
+                field for group in groups for field in FIELD_GROUPS[group]
+            )
+        self.interval = interval
+
+    @property
+    def key(self) -> ShapeKey:
+        return self.cars, self.groups, self.interval
+
+    @classmethod
+    def parse(cls, message: Dict) -> "Subscription":
+        """
+        Reads a subscribe message:
+        {"type": "subscribe", "cars": [uuid, ...], "fields": [group, ...], "max_rate": hz}
+        Leaving out cars or fields means all of them, leaving out max_rate
+        means every frame.
+
+        Raises:
+            ValueError: If the message is not a valid subscription
+        """
+        cars = message.get("cars")
+        if cars is not None:
+            if not isinstance(cars, list) or not all(isinstance(c, str) for c in cars):
+                raise ValueError("cars must be a list of uuids")
+            cars = frozenset(car.lower() for car in cars)
+
+        groups = message.get("fields")
+        if groups is not None:
+            if not isinstance(groups, list) or not all(
+                g in FIELD_GROUPS for g in groups
+            ):
+                raise ValueError(f"fields must be a list of {', '.join(FIELD_GROUPS)}")
+            # Sorted, so the same groups in any order are the same shape
+            groups = tuple(sorted(set(groups)))
+
+        interval = 0.0
+        max_rate = message.get("max_rate")
+        if max_rate is not None:
+            if not isinstance(max_rate, (int, float)) or max_rate <= 0:
+                raise ValueError("max_rate must be a positive number (updates/s)")
+            interval = round(1.0 / max_rate, 3)
+
+        return cls(cars, groups, interval)
+
+    def describe(self) -> Dict:
+        """Returns the subscription as confirmed to the viewer."""
+        return {
+            "type": "subscribed",
+            "cars": sorted(self.cars) if self.cars is not None else None,
+            "fields": list(self.groups) if self.groups is not None else None,
+            "max_rate": round(1.0 / self.interval, 3) if self.interval else None,
+        }
+
+
+class Shape:
+    """The viewers sharing one subscription, and the updates collected for
+    them since their last frame."""
+
+    def __init__(self, subscription: Subscription):
+        self.subscription = subscription
+        self.writers: Set = set()
+        self.pending: Dict[str, PacketData] = {}
+        self.recovered: List[PacketData] = []
+        self.next_due = time.monotonic()
+        # Recovered samples only go to viewers that get the position
+        fields = subscription.fields
+        self.wants_recovered = fields is None or "latitude" in fields
+        # uuid -> [min, max] per MINMAX_FIELDS entry, for decimated shapes
+        self.minmax_fields = ()
+        if subscription.interval:
+            self.minmax_fields = tuple(
+                f for f in MINMAX_FIELDS if fields is None or f in fields
+            )
+        self.extremes: Dict[str, List[List[float]]] = {}
+
+    def collect(self, pending: Dict[str, PacketData], recovered: List[PacketData]):
+        cars = self.subscription.cars
+        if not self.wants_recovered:
+            recovered = []
+        if cars is None:
+            self.pending.update(pending)
+            self.recovered += recovered
+            collected = pending.keys()
+        else:
+            collected = cars & pending.keys()
+            for uuid in collected:
+                self.pending[uuid] = pending[uuid]
+            self.recovered += [data for data in recovered if data["uuid"] in cars]
+
+        if not self.minmax_fields:
+            return
+        for uuid in collected:
+            vehicle = pending[uuid]["vehicle"]
+            extremes = self.extremes.get(uuid)
+            if extremes is None:
+                self.extremes[uuid] = [
+                    [vehicle[f], vehicle[f]] for f in self.minmax_fields
+                ]
+                continue
+            for field, extreme in zip(self.minmax_fields, extremes):
+                value = vehicle[field]
+                if value < extreme[0]:
+                    extreme[0] = value
+                elif value > extreme[1]:
+                    extreme[1] = value
+
+    def with_extremes(self, uuid: str, data: PacketData, fields) -> PacketData:
+        """Returns the update with the min and max of MINMAX_FIELDS since the last frame."""
+        vehicle = data["vehicle"]
+        if fields is not None:
+            vehicle = {f: vehicle[f] for f in fields}
+        else:
+            vehicle = dict(vehicle)
+        for field, (low, high) in zip(self.minmax_fields, self.extremes.pop(uuid)):
+            vehicle[f"{field}_min"] = low
+            vehicle[f"{field}_max"] = high
+        return dict(data, vehicle=vehicle)
+
+
+class SubscriptionManager:
+    """
+    Keeps the subscription shapes of the viewers that sent a subscribe
+    message, and builds their frames. Per frame every shape is serialized
+    once, and a car's update with the same fields is serialized once for
+    all shapes that include it.
+    """
+
+    def __init__(self):
+        self.shapes: Dict[ShapeKey, Shape] = {}
+        self.by_writer: Dict[object, Shape] = {}
+
+    def subscribe(self, writer, subscription: Subscription):
+        """Moves a writer to the shape of its new subscription."""
+        self.unsubscribe(writer)
+        shape = self.shapes.get(subscription.key)
+        if shape is None:
+            shape = Shape(subscription)
+            self.shapes[subscription.key] = shape
+        shape.writers.add(writer)
+        self.by_writer[writer] = shape
+
+    def unsubscribe(self, writer):
+        shape = self.by_writer.pop(writer, None)
+        if shape is None:
+            return
+        shape.writers.discard(writer)
+        if not shape.writers:
+            del self.shapes[shape.subscription.key]
+
+    def is_subscribed(self, writer) -> bool:
+        return writer in self.by_writer
+
+    def deliver(self, pending: Dict[str, PacketData], recovered: List[PacketData]):
+        """Collects a tick's updates and pushes frames to the shapes that are due."""
+        if not self.shapes:
+            return
+        now = time.monotonic()
+        # (id of the update, fields) -> serialized update, shared by all shapes
+        fragments: Dict[Tuple[int, Optional[Tuple[str, ...]]], str] = {}
+
+        def serialize(data: PacketData, fields: Optional[Tuple[str, ...]]) -> str:
+            key = (id(data), fields)
+            fragment = fragments.get(key)
+            if fragment is None:
+                if fields is not None:
+                    vehicle = data["vehicle"]
+                    data = dict(data, vehicle={f: vehicle[f] for f in fields})
+                fragment = json.dumps(data)
+                fragments[key] = fragment
+            return fragment
+
+        for shape in self.shapes.values():
+            shape.collect(pending, recovered)
+            if not shape.pending and not shape.recovered:
+                continue
+            if now < shape.next_due:
+                continue
+            # On the tick grid, not drifting later with every frame
+            shape.next_due = max(shape.next_due + shape.subscription.interval, now)
+
+            fields = shape.subscription.fields
+            if shape.minmax_fields:
+                # Decimated, with per shape extremes so nothing to share
+                updates = {
+                    uuid: json.dumps(shape.with_extremes(uuid, data, fields))
+                    for uuid, data in shape.pending.items()
+                }
+            else:
+                updates = {
+                    uuid: serialize(data, fields) for uuid, data in shape.pending.items()
+                }
+            recovered_fragments = [serialize(data, fields) for data in shape.recovered]
+            shape.pending = {}
+            shape.recovered = []
+
+            fragments_out = recovered_fragments + list(updates.values())
+            frame = "[" + ",".join(fragments_out) + "]"
+            for writer in shape.writers:
+                writer.push(frame, updates, recovered_fragments)
@@ -0,0 +1,63 @@
+import asyncio
+import contextlib
+import io
+import json
+from car_simulator import CarSimulator
+from packet_parser import V0_SLOT_US
+from udp_handler import UDPHandler
+from websocket_handler import DROP_POLICIES, ClientWriter, WebSocketServer
+
+ADDR = ("127.0.0.1", 40000)
+MISSING = 6  # Packets lost between the two that arrive
+
+
+class FakeWebSocket:
+    remote_address = ADDR
+
+
+def received_samples(policy: str):
+    """
+    Sends a car's packets with MISSING of them lost to a server with one JSON
+    viewer on the drop policy, and returns the samples in the viewer's frames.
+    """
+    server = WebSocketServer(host="127.0.0.1", port=0, client_policy=policy)
+    writer = ClientWriter(FakeWebSocket(), policy=policy)
+    server.clients[writer.websocket] = writer
+    handler = UDPHandler()
+    handler.set_websocket_server(server)
+    with contextlib.redirect_stdout(io.StringIO()):
+        car = CarSimulator(uuid_seed="gap-recovery")
+
+    async def run():
+        await handler.process_datagram(bytes([0xFF]) + car.car_uuid, ADDR)
+        for index in (0, MISSING + 1):
+            car.update_car_state()
+            car.timestamp = 1700000000000000 + index * V0_SLOT_US
+            await handler.process_datagram(car.build_telemetry_packet(), ADDR)
+            server.broadcast_frame()
+
+    asyncio.run(run())
+    samples = []
+    frame = writer._pop_frame()
+    while frame is not None:
+        samples.extend(json.loads(frame))
+        frame = writer._pop_frame()
+    return samples
+
+
+def test_gap_recovery_with_every_drop_policy():
+    for policy in DROP_POLICIES:
+        samples = received_samples(policy)
+        recovered = [sample for sample in samples if sample.get("recovered")]
+        live = [sample for sample in samples if not sample.get("recovered")]
+        assert len(recovered) == MISSING, policy
+        assert len(live) >= 1, policy
+        timestamps = [sample["vehicle"]["timestamp"] for sample in recovered]
+        assert timestamps == sorted(timestamps), policy
+        # Recovered samples come ahead of the live update they were taken from
+        assert samples.index(recovered[-1]) < samples.index(live[-1]), policy
+
+
+if __name__ == "__main__":
+    test_gap_recovery_with_every_drop_policy()
+    print("ok")
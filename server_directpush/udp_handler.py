@@ -1,8 +1,11 @@
 import asyncio
 import logging
-import json
+import time
 from typing import Dict, List, Tuple
-from packet_parser import PacketParser, VehicleData, PacketData
+from packet_parser import PacketParser, VehicleData, PacketData, V0_SLOT_US
+from metrics import Histogram
+from async_logging import RateLimitedLog
+from sender_table import SenderTable
 
 # Configure logging
 logging.basicConfig(
@@ -22,9 +25,9 @@ class UDPServerProtocol(asyncio.DatagramProtocol):
 
     def datagram_received(self, data: bytes, addr: Tuple[str, int]):
         """Handles incoming datagrams."""
-        # Use asyncio.create_task to handle processing asynchronously
-        # without blocking the datagram_received method.
-        asyncio.create_task(self.handler.process_datagram(data, addr))
+        # Only queue the datagram here, the handler's ingest loop drains the
+        # queue in batches so bursts don't turn into one task per packet.
+        self.handler.enqueue_datagram(data, addr)
 
     def error_received(self, exc: Exception):
         logging.error(f"UDP Error received: {exc}")
@@ -35,29 +38,92 @@ class UDPServerProtocol(asyncio.DatagramProtocol):
 
 # --- UDP Handler Class ---
 class UDPHandler:
-    def __init__(self):
-        self.last_timestamp: Dict[Tuple[str, int], int] = (
-            {}
-        )  # Store last timestamp per client
-        self.authenticated_clients: Dict[Tuple[str, int], str] = {}
+    def __init__(
+        self,
+        ingest_queue_size=10000,
+        ingest_batch_size=256,
+        recover_gaps=True,
+        sender_timeout=60.0,
+    ):
+        # Authenticated cars by address and UUID, with their last timestamp.
+        # Cars that send nothing for sender_timeout seconds are forgotten.
+        self.senders = SenderTable(idle_timeout=sender_timeout)
+        self.expiry_task = None
         self.websocket_server = None  # Initialize websocket_server attribute
+        self.db_writer = None  # Optional TelemetryWriter for the history database
+        self.segment_log = None  # Optional SegmentLog recording raw datagrams
+        self.session_store = None  # Optional SessionStore keeping the session in memory
+        self.lap_timer = None  # Optional LapTimer timing laps and sectors
         self.udp_transport = None  # Keep track of the UDP transport
 
+        # Bounded ingest queue between the datagram protocol and the ingest loop.
+        # When it is full new datagrams are dropped and counted instead of
+        # piling up as pending tasks.
+        self.ingest_queue: asyncio.Queue = asyncio.Queue(maxsize=ingest_queue_size)
+        self.ingest_batch_size = ingest_batch_size
+        self.ingest_task = None
+        self.dropped_datagrams = 0
+        self.max_batch_seen = 0
+
+        # Fill the 100 ms slots of lost packets from the position history
+        # of the next packet that arrives
+        self.recover_gaps = recover_gaps
+        self.recovered_samples = 0
+        self.unrecovered_slots = 0
+
+        # Per-packet messages, at most one line per second per sender
+        self.packet_log = RateLimitedLog()
+
+        # Per-stage latency, exported by the MetricsServer
+        self.receive_seconds = Histogram(
+            "udp_receive_seconds", "Time datagrams wait in the ingest queue"
+        )
+        self.auth_seconds = Histogram(
+            "udp_auth_seconds", "Time to look up the sender of a data packet"
+        )
+        self.parse_seconds = Histogram(
+            "udp_parse_seconds", "Time to parse a data packet"
+        )
+
     # Method to set WebSocket server instance
     def set_websocket_server(self, ws_server):
         self.websocket_server = ws_server
         logging.info("WebSocket server instance set in UDPHandler")
 
-    async def start_server(self, host="127.0.0.1", port=5005):
-        """Starts the UDP server."""
+    # Method to set the database writer instance
+    def set_database_writer(self, db_writer):
+        self.db_writer = db_writer
+        logging.info("Database writer instance set in UDPHandler")
+
+    # Method to set the segment log for recording raw datagrams
+    def set_segment_log(self, segment_log):
+        self.segment_log = segment_log
+        logging.info("Segment log instance set in UDPHandler")
+
+    # Method to set the in-memory session store
+    def set_session_store(self, session_store):
+        self.session_store = session_store
+        logging.info("Session store instance set in UDPHandler")
+
+    def set_lap_timer(self, lap_timer):
+        self.lap_timer = lap_timer
+        logging.info("Lap timer instance set in UDPHandler")
+
+    async def start_server(self, host="127.0.0.1", port=5005, reuse_port=False):
+        """Starts the UDP server. With reuse_port several processes can bind the
+        same port, and the kernel spreads the senders over them."""
         loop = asyncio.get_running_loop()
         logging.info(f"Starting UDP server on {host}:{port}")
         try:
             # Create the datagram endpoint and store the transport
             transport, protocol = await loop.create_datagram_endpoint(
-                lambda: UDPServerProtocol(self), local_addr=(host, port)
+                lambda: UDPServerProtocol(self),
+                local_addr=(host, port),
+                reuse_port=reuse_port,
             )
             self.udp_transport = transport  # Store the transport
+            self.ingest_task = asyncio.create_task(self._ingest_loop())
+            self.expiry_task = asyncio.create_task(self._expiry_loop())
             logging.info("UDP server running.")
             # Removed await asyncio.Future() to allow concurrent execution
         except OSError as e:
@@ -73,70 +139,228 @@ class UDPHandler:
             logging.info("Stopping UDP server...")
             self.udp_transport.close()
             self.udp_transport = None
+            if self.ingest_task:
+                self.ingest_task.cancel()
+                self.ingest_task = None
+            if self.expiry_task:
+                self.expiry_task.cancel()
+                self.expiry_task = None
             logging.info("UDP server stopped.")
         else:
             logging.info("UDP server is not running.")
 
+    def enqueue_datagram(self, data: bytes, addr: Tuple[str, int]):
+        """Queues a received datagram for the ingest loop, dropping it if the queue is full."""
+        if self.segment_log:
+            self.segment_log.append(data, addr, self.senders.uuid(addr))
+        try:
+            self.ingest_queue.put_nowait((data, addr, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.dropped_datagrams += 1
+            if self.dropped_datagrams % 1000 == 1:
+                logging.warning(
+                    f"Ingest queue full ({self.ingest_queue.qsize()} datagrams), "
+                    f"{self.dropped_datagrams} datagrams dropped so far"
+                )
+
+    def ingest_stats(self) -> Dict[str, int]:
+        """Returns the current ingest queue depth and drop counters."""
+        return {
+            "queue_depth": self.ingest_queue.qsize(),
+            "queue_size": self.ingest_queue.maxsize,
+            "dropped_datagrams": self.dropped_datagrams,
+            "max_batch_seen": self.max_batch_seen,
+            "recovered_samples": self.recovered_samples,
+            "unrecovered_slots": self.unrecovered_slots,
+            "senders": len(self.senders),
+            "evicted_senders": self.senders.evicted,
+            "rebound_senders": self.senders.rebound,
+        }
+
+    def histograms(self) -> List[Histogram]:
+        return [self.receive_seconds, self.auth_seconds, self.parse_seconds]
+
+    async def _expiry_loop(self):
+        """Forgets cars that stopped sending, one timer wheel tick at a time."""
+        while True:
+            await asyncio.sleep(self.senders.tick)
+            for session in self.senders.expire():
+                logging.info(
+                    f"Forgot {session.addr} (UUID: {session.uuid}), "
+                    f"idle for {self.senders.idle_timeout:.0f} seconds"
+                )
+
+    async def _ingest_loop(self):
+        """Drains the ingest queue, processing everything that is ready in one batch per loop tick."""
+        queue = self.ingest_queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.ingest_batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            if len(batch) > self.max_batch_seen:
+                self.max_batch_seen = len(batch)
+
+            now = time.perf_counter()
+            for data, addr, received in batch:
+                self.receive_seconds.observe(now - received)
+                try:
+                    await self.process_datagram(data, addr)
+                except Exception as e:
+                    logging.error(f"Error processing datagram from {addr}: {e}")
+
+            # Give the rest of the event loop a turn before the next batch
+            await asyncio.sleep(0)
+
     async def process_datagram(self, data: bytes, addr: Tuple[str, int]):
         """Processes a received datagram after basic validation."""
         if not data:
-            logging.warning(f"Received empty packet from {addr}")
+            self.packet_log.log(
+                ("empty", addr), logging.WARNING, "Received empty packet from %s", addr
+            )
             return
 
-        logging.debug("Received packet from {addr}")
+        logging.debug("Received packet from %s", addr)
 
         packet_type = data[0]
-        payload = data[1:]
+        # View past the type byte without copying the datagram
+        payload = memoryview(data)[1:]
 
         if packet_type == 0xFF:  # Authentication packet
             await self._handle_auth_packet(payload, addr)
         elif packet_type == 0x00:  # Data packet (version 0)
             await self._handle_data_packet(payload, addr)
         else:
-            logging.warning(
-                f"Received unknown packet type {packet_type:#04x} from {addr}"
+            self.packet_log.log(
+                ("unknown", addr),
+                logging.WARNING,
+                "Received unknown packet type %#04x from %s",
+                packet_type,
+                addr,
             )
 
     async def _handle_auth_packet(self, payload: bytes, addr: Tuple[str, int]):
         """Handles authentication packets."""
         uuid = PacketParser.parse_auth_packet(payload)
         if uuid:
-            self.authenticated_clients[addr] = uuid
-            logging.info(f"Client {addr} authenticated with UUID: {uuid}")
-            # Initialize last timestamp for this client
-            self.last_timestamp[addr] = 0
+            # Cars repeat their auth packet every 10 seconds, only new bindings
+            # are logged. A car from a new address keeps its last timestamp.
+            _, new = self.senders.authenticate(addr, uuid)
+            if new:
+                logging.info(f"Client {addr} authenticated with UUID: {uuid}")
         else:
             logging.warning(f"Authentication failed for client {addr}")
 
+    def _recover_gap(
+        self, payload: bytes, vehicle_data: VehicleData, last_ts: int
+    ) -> List[VehicleData]:
+        """
+        Recovers the samples of packets lost since the previous packet from the
+        position history of this one.
+
+        The last timestamp of a car is its slot index: the slots missing since
+        then map straight to history records, so nothing is searched or sorted.
+        Only position and RPM are in the history, the other fields are taken
+        from the current packet.
+
+        Args:
+            payload: The data packet payload
+            vehicle_data: The parsed current sample of the packet
+            last_ts: Timestamp of the previous packet from this car
+
+        Returns:
+            The recovered samples, oldest first
+        """
+        # Packets are V0_SLOT_US apart, rounded to allow for clock jitter
+        elapsed = vehicle_data["timestamp"] - last_ts
+        missing = (elapsed + V0_SLOT_US // 2) // V0_SLOT_US - 1
+        if missing <= 0:
+            return []
+        available = PacketParser.position_record_count(payload) - 1
+        if missing > available:
+            self.unrecovered_slots += missing - available
+            missing = available
+
+        samples = []
+        for index in range(missing, 0, -1):
+            latitude, longitude, rpm = PacketParser.parse_position_record(payload, index)
+            sample = vehicle_data.copy()
+            sample["timestamp"] = vehicle_data["timestamp"] - index * V0_SLOT_US
+            sample["latitude"] = latitude
+            sample["longitude"] = longitude
+            sample["rpm"] = rpm
+            samples.append(sample)
+        self.recovered_samples += len(samples)
+        return samples
+
+    def _time_sample(self, uuid: str, vehicle_data: VehicleData):
+        for event in self.lap_timer.add(uuid, vehicle_data):
+            if event["type"] == "lap":
+                logging.info(
+                    f"Car {uuid} lap {event['lap']}: {event['time_ms'] / 1000:.3f} s"
+                )
+            if self.websocket_server:
+                self.websocket_server.publish_event(event)
+
     async def _handle_data_packet(self, payload: bytes, addr: Tuple[str, int]):
         """Handles data packets (protocol v0)."""
-        if addr not in self.authenticated_clients:
-            logging.warning(f"Received data packet from unauthenticated client {addr}")
+        started = time.perf_counter()
+        session = self.senders.get(addr)
+        if session is None:
+            self.packet_log.log(
+                ("unauthenticated", addr),
+                logging.WARNING,
+                "Received data packet from unauthenticated client %s",
+                addr,
+            )
             return  # Ignore unauthenticated clients
 
-        last_ts = self.last_timestamp.get(addr, 0)
+        last_ts = session.last_timestamp
+        looked_up = time.perf_counter()
+        self.auth_seconds.observe(looked_up - started)
         parsed_data = PacketParser.parse_data_packet(payload, True, last_ts)
+        self.parse_seconds.observe(time.perf_counter() - looked_up)
 
         if not parsed_data:
             return  # Parsing failed or old packet
 
         timestamp, vehicle_data = parsed_data
-        self.last_timestamp[addr] = timestamp
+        session.last_timestamp = timestamp
+        uuid = session.uuid
+
+        logging.debug("Received Vehicle Data from %s: %s", addr, vehicle_data)
 
-        logging.debug(f"Received Vehicle Data from {addr}: {vehicle_data}")
+        # Samples for the slots since the previous packet come first
+        recovered_samples = []
+        if self.recover_gaps and last_ts and (self.websocket_server or self.lap_timer):
+            recovered_samples = self._recover_gap(payload, vehicle_data, last_ts)
 
         # --- Process or Broadcast Data ---
         # 1. Send data to the WebSocket clients
         if self.websocket_server:
+            for recovered in recovered_samples:
+                self.websocket_server.publish(
+                    {"uuid": uuid, "vehicle": recovered, "recovered": True}
+                )
             # Create the packet data structure
-            full_data: PacketData = {
-                "uuid": self.authenticated_clients[addr],
-                "vehicle": vehicle_data,
-            }
-            # Use create_task to avoid blocking datagram processing while broadcasting
-            asyncio.create_task(self.websocket_server.broadcast(json.dumps(full_data)))
-        # 2. Insert data into a database (Placeholder)
-        # await self.insert_into_db(vehicle_data)
-        logging.info(
-            f"Successfully processed data packet from {addr} (UUID: {self.authenticated_clients.get(addr, 'N/A')}) with timestamp {timestamp}"
+            full_data: PacketData = {"uuid": uuid, "vehicle": vehicle_data}
+            # Queued for the next broadcast tick, sending happens elsewhere
+            self.websocket_server.publish(full_data)
+        # 2. Queue data for the database, written in batches elsewhere
+        if self.db_writer:
+            self.db_writer.write(uuid, vehicle_data)
+        # 3. Keep the sample in the in-memory session store
+        if self.session_store:
+            self.session_store.add(uuid, vehicle_data)
+        # 4. Time laps and sectors, the recovered positions fill in the line crossings
+        if self.lap_timer:
+            for sample in recovered_samples:
+                self._time_sample(uuid, sample)
+            self._time_sample(uuid, vehicle_data)
+        self.packet_log.log(
+            addr,
+            logging.INFO,
+            "Processed data packets from %s (UUID: %s), latest timestamp %d",
+            addr,
+            uuid,
+            timestamp,
         )
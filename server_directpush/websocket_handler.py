@@ -1,43 +1,664 @@
 import asyncio
 import json
 import websockets
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 import logging
 import ssl
-from typing import Set
+import time
+from collections import deque
+from http import HTTPStatus
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit, parse_qsl
+from websockets.datastructures import Headers
+from websockets.http11 import Response
+from packet_parser import PacketData
+from delta_encoder import DeltaEncoder, DELTA_SUBPROTOCOL, SCHEMA
+from subscriptions import Subscription, SubscriptionManager
+from snapshot import SnapshotCache
+from metrics import Histogram
+
+
+# What a ClientWriter does when its viewer can't keep up
+DROP_OLDEST = "drop_oldest"  # Drop the oldest queued frame
+LATEST_PER_CAR = "latest_per_car"  # Merge unsent frames, keeping the newest update per car
+DISCONNECT = "disconnect"  # Drop the oldest frame, disconnect if lagging for too long
+DROP_POLICIES = (DROP_OLDEST, LATEST_PER_CAR, DISCONNECT)
+
+# Adaptive update rate of JSON viewers: a viewer with more than this many bytes
+# in its send buffer, or more than one frame queued, is congested and gets half
+# the rate, at most RATE_LEVELS times. After RATE_RECOVERY seconds without
+# congestion it goes back up a level.
+CONGESTED_BYTES = 64 * 1024
+RATE_LEVELS = 4
+RATE_RECOVERY = 5.0
+
+# Recovered samples kept for a LATEST_PER_CAR viewer until its next frame, ten
+# packets' worth of position history. They can't be merged like live updates.
+MAX_MERGED_RECOVERED = 400
+
+# Replies and lap events waiting for a viewer. These can't be dropped, so a
+# viewer that lets this many pile up is disconnected whatever its policy.
+MAX_CONTROL_MESSAGES = 1000
+
+
+class ClientWriter:
+    """
+    Outbound side of a single viewer connection.
+    Frames are queued in a bounded queue and sent by the writer's own task,
+    so a slow client only ever delays itself. What happens when the client
+    falls behind is decided by the drop policy.
+    """
+
+    def __init__(
+        self,
+        websocket,
+        queue_size: int = 10,
+        policy: str = DROP_OLDEST,
+        lag_timeout: float = 10.0,
+    ):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy {policy}")
+        self.websocket = websocket
+        self.policy = policy
+        self.lag_timeout = lag_timeout
+        self.queue: deque = deque(maxlen=queue_size)
+        self.latest: Dict[str, str] = {}  # uuid -> serialized update, for LATEST_PER_CAR
+        self.latest_frames = 0  # Frames merged into self.latest since it was sent
+        # Serialized recovered samples for LATEST_PER_CAR, sent ahead of self.latest
+        self.latest_recovered: deque = deque(maxlen=MAX_MERGED_RECOVERED)
+        self.control: deque = deque()  # Replies to the viewer, sent ahead of frames
+        # Adaptive rate: the subscription the viewer asked for (None for everything),
+        # and how many times its rate has been halved because it was congested
+        self.requested = None
+        self.rate_level = 0
+        self.calm_since = time.monotonic()
+        self.ready = asyncio.Event()
+        self.lagging_since = None  # Monotonic time the client first fell behind
+        self.closing = False
+        self.dropped_frames = 0
+        self.sent_frames = 0
+        self.send_seconds: Optional[Histogram] = None  # Set by the server
+
+    def pending(self) -> int:
+        """Returns the number of frames waiting to be sent, including merged ones."""
+        if self.policy == LATEST_PER_CAR:
+            return self.latest_frames
+        return len(self.queue)
+
+    def push(self, frame: str, updates: Dict[str, str], recovered: Sequence[str] = ()):
+        """
+        Queues a frame for sending.
+
+        Args:
+            frame: The serialized frame
+            updates: The same frame as serialized updates per car uuid
+            recovered: The recovered samples of the frame, serialized, which
+                LATEST_PER_CAR keeps as they are
+        """
+        if self.closing:
+            return
+
+        if self.policy == LATEST_PER_CAR:
+            if not updates and not recovered:
+                return  # Nothing to merge, and no frame to count
+            if self.latest or self.latest_recovered:
+                # The previous frame hasn't gone out yet, newer updates replace it
+                self.dropped_frames += 1
+                self._lagging()
+            self.latest.update(updates)
+            self.latest_recovered.extend(recovered)
+            self.latest_frames += 1
+        else:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped_frames += 1
+                self._lagging()
+            self.queue.append(frame)
+        self.ready.set()
+
+    def congested(self) -> bool:
+        """Whether frames are piling up for this viewer, in the queue or the socket."""
+        if self.pending() > 1:
+            return True
+        transport = getattr(self.websocket, "transport", None)
+        if transport is None:
+            return False
+        return transport.get_write_buffer_size() > CONGESTED_BYTES
+
+    def send_control(self, message: str):
+        """
+        Queues a reply to the viewer, which is never dropped. A viewer with
+        MAX_CONTROL_MESSAGES replies unsent is disconnected instead.
+        """
+        if self.closing:
+            return
+        if len(self.control) >= MAX_CONTROL_MESSAGES:
+            self.dropped_frames += 1
+            logging.warning(
+                f"Disconnecting {self.websocket.remote_address}, "
+                f"{len(self.control)} replies unsent"
+            )
+            self._disconnect()
+            return
+        self.control.append(message)
+        self.ready.set()
+
+    def _lagging(self):
+        """Records that the client is behind, and disconnects it if the policy says so."""
+        now = time.monotonic()
+        if self.lagging_since is None:
+            self.lagging_since = now
+        elif self.policy == DISCONNECT and now - self.lagging_since > self.lag_timeout:
+            logging.warning(
+                f"Disconnecting {self.websocket.remote_address}, "
+                f"lagging for more than {self.lag_timeout} seconds"
+            )
+            self._disconnect()
+
+    def _disconnect(self):
+        self.closing = True
+        self.queue.clear()
+        self.control.clear()
+        asyncio.create_task(self.websocket.close(1008, "Client too slow"))
+
+    def _next_frame(self):
+        if self.policy == LATEST_PER_CAR:
+            if not self.latest and not self.latest_recovered:
+                self.latest_frames = 0
+                return None
+            # Recovered samples are older than the live updates, so they go first
+            fragments = [*self.latest_recovered, *self.latest.values()]
+            frame = "[" + ",".join(fragments) + "]"
+            self.latest = {}
+            self.latest_recovered.clear()
+            self.latest_frames = 0
+            return frame
+        if not self.queue:
+            return None
+        return self.queue.popleft()
+
+    def _pop_frame(self):
+        if self.control:
+            return self.control.popleft()
+        return self._next_frame()
+
+    async def run(self):
+        """Sends queued frames until the connection closes."""
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            frame = self._pop_frame()
+            while frame is not None:
+                started = time.perf_counter()
+                await self.websocket.send(frame)
+                if self.send_seconds:
+                    self.send_seconds.observe(time.perf_counter() - started)
+                self.sent_frames += 1
+                frame = self._pop_frame()
+            # Caught up with everything that was queued
+            self.lagging_since = None
+
+
+class DeltaClientWriter(ClientWriter):
+    """
+    Writer for viewers on the delta encoded binary format.
+    Delta frames only make sense in sequence, so instead of dropping single
+    frames a lagging viewer gets its queue replaced by the current keyframe.
+    """
+
+    def __init__(
+        self,
+        websocket,
+        encoder: DeltaEncoder,
+        queue_size: int = 10,
+        policy: str = DROP_OLDEST,
+        lag_timeout: float = 10.0,
+    ):
+        super().__init__(websocket, queue_size, policy, lag_timeout)
+        self.encoder = encoder
+
+    def pending(self) -> int:
+        return len(self.queue)
+
+    def push_delta(self, frame: bytes):
+        """Queues a delta frame, or resyncs with a keyframe if the viewer is behind."""
+        if self.closing:
+            return
+
+        behind = len(self.queue) == self.queue.maxlen
+        if self.policy == LATEST_PER_CAR:
+            behind = len(self.queue) > 0
+        if behind:
+            self.dropped_frames += len(self.queue)
+            self.queue.clear()
+            self._lagging()
+            if self.closing:
+                return
+            frame = self.encoder.keyframe()
+        self.queue.append(frame)
+        self.ready.set()
+
+    def _next_frame(self):
+        if not self.queue:
+            return None
+        return self.queue.popleft()
+
+
+def deflate_extension(
+    window_bits: int = 12,
+    mem_level: int = 5,
+    level: int = 6,
+    no_context_takeover: bool = False,
+) -> ServerPerMessageDeflateFactory:
+    """
+    Builds the permessage-deflate settings for the server.
+
+    Args:
+        window_bits: Server LZ77 window, 9-15. Larger finds more repetition between frames
+        mem_level: zlib memLevel, 1-9. Memory for the compressor's hash table
+        level: zlib compression level, 1 (fastest) - 9 (smallest)
+        no_context_takeover: Reset the compressor after every frame. Saves the
+            window memory for idle connections, at the cost of compression ratio
+
+    Returns:
+        Extension factory to pass to websockets.serve
+    """
+    return ServerPerMessageDeflateFactory(
+        server_no_context_takeover=no_context_takeover,
+        server_max_window_bits=window_bits,
+        client_max_window_bits=window_bits,
+        compress_settings={"memLevel": mem_level, "level": level},
+    )
 
 
 class WebSocketServer:
-    def __init__(self, host, port):
+    def __init__(
+        self,
+        host,
+        port,
+        tick_interval=0.1,
+        client_queue_size=10,
+        client_policy=DROP_OLDEST,
+        lag_timeout=10.0,
+        compression=True,
+        deflate: Optional[ServerPerMessageDeflateFactory] = None,
+        snapshot_trail=10.0,
+    ):
         self.host = host
         self.port = port
-        self.clients = set()
+        self.clients: Dict[object, ClientWriter] = {}
         self.server_instance = None  # Keep track of the server instance
+        # permessage-deflate settings, the defaults unless tuned
+        self.deflate = (deflate or deflate_extension()) if compression else None
+
+        # Car updates are collected here and sent as one frame per tick
+        self.tick_interval = tick_interval
+        self.client_queue_size = client_queue_size
+        self.client_policy = client_policy
+        self.lag_timeout = lag_timeout
+        self.pending: Dict[str, PacketData] = {}
+        # Samples recovered from position history, all sent in order ahead of
+        # the live updates of the same tick
+        self.recovered: List[PacketData] = []
+        # Lap and sector events, sent to JSON viewers with the next frame
+        self.events: List[Dict] = []
+        self.broadcast_task = None
+        self.delta_encoder = DeltaEncoder()
+        # Optional FrameBus that also sends every serialized frame to fan-out workers
+        self.frame_bus = None
+        # Optional JitterBuffer holding updates back until their playout time
+        self.jitter_buffer = None
+        # Viewers that asked for some cars or fields only, by subscription shape
+        self.subscriptions = SubscriptionManager()
+        # Current state and position trails, sent to viewers when they connect
+        self.snapshot = SnapshotCache(trail_seconds=snapshot_trail)
+
+        self.adapt_task = None
+
+        # Plain HTTP endpoints served on the WebSocket port, by path
+        self.http_routes: Dict[
+            str, Callable[[Dict[str, str]], Awaitable[Tuple[int, Dict]]]
+        ] = {}
+
+        # Counters for clients that have disconnected, live ones are in self.clients
+        self.dropped_frames_total = 0
+        self.lag_disconnects = 0
+
+        # Per-stage latency, exported by the MetricsServer
+        self.serialize_seconds = Histogram(
+            "ws_serialize_seconds", "Time to serialize a broadcast frame, JSON and delta"
+        )
+        self.deliver_seconds = Histogram(
+            "ws_deliver_seconds", "Time to hand a frame to every viewer's writer"
+        )
+        self.send_seconds = Histogram(
+            "ws_send_seconds", "Time to send a frame to one viewer"
+        )
 
-    async def broadcast(self, message):
-        if self.clients:
-            await asyncio.wait(
-                [asyncio.create_task(client.send(message)) for client in self.clients]
+    def client_stats(self) -> Dict[str, int]:
+        """Returns client counts, frames waiting to be sent and dropped frame counters."""
+        writers = self.clients.values()
+        return {
+            "clients": len(self.clients),
+            "pending_frames": sum(writer.pending() for writer in writers),
+            "dropped_frames": self.dropped_frames_total
+            + sum(writer.dropped_frames for writer in writers),
+            "lag_disconnects": self.lag_disconnects,
+        }
+
+    def histograms(self) -> List[Histogram]:
+        return [self.serialize_seconds, self.deliver_seconds, self.send_seconds]
+
+    def publish(self, data: PacketData):
+        """Queues a car update for the next broadcast tick, or for the tick
+        at its playout time with a jitter buffer."""
+        if self.jitter_buffer:
+            self.jitter_buffer.add(data)
+            return
+        self._queue(data)
+
+    def publish_event(self, event: Dict):
+        """Queues a timing event, such as a completed lap, for the next broadcast tick."""
+        self.events.append(event)
+
+    def _queue(self, data: PacketData):
+        """Only the newest update per car is kept within a tick, except for
+        recovered samples, which are all kept."""
+        if data.get("recovered"):
+            self.recovered.append(data)
+            return
+        self.pending[data["uuid"]] = data
+
+    def broadcast_frame(self):
+        """Serializes all pending car updates into one frame and hands it to every client."""
+        if self.jitter_buffer:
+            for data in self.jitter_buffer.release():
+                self._queue(data)
+        if not self.pending and not self.recovered and not self.events:
+            return
+        pending = self.pending
+        self.pending = {}
+        recovered = self.recovered
+        self.recovered = []
+        events = [json.dumps(event) for event in self.events]
+        self.events = []
+
+        # Always encoded, so the keyframe for newly connected delta viewers is current.
+        # The delta format only carries the live state, not recovered samples.
+        started = time.perf_counter()
+        delta_frame = None
+        if pending:
+            delta_frame = self.delta_encoder.encode(
+                {uuid: data["vehicle"] for uuid, data in pending.items()}
+            )
+        if not self.clients and not self.frame_bus:
+            self.snapshot.update(pending, recovered)
+            return
+
+        # Serialize once, every client without a subscription gets the same strings
+        frame, updates = None, None
+        if (pending or recovered) and (
+            self.frame_bus
+            or any(
+                not isinstance(writer, DeltaClientWriter)
+                and not self.subscriptions.is_subscribed(writer)
+                for writer in self.clients.values()
             )
+        ):
+            updates = {uuid: json.dumps(data) for uuid, data in pending.items()}
+            # Recovered samples are older than the live updates, so they go first
+            fragments = [json.dumps(data) for data in recovered]
+            frame = "[" + ",".join(fragments + list(updates.values())) + "]"
+        self.serialize_seconds.observe(time.perf_counter() - started)
+        if self.frame_bus:
+            self.frame_bus.publish(
+                frame,
+                updates,
+                delta_frame,
+                self.delta_encoder.keyframe(),
+                pending,
+                recovered,
+                events,
+            )
+        self.deliver(frame, updates, delta_frame, pending, recovered, events)
+
+    def deliver(
+        self,
+        frame: Optional[str],
+        updates: Optional[Dict[str, str]],
+        delta_frame: Optional[bytes],
+        pending: Dict[str, PacketData],
+        recovered: List[PacketData],
+        events: Sequence[str] = (),
+    ):
+        """
+        Hands serialized frames to the writers of the connected clients.
+
+        Args:
+            frame: The JSON frame for viewers without a subscription
+            updates: The same frame as serialized updates per car uuid
+            delta_frame: The frame for delta viewers, None if there is none this tick
+            pending: The live updates, for the subscription frames
+            recovered: The recovered samples, for the subscription frames
+            events: Serialized timing events, sent to every JSON viewer ahead
+                of the frame and never dropped
+        """
+        started = time.perf_counter()
+        self.snapshot.update(pending, recovered)
+        subscriptions = self.subscriptions
+        # LATEST_PER_CAR viewers merge the live updates, the recovered samples
+        # are kept separately
+        fragments = ()
+        if recovered and self.client_policy == LATEST_PER_CAR:
+            fragments = [json.dumps(data) for data in recovered]
+        for writer in self.clients.values():
+            if isinstance(writer, DeltaClientWriter):
+                if delta_frame is not None:
+                    writer.push_delta(delta_frame)
+                continue
+            for event in events:
+                writer.send_control(event)
+            if frame is not None and not subscriptions.is_subscribed(writer):
+                writer.push(frame, updates, fragments)
+        subscriptions.deliver(pending, recovered)
+        self.deliver_seconds.observe(time.perf_counter() - started)
+
+    def apply_rate(self, writer: ClientWriter) -> float:
+        """
+        Subscribes a JSON viewer to what it asked for, at its adaptive rate.
+
+        Returns:
+            The max updates per second the viewer gets now
+        """
+        requested = writer.requested or Subscription()
+        interval = max(requested.interval, self.tick_interval) * 2**writer.rate_level
+        if writer.rate_level == 0 and writer.requested is None:
+            self.subscriptions.unsubscribe(writer)
+        elif writer.rate_level == 0:
+            self.subscriptions.subscribe(writer, requested)
+        else:
+            self.subscriptions.subscribe(
+                writer,
+                Subscription(requested.cars, requested.groups, round(interval, 3)),
+            )
+        return round(1.0 / interval, 3)
+
+    def adapt_rates(self):
+        """Halves the rate of congested JSON viewers, and raises it again once they keep up."""
+        now = time.monotonic()
+        for writer in self.clients.values():
+            if isinstance(writer, DeltaClientWriter) or writer.closing:
+                continue
+            level = writer.rate_level
+            if writer.congested():
+                writer.calm_since = now
+                if level < RATE_LEVELS:
+                    writer.rate_level += 1
+            elif level > 0 and now - writer.calm_since >= RATE_RECOVERY:
+                writer.calm_since = now
+                writer.rate_level -= 1
+            if writer.rate_level != level:
+                rate = self.apply_rate(writer)
+                writer.send_control(json.dumps({"type": "rate", "max_rate": rate}))
+
+    async def _adapt_loop(self):
+        while True:
+            await asyncio.sleep(1.0)
+            try:
+                self.adapt_rates()
+            except Exception as e:
+                logging.error(f"Error adapting viewer rates: {e}")
+
+    async def _broadcast_loop(self):
+        """Sends a frame every tick_interval seconds, without drifting."""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.tick_interval
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            try:
+                self.broadcast_frame()
+            except Exception as e:
+                logging.error(f"Error broadcasting frame: {e}")
+
+    def add_http_route(
+        self, path: str, handler: Callable[[Dict[str, str]], Awaitable[Tuple[int, Dict]]]
+    ):
+        """Serves GET requests for path with handler, which gets the query
+        parameters and returns (status, JSON body)."""
+        self.http_routes[path] = handler
+
+    async def process_request(self, connection, request):
+        """Answers plain HTTP requests for registered routes, lets WebSocket handshakes through."""
+        if "Upgrade" in request.headers:
+            return None
+        url = urlsplit(request.path)
+        handler = self.http_routes.get(url.path)
+        if handler is None:
+            return None
+
+        try:
+            status, body = await handler(dict(parse_qsl(url.query)))
+        except Exception as e:
+            logging.error(f"Error handling HTTP request {request.path}: {e}")
+            status, body = 500, {"error": "Internal error"}
+        payload = json.dumps(body).encode()
+        headers = Headers(
+            [
+                ("Content-Type", "application/json"),
+                ("Content-Length", str(len(payload))),
+                ("Access-Control-Allow-Origin", "*"),
+            ]
+        )
+        return Response(status, HTTPStatus(status).phrase, headers, payload)
+
+    @staticmethod
+    def select_subprotocol(connection, subprotocols):
+        """Picks the delta format if the viewer offers it, otherwise continues with JSON."""
+        if DELTA_SUBPROTOCOL in subprotocols:
+            return DELTA_SUBPROTOCOL
+        return None
+
+    def handle_message(self, writer: ClientWriter, message):
+        """
+        Handles a message from a viewer. JSON viewers can narrow down what they get with
+        {"type": "subscribe", "cars": [uuid, ...], "fields": [group, ...], "max_rate": hz}
+        and go back to everything with {"type": "unsubscribe"}.
+        """
+        try:
+            request = json.loads(message)
+            request_type = request.get("type")
+        except (ValueError, AttributeError):
+            writer.send_control(json.dumps({"type": "error", "error": "Invalid JSON"}))
+            return
+
+        if isinstance(writer, DeltaClientWriter):
+            reply = {"type": "error", "error": "Subscriptions need the JSON format"}
+        elif request_type == "subscribe":
+            try:
+                subscription = Subscription.parse(request)
+            except ValueError as e:
+                reply = {"type": "error", "error": str(e)}
+            else:
+                writer.requested = subscription
+                self.apply_rate(writer)
+                reply = subscription.describe()
+        elif request_type == "unsubscribe":
+            writer.requested = None
+            self.apply_rate(writer)
+            reply = Subscription().describe()
+        else:
+            reply = {"type": "error", "error": f"Unknown message type {request_type}"}
+        writer.send_control(json.dumps(reply))
+
+    async def _read_messages(self, websocket, writer: ClientWriter):
+        async for message in websocket:
+            self.handle_message(writer, message)
 
     async def handler(self, websocket):
-        """Simple handler that just adds the client to the set and removes it when disconnected.
-        No longer processes incoming messages as they are not needed."""
+        """Adds the client with its own writer and removes it when disconnected.
+        Messages from the client are handled by handle_message."""
         logging.info(f"Client connected: {websocket.remote_address}")
 
-        self.clients.add(websocket)
+        if websocket.subprotocol == DELTA_SUBPROTOCOL:
+            writer = DeltaClientWriter(
+                websocket,
+                self.delta_encoder,
+                self.client_queue_size,
+                self.client_policy,
+                self.lag_timeout,
+            )
+            # The schema tells the viewer how to decode, the keyframe gives it the current state
+            writer.queue.append(json.dumps(SCHEMA))
+            writer.queue.append(self.delta_encoder.keyframe())
+            writer.ready.set()
+        else:
+            writer = ClientWriter(
+                websocket, self.client_queue_size, self.client_policy, self.lag_timeout
+            )
+            # Everything the viewer missed in one message, ahead of the first frame.
+            # Delta viewers get the current state from the keyframe instead.
+            if self.snapshot.latest:
+                writer.send_control(self.snapshot.message())
+        writer.send_seconds = self.send_seconds
+        self.clients[websocket] = writer
+        writer_task = asyncio.create_task(writer.run())
+        reader_task = asyncio.create_task(self._read_messages(websocket, writer))
         try:
-            # Just keep the connection alive, but don't process incoming messages
-            await websocket.wait_closed()
+            # Keep the connection alive while the writer sends frames
+            done, _ = await asyncio.wait(
+                [writer_task, reader_task],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                task.result()  # Raises if the connection failed
         except websockets.exceptions.ConnectionClosedOK:
             pass  # Client disconnected normally
         except websockets.exceptions.ConnectionClosedError as e:
             logging.error(f"WebSocket connection closed with error: {e}")
         finally:
-            logging.info(f"Client disconnected: {websocket.remote_address}")
-            self.clients.remove(websocket)
+            writer_task.cancel()
+            reader_task.cancel()
+            self.subscriptions.unsubscribe(writer)
+            self.dropped_frames_total += writer.dropped_frames
+            if writer.closing:
+                self.lag_disconnects += 1
+            logging.info(
+                f"Client disconnected: {websocket.remote_address} "
+                f"(sent {writer.sent_frames} frames, dropped {writer.dropped_frames})"
+            )
+            del self.clients[websocket]
+
+    def set_frame_bus(self, frame_bus):
+        self.frame_bus = frame_bus
+        logging.info("Frame bus instance set in WebSocketServer")
+
+    def set_jitter_buffer(self, jitter_buffer):
+        self.jitter_buffer = jitter_buffer
+        logging.info("Jitter buffer instance set in WebSocketServer")
 
-    async def start(self, devmode):
-        """Starts the WebSocket server and returns the Server instance."""
+    async def start(self, devmode, reuse_port=False):
+        """Starts the WebSocket server and returns the Server instance.
+        With reuse_port several processes can serve the same port."""
         try:
             if devmode is False:
                 logging.info(
@@ -56,8 +677,19 @@ class WebSocketServer:
 
             # Start the server
             self.server_instance = await websockets.serve(
-                self.handler, self.host, self.port, ssl=ssl_context
+                self.handler,
+                self.host,
+                self.port,
+                ssl=ssl_context,
+                subprotocols=[DELTA_SUBPROTOCOL],
+                select_subprotocol=self.select_subprotocol,
+                process_request=self.process_request,
+                compression=None,
+                extensions=[self.deflate] if self.deflate else None,
+                reuse_port=reuse_port,
             )
+            self.broadcast_task = asyncio.create_task(self._broadcast_loop())
+            self.adapt_task = asyncio.create_task(self._adapt_loop())
 
             if devmode:
                 logging.info(
@@ -77,6 +709,12 @@ class WebSocketServer:
 
     async def stop(self):
         """Stops the WebSocket server gracefully."""
+        if self.broadcast_task:
+            self.broadcast_task.cancel()
+            self.broadcast_task = None
+        if self.adapt_task:
+            self.adapt_task.cancel()
+            self.adapt_task = None
         if self.server_instance:
             logging.info("Stopping WebSocket server...")
             self.server_instance.close()
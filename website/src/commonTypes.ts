@@ -6,6 +6,39 @@ export enum PAGE {
 export type IncomingPacket = {
   uuid: string;
   vehicle: CarStateType;
+  recovered?: boolean; // Older sample recovered from a later packet's position history
+};
+
+// Sent once right after connecting: the latest update and recent positions of every car
+export type SnapshotMessage = {
+  type: "snapshot";
+  cars: IncomingPacket[];
+  trails: Record<string, [number, number, number][]>; // [timestamp, latitude, longitude]
+};
+
+// Sent when a car crosses the start/finish line, with the server running lap timing.
+// Times are in milliseconds, deltas are null without an earlier lap to compare with
+export type LapMessage = {
+  type: "lap";
+  uuid: string;
+  lap: number;
+  time_ms: number;
+  best_ms: number;
+  delta_ms: number | null; // To the car's best lap before this one
+  session_delta_ms: number | null; // To the fastest lap of any car before this one
+  timestamp: number; // When the line was crossed, in microseconds
+};
+
+// Sent when a car completes a sector, the last one ends at the start/finish line
+export type SectorMessage = {
+  type: "sector";
+  uuid: string;
+  lap: number;
+  sector: number; // Starting at 1
+  time_ms: number;
+  delta_ms: number | null; // To the car's best time in this sector
+  session_delta_ms: number | null; // To the fastest time of any car in this sector
+  timestamp: number;
 };
 
 export type RaceStateType = Record<string, CarStateType>;
@@ -1,7 +1,14 @@
 import { map, pickBy, size } from "lodash-es";
 import { useEffect, useState } from "react";
 import useWebSocket, { ReadyState } from "react-use-websocket";
-import { IncomingPacket, PAGE, RaceStateType } from "../commonTypes.ts";
+import {
+  IncomingPacket,
+  PAGE,
+  LapMessage,
+  RaceStateType,
+  SectorMessage,
+  SnapshotMessage,
+} from "../commonTypes.ts";
 import CarDisplay from "./CarDisplay.tsx";
 
 type RaceViewProps = {
@@ -23,9 +30,30 @@ const RaceView = ({ setPage, setConnectionState, setTime }: RaceViewProps) => {
     shouldReconnect: () => true,
     reconnectInterval: 3000,
     onMessage: (event) => {
-      const parsedData = JSON.parse(event.data) as IncomingPacket;
+      // The server sends one frame per tick with the latest update for each car,
+      // and a snapshot with the current state of every car right after connecting.
+      // Other messages, like lap and sector times, don't change the cars.
+      const frame = JSON.parse(event.data) as
+        | IncomingPacket
+        | IncomingPacket[]
+        | SnapshotMessage
+        | LapMessage
+        | SectorMessage;
+      if (
+        !Array.isArray(frame) &&
+        "type" in frame &&
+        frame.type !== "snapshot"
+      ) {
+        console.log("Received: ", frame);
+        return;
+      }
+      const packets = Array.isArray(frame)
+        ? frame
+        : "type" in frame
+          ? frame.cars
+          : [frame];
 
-      console.log("Received: ", parsedData);
+      console.log("Received: ", packets);
 
       const currentTime = Date.now();
       const carsUpdatedLast5Minutes = pickBy(raceState, (car) => {
@@ -34,10 +62,14 @@ const RaceView = ({ setPage, setConnectionState, setTime }: RaceViewProps) => {
 
       const newRaceState: RaceStateType = {
         ...carsUpdatedLast5Minutes,
-        [parsedData.uuid]: {
-          ...parsedData.vehicle,
-        },
       };
+      packets.forEach((packet) => {
+        // Recovered samples only fill gaps in the trace, the live one follows
+        if (packet.recovered) {
+          return;
+        }
+        newRaceState[packet.uuid] = { ...packet.vehicle };
+      });
 
       setRaceState(newRaceState);
     },